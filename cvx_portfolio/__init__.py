@@ -15,13 +15,52 @@ limitations under the License.
 """
 
 __version__ = "0.0.1"
-from .simulator import MarketSimulator
-from .result import SimulationResult
-from .policies import *
-from .constraints import *
-from .utils import *
-from .costs import TcostModel, HcostModel
-from .returns import *
-from .risks import (FullSigma, EmpSigma, SqrtSigma,
-                    FactorModelSigma, RobustFactorModelSigma,
-                    RobustSigma, WorstCaseRisk)
+
+import importlib
+import importlib.util
+
+# public names and the submodules defining them; submodules are only
+# imported when one of their names is first accessed
+_LAZY_NAMES = {
+    'simulator': ['MarketSimulator'],
+    'result': ['SimulationResult'],
+    'policies': ['Hold', 'FixedTrade', 'PeriodicRebalance',
+                 'AdaptiveRebalance', 'SinglePeriodOpt', 'MultiPeriodOpt',
+                 'ProportionalTrade', 'MultiAccountOpt',
+                 'JointAccountOpt'],
+    'solvers': ['SolverStrategy'],
+    'constraints': ['LongOnly', 'LeverageLimit', 'LongCash', 'MaxTrade',
+                    'ConstraintCompiler'],
+    'utils': ['plot_what_if'],
+    'costs': ['TcostModel', 'HcostModel'],
+    'returns': ['AlphaSource', 'MPOAlphaSource', 'AlphaStream'],
+    'risks': ['FullSigma', 'EmpSigma', 'SqrtSigma', 'FactorModelSigma',
+              'RobustFactorModelSigma', 'RobustSigma', 'WorstCaseRisk'],
+    'scenarios': ['BlockBootstrap', 'FactorScenarios', 'ScenarioMetrics'],
+    'sweep': ['ParameterSweep'],
+    'executors': ['SerialExecutor', 'ThreadExecutor', 'ProcessExecutor'],
+    'cache': ['MemoryCache', 'DiskCache'],
+    'data': ['MarketData'],
+}
+
+_LAZY = {name: module for module, names in _LAZY_NAMES.items()
+         for name in names}
+
+__all__ = sorted(_LAZY)
+
+
+def __getattr__(name):
+    if name in _LAZY:
+        value = getattr(importlib.import_module('.' + _LAZY[name], __name__),
+                        name)
+    elif importlib.util.find_spec('.' + name, __name__) is not None:
+        value = importlib.import_module('.' + name, __name__)
+    else:
+        raise AttributeError('module %r has no attribute %r' %
+                             (__name__, name))
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY) | set(_LAZY_NAMES))
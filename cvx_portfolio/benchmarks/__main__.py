@@ -0,0 +1,47 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import argparse
+
+import pandas as pd
+
+from .suite import BENCHMARKS, run_benchmarks, compare
+
+parser = argparse.ArgumentParser(
+    prog='python -m cvx_portfolio.benchmarks',
+    description='Benchmark the simulator and the policies on synthetic data.')
+parser.add_argument('--n', type=int, default=50, help='number of assets')
+parser.add_argument('--T', type=int, default=250, help='number of periods')
+parser.add_argument('--repeat', type=int, default=3)
+parser.add_argument('--opt-steps', type=int, default=20,
+                    help='steps of the optimization-based backtests')
+parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS),
+                    help='benchmarks to run')
+parser.add_argument('--output', help='JSON lines file to append results to')
+parser.add_argument('--compare', metavar='BASELINE',
+                    help='results file to compare against')
+args = parser.parse_args()
+
+pd.set_option('display.width', 200)
+results = run_benchmarks(n=args.n, T=args.T, names=args.only,
+                         repeat=args.repeat, opt_steps=args.opt_steps,
+                         output=args.output)
+print(results[['benchmark', 'steps', 'time', 'time_per_step', 'peak_memory']])
+if args.compare:
+    comparison = compare(args.compare, results)
+    print(comparison)
+    if comparison.regression.any():
+        raise SystemExit(1)
@@ -0,0 +1,337 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import datetime
+import gc
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .. import __version__
+from .. import kernels
+from ..simulator import MarketSimulator
+from ..costs import TcostModel, HcostModel
+from ..returns import AlphaSource
+from ..risks import FullSigma, EmpSigma, SqrtSigma, FactorModelSigma
+from ..policies import Hold, PeriodicRebalance, SinglePeriodOpt, MultiPeriodOpt
+from .synthetic import synthetic_market
+
+__all__ = ['BENCHMARKS', 'run_benchmarks', 'load_results', 'compare',
+           'heavy_imports']
+
+# name -> function(data, opt_steps) returning (callable to time, number of steps)
+BENCHMARKS = OrderedDict()
+
+# periods skipped by the optimization-based backtests, for EmpSigma
+WARM_UP = 25
+
+# dependencies that must not be loaded by the startup of a backtest
+HEAVY_MODULES = ['cvxpy', 'matplotlib', 'multiprocess']
+
+# what a short-lived job does before its first backtest
+STARTUP = ('import sys, types\n'
+           'import cvx_portfolio as cp\n'
+           'cp.MarketSimulator, cp.SinglePeriodOpt, cp.TcostModel\n')
+
+
+def benchmark(name):
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+def _simulator(data):
+    tcost = TcostModel(data['volumes'], data['sigmas'], data['spreads'],
+                       data['nonlin_coeff'])
+    hcost = HcostModel(data['borrow_costs'])
+    return MarketSimulator(data['returns'], data['volumes'], [tcost, hcost])
+
+
+def _initial_portfolio(data):
+    returns = data['returns']
+    return pd.Series(index=returns.columns, data=1E8 / returns.shape[1])
+
+
+def _target(data):
+    return _initial_portfolio(data) / 1E8
+
+
+def _times(data, steps=None):
+    """All times, or steps times after a warm-up for the lookback models."""
+    times = data['returns'].index
+    if steps is None:
+        return times
+    start = min(WARM_UP, len(times) - steps)
+    return times[start:start + steps]
+
+
+@benchmark('import_package')
+def bench_import(data, opt_steps):
+    command = [sys.executable, '-c', STARTUP]
+
+    def run():
+        subprocess.check_call(command)
+    return run, 1
+
+
+def heavy_imports():
+    """The HEAVY_MODULES loaded by STARTUP in a fresh interpreter."""
+    code = STARTUP + ('print(" ".join(name for name in %r if '
+                      'type(sys.modules.get(name)) is types.ModuleType))'
+                      % HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code])
+    return output.decode().split()
+
+
+@benchmark('propagate')
+def bench_propagate(data, opt_steps):
+    simulator = _simulator(data)
+    h = _initial_portfolio(data)
+    u = h * 0.01
+    u[simulator.cash_key] = 0.
+    times = _times(data)
+
+    def run():
+        for t in times:
+            simulator.propagate(h.copy(), u.copy(), t)
+    return run, len(times)
+
+
+@benchmark('propagate_numpy')
+def bench_propagate_numpy(data, opt_steps):
+    """propagate with the kernels not compiled, as without numba."""
+    run_compiled, steps = bench_propagate(data, opt_steps)
+
+    def run():
+        previous = kernels.use_jit(False)
+        try:
+            run_compiled()
+        finally:
+            kernels.use_jit(previous)
+    return run, steps
+
+
+def _backtest(data, policy, steps=None, **kwargs):
+    simulator = _simulator(data)
+    h = _initial_portfolio(data)
+    times = _times(data, steps)
+
+    def run():
+        return simulator.run_backtest(h, times[0], times[-1], policy, **kwargs)
+    return run, len(times)
+
+
+@benchmark('backtest_hold')
+def bench_backtest_hold(data, opt_steps):
+    return _backtest(data, Hold())
+
+
+@benchmark('backtest_periodic')
+def bench_backtest_periodic(data, opt_steps):
+    return _backtest(data, PeriodicRebalance(_target(data), 'month'))
+
+
+@benchmark('backtest_periodic_stepwise')
+def bench_backtest_periodic_stepwise(data, opt_steps):
+    return _backtest(data, PeriodicRebalance(_target(data), 'month'),
+                     fast_forward=False)
+
+
+def _spo(data, risk_model, opt_steps):
+    tcost = TcostModel(data['volumes'], data['sigmas'], data['spreads'],
+                       data['nonlin_coeff'])
+    hcost = HcostModel(data['borrow_costs'])
+    policy = SinglePeriodOpt(AlphaSource(data['return_estimate']),
+                             [10 * risk_model, tcost, hcost], [])
+    return _backtest(data, policy, opt_steps)
+
+
+@benchmark('spo_full_sigma')
+def bench_spo_full(data, opt_steps):
+    return _spo(data, FullSigma(data['Sigma']), opt_steps)
+
+
+@benchmark('spo_emp_sigma')
+def bench_spo_emp(data, opt_steps):
+    return _spo(data, EmpSigma(data['returns'], lookback=20), opt_steps)
+
+
+@benchmark('spo_sqrt_sigma')
+def bench_spo_sqrt(data, opt_steps):
+    sigma_sqrt = pd.DataFrame(np.linalg.cholesky(
+        data['Sigma'] + 1e-8 * np.eye(len(data['Sigma']))).T)
+    return _spo(data, SqrtSigma(sigma_sqrt), opt_steps)
+
+
+@benchmark('spo_factor_model')
+def bench_spo_factor(data, opt_steps):
+    return _spo(data, FactorModelSigma(data['exposures'], data['factor_Sigma'],
+                                       data['idiosync']), opt_steps)
+
+
+def _mpo(data, lookahead, opt_steps):
+    tcost = TcostModel(data['volumes'], data['sigmas'], data['spreads'],
+                       data['nonlin_coeff'])
+    hcost = HcostModel(data['borrow_costs'])
+    policy = MultiPeriodOpt(alpha_model=AlphaSource(data['return_estimate']),
+                            costs=[10 * FullSigma(data['Sigma']), tcost, hcost],
+                            constraints=[],
+                            trading_times=list(data['returns'].index),
+                            lookahead_periods=lookahead,
+                            terminal_weights=None)
+    return _backtest(data, policy, opt_steps)
+
+
+@benchmark('mpo_lookahead_2')
+def bench_mpo_2(data, opt_steps):
+    return _mpo(data, 2, opt_steps)
+
+
+@benchmark('mpo_lookahead_3')
+def bench_mpo_3(data, opt_steps):
+    return _mpo(data, 3, opt_steps)
+
+
+@benchmark('mpo_lookahead_5')
+def bench_mpo_5(data, opt_steps):
+    return _mpo(data, 5, opt_steps)
+
+
+@benchmark('result_metrics')
+def bench_result_metrics(data, opt_steps):
+    run, steps = _backtest(data, PeriodicRebalance(_target(data), 'week'))
+    result = run()
+
+    def metrics():
+        return [result.v, result.returns, result.sharpe_ratio,
+                result.max_drawdown, result.turnover, result.leverage,
+                result.annual_return, result.volatility]
+    return metrics, steps
+
+
+def _multiple(data, parallel):
+    simulator = _simulator(data)
+    h = _initial_portfolio(data)
+    times = _times(data)
+    policies = [PeriodicRebalance(_target(data), period)
+                for period in ['day', 'week', 'month', 'quarter']]
+
+    def run():
+        return simulator.run_multiple_backtest(h, times[0], times[-1],
+                                               policies, parallel=parallel)
+    return run, len(times) * len(policies)
+
+
+@benchmark('multiple_backtest_serial')
+def bench_multiple_serial(data, opt_steps):
+    return _multiple(data, False)
+
+
+@benchmark('multiple_backtest_parallel')
+def bench_multiple_parallel(data, opt_steps):
+    return _multiple(data, True)
+
+
+def _measure(func, repeat):
+    """Returns the wall-clock times of repeat runs and the peak memory."""
+    times = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+
+def run_benchmarks(n=50, T=250, names=None, repeat=3, opt_steps=20,
+                   output=None, seed=0):
+    """Runs the benchmarks on synthetic data of n assets and T periods.
+
+    Args:
+      names: list of benchmark names, default all of BENCHMARKS.
+      repeat: number of timed runs; the peak memory is measured in an extra run.
+      opt_steps: number of steps of the optimization-based backtests.
+      output: path of a JSON lines file the results are appended to.
+
+    Returns:
+      A DataFrame with one row per benchmark.
+    """
+    data = synthetic_market(n=n, T=T, seed=seed)
+    records = []
+    for name in (names or BENCHMARKS):
+        func, steps = BENCHMARKS[name](data, opt_steps)
+        times, peak = _measure(func, repeat)
+        records.append(OrderedDict([
+            ('benchmark', name), ('n', n), ('T', T), ('steps', steps),
+            ('time', min(times)), ('time_median', float(np.median(times))),
+            ('time_per_step', min(times) / steps),
+            ('us_per_step', 1E6 * min(times) / steps), ('peak_memory', peak),
+            ('jit', kernels.HAS_JIT),
+            ('version', __version__), ('python', platform.python_version()),
+            ('timestamp', datetime.datetime.now().isoformat())]))
+    if output is not None:
+        with open(output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+    return pd.DataFrame(records)
+
+
+def load_results(path):
+    """Loads the results written by run_benchmarks."""
+    with open(path) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+
+def compare(baseline, current, tolerance=0.2):
+    """Compares two sets of results, e.g. of two versions of the package.
+
+    The last result of each benchmark and size is used.
+
+    Args:
+      baseline, current: DataFrames or paths of results files.
+      tolerance: the relative slowdown (or memory increase) flagged
+          as a regression.
+
+    Returns:
+      A DataFrame with the time and memory ratios, current over baseline.
+    """
+    keys = ['benchmark', 'n', 'T']
+    frames = []
+    for results in [baseline, current]:
+        if not isinstance(results, pd.DataFrame):
+            results = load_results(results)
+        frames.append(results.groupby(keys).last()[['time', 'peak_memory']])
+    base, cur = frames
+    result = pd.DataFrame({'time_ratio': cur.time / base.time,
+                           'memory_ratio': cur.peak_memory / base.peak_memory})
+    result['regression'] = (result.time_ratio > 1 + tolerance) | \
+        (result.memory_ratio > 1 + tolerance)
+    return result.dropna(subset=['time_ratio'])
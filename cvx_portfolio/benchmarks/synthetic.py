@@ -0,0 +1,80 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['synthetic_market']
+
+
+def synthetic_market(n=50, T=250, num_factors=5, start='2010-01-04',
+                     cash_key='cash', seed=0):
+    """Generates synthetic market data of n assets over T periods.
+
+    Returns are drawn from a factor model, so that the factor model used to
+    generate them can also be used as risk model.
+
+    Returns:
+      A dict with the DataFrames 'returns' (with the cash column), 'volumes',
+      'sigmas', 'spreads', 'nonlin_coeff', 'borrow_costs' and
+      'return_estimate', the factor model data 'exposures', 'factor_Sigma'
+      and 'idiosync' (each valid from the first period on), and the full
+      covariance matrix 'Sigma'.
+    """
+    rng = np.random.RandomState(seed)
+    times = pd.bdate_range(start, periods=T)
+    tickers = ['A%04d' % i for i in range(n)]
+    columns = tickers + [cash_key]
+
+    exposures = rng.randn(num_factors, n) / np.sqrt(num_factors)
+    factor_vols = 0.01 * (1 + rng.rand(num_factors))
+    idio_vols = 0.01 * (1 + rng.rand(n))
+    factor_returns = rng.randn(T, num_factors) * factor_vols
+    asset_returns = factor_returns @ exposures + \
+        rng.randn(T, n) * idio_vols + 2e-4
+    cash_returns = np.full((T, 1), 1e-4)
+    returns = pd.DataFrame(np.hstack([asset_returns, cash_returns]),
+                           index=times, columns=columns)
+
+    total_vols = np.sqrt((exposures**2).T @ factor_vols**2 + idio_vols**2)
+    sigmas = pd.DataFrame(total_vols * np.exp(0.1 * rng.randn(T, n)),
+                          index=times, columns=tickers)
+    volumes = pd.DataFrame(1e8 * np.exp(rng.randn(T, n)),
+                           index=times, columns=tickers)
+    spreads = pd.DataFrame(5e-4, index=times, columns=tickers)
+    nonlin_coeff = pd.DataFrame(1., index=times, columns=tickers)
+    borrow_costs = pd.DataFrame(1e-4, index=times, columns=tickers)
+    return_estimate = returns + \
+        pd.DataFrame(0.02 * rng.randn(T, n + 1), index=times, columns=columns)
+    return_estimate[cash_key] = returns[cash_key]
+
+    # factor model data, valid from the first period on
+    exposures = np.hstack([exposures, np.zeros((num_factors, 1))])
+    idiosync = np.append(idio_vols**2, 0.)
+    Sigma = exposures.T @ np.diag(factor_vols**2) @ exposures + np.diag(idiosync)
+
+    def first(data):
+        values = np.empty(1, dtype=object)
+        values[0] = data
+        return pd.Series(values, index=times[:1])
+
+    return {'returns': returns, 'volumes': volumes, 'sigmas': sigmas,
+            'spreads': spreads, 'nonlin_coeff': nonlin_coeff,
+            'borrow_costs': borrow_costs, 'return_estimate': return_estimate,
+            'exposures': first(pd.DataFrame(exposures, columns=columns)),
+            'factor_Sigma': first(pd.DataFrame(np.diag(factor_vols**2))),
+            'idiosync': first(pd.Series(idiosync, index=columns)),
+            'Sigma': Sigma}
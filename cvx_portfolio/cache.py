@@ -0,0 +1,271 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+__all__ = ['SolutionCache', 'MemoryCache', 'DiskCache', 'step_fingerprints']
+
+# attributes that change at each call without changing the problem
+TRANSIENT = ('cache', 'stats', 'solver_used', 'expression', 'compiler')
+TRANSIENT_PREFIXES = ('_', 'last_', 'tmp_')
+
+
+def _fields(obj):
+    """The attributes of obj that define the problem it models."""
+    return {key: value for key, value in vars(obj).items()
+            if key not in TRANSIENT and not key.startswith(TRANSIENT_PREFIXES)}
+
+
+def _update_array(digest, values):
+    """Adds the content of the array values to the hash digest."""
+    values = np.asarray(values)
+    digest.update(repr((values.dtype, values.shape)).encode())
+    if values.dtype == object:
+        digest.update(repr(values.tolist()).encode())
+    else:
+        digest.update(np.ascontiguousarray(values).tobytes())
+
+
+def _is_cvxpy(obj):
+    return type(obj).__module__.startswith('cvxpy')
+
+
+def step_fingerprints(objs, times):
+    """Fingerprints of the data of objs used at each of times.
+
+    The rows of the pandas data indexed by time are assigned to the first
+    of times at or after them, those after the last to the last, and the
+    rest of the data and parameters to the static fingerprint. If the
+    models use the data up to the time of each step, a step only depends
+    on the data of its fingerprint, of those before it and the static one.
+
+    Returns:
+        The static fingerprint, and a Series of those of each of times.
+    """
+    static = hashlib.blake2b(digest_size=16)
+    steps = [hashlib.blake2b(digest_size=16) for t in times]
+    _update_steps(static, steps, times, objs, set())
+    return static.hexdigest(), pd.Series(index=times,
+                                         data=[step.hexdigest()
+                                               for step in steps])
+
+
+def _update_steps(static, steps, times, obj, seen):
+    if _is_cvxpy(obj):
+        return
+    if isinstance(obj, pd.core.generic.NDFrame) and \
+            isinstance(obj.axes[0], pd.DatetimeIndex):
+        for axis in obj.axes[1:]:
+            _update_array(static, axis.values)
+        positions = np.minimum(times.searchsorted(obj.axes[0]),
+                               len(times) - 1)
+        for position, t, row in zip(positions, obj.axes[0], obj.values):
+            steps[position].update(repr(t).encode())
+            _update_array(steps[position], row)
+    elif isinstance(obj, pd.core.generic.NDFrame):
+        for axis in obj.axes:
+            _update_array(static, axis.values)
+        _update_array(static, obj.values)
+    elif isinstance(obj, (np.ndarray, pd.Index)):
+        _update_array(static, obj)
+    elif isinstance(obj, (list, tuple)):
+        static.update(b'[')
+        for item in obj:
+            _update_steps(static, steps, times, item, seen)
+        static.update(b']')
+    elif isinstance(obj, dict):
+        for key in sorted(obj, key=repr):
+            static.update(repr(key).encode())
+            _update_steps(static, steps, times, obj[key], seen)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, (pd.Timestamp,
+                                                          pd.Timedelta)):
+        static.update(type(obj).__name__.encode())
+        if id(obj) in seen:
+            return
+        seen.add(id(obj))
+        _update_steps(static, steps, times, _fields(obj), seen)
+    else:
+        static.update(repr(obj).encode())
+
+
+class SolutionCache(object):
+    """A bounded cache of policy solutions, evicting the least recently used.
+
+    The solutions are keyed on a hash of the numeric inputs of the problem:
+    the time, the weights and value of the portfolio, and the data,
+    parameters and solver settings of the policy and its models. The
+    pandas data are hashed once, by identity, so they must not be changed
+    in place.
+
+    Attributes:
+      max_size: maximum number of solutions kept.
+      hits, misses: number of lookups found or not.
+    """
+
+    def __init__(self, max_size=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._digests = {}  # id of data -> (data, digest)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else np.nan
+
+    def __getstate__(self):
+        # the lock and the hashed data are not sent to the workers
+        state = dict(self.__dict__)
+        del state['_lock']
+        state['_digests'] = {}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _update(self, digest, obj, seen):
+        """Adds the content of obj to the hash digest."""
+        if _is_cvxpy(obj):
+            return
+        if obj is None or isinstance(obj, (bool, int, float, str, bytes,
+                                           pd.Timestamp, pd.Timedelta)):
+            digest.update(repr(obj).encode())
+        elif isinstance(obj, (np.ndarray, pd.Index)):
+            _update_array(digest, obj)
+        elif isinstance(obj, pd.core.generic.NDFrame):
+            # kept, so that its id is not reused
+            if id(obj) not in self._digests:
+                data = hashlib.blake2b(digest_size=16)
+                _update_array(data, obj.values)
+                for axis in getattr(obj, 'axes', []):
+                    data.update(repr(list(axis)).encode())
+                self._digests[id(obj)] = (obj, data.digest())
+            digest.update(self._digests[id(obj)][1])
+        elif isinstance(obj, (list, tuple)):
+            digest.update(b'[')
+            for item in obj:
+                self._update(digest, item, seen)
+            digest.update(b']')
+        elif isinstance(obj, dict):
+            for key in sorted(obj, key=repr):
+                digest.update(repr(key).encode())
+                self._update(digest, obj[key], seen)
+        elif hasattr(obj, '__dict__'):
+            digest.update(type(obj).__name__.encode())
+            if id(obj) in seen:
+                return
+            seen.add(id(obj))
+            self._update(digest, _fields(obj), seen)
+        else:
+            digest.update(repr(obj).encode())
+
+    def key(self, policy, t, w, value):
+        """The key of the problem of policy at time t, from weights w."""
+        digest = hashlib.blake2b(digest_size=16)
+        self._update(digest, [policy, t, np.asarray(w, dtype=float),
+                              float(value)], set())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """The solution of key, or None."""
+        with self._lock:
+            result = self._load(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return result
+
+    def put(self, key, solution):
+        with self._lock:
+            self._store(key, np.asarray(solution))
+
+    def _load(self, key):
+        raise NotImplementedError
+
+    def _store(self, key, solution):
+        raise NotImplementedError
+
+
+class MemoryCache(SolutionCache):
+    """A SolutionCache in memory, of each process."""
+
+    def __init__(self, max_size=1024):
+        super().__init__(max_size)
+        self._solutions = OrderedDict()
+
+    def _load(self, key):
+        if key not in self._solutions:
+            return None
+        self._solutions.move_to_end(key)
+        return self._solutions[key]
+
+    def _store(self, key, solution):
+        self._solutions[key] = solution
+        self._solutions.move_to_end(key)
+        while len(self._solutions) > self.max_size:
+            self._solutions.popitem(last=False)
+
+
+class DiskCache(SolutionCache):
+    """A SolutionCache in a directory, shared by processes.
+
+    Each solution is a .npy file, whose modification time is the last use.
+    """
+
+    def __init__(self, path, max_size=100000):
+        super().__init__(max_size)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        files = [name for name in os.listdir(path) if name.endswith('.npy')]
+        files.sort(key=lambda name: os.path.getmtime(os.path.join(path, name)))
+        self._keys = OrderedDict((name[:-4], None) for name in files)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.npy')
+
+    def _load(self, key):
+        try:
+            solution = np.load(self._file(key))
+            os.utime(self._file(key))
+        except (IOError, OSError, ValueError):
+            return None
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        return solution
+
+    def _store(self, key, solution):
+        # written whole, for the other processes
+        tmp = self._file(key) + '.%d.tmp' % os.getpid()
+        with open(tmp, 'wb') as f:
+            np.save(f, solution)
+        os.replace(tmp, self._file(key))
+        self._keys[key] = None
+        self._keys.move_to_end(key)
+        while len(self._keys) > self.max_size:
+            old, _ = self._keys.popitem(last=False)
+            try:
+                os.remove(self._file(old))
+            except OSError:
+                pass
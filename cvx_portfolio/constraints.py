@@ -16,10 +16,17 @@ limitations under the License.
 
 
 from abc import ABCMeta, abstractmethod
-import cvxpy as cvx
+import numpy as np
 import pandas as pd
 
-__all__ = ['LongOnly', 'LeverageLimit', 'LongCash', 'MaxTrade']
+from .expression import embed_active
+from .utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
+sp = lazy_import('scipy.sparse')
+
+__all__ = ['LongOnly', 'LeverageLimit', 'LongCash', 'MaxTrade',
+           'ConstraintCompiler']
 
 
 class BaseConstraint(object):
@@ -28,6 +35,10 @@ class BaseConstraint(object):
     def __init__(self, **kwargs):
         self.w_bench = kwargs.pop('w_bench', 0.)
 
+    def _cache_data(self):
+        """See Expression._cache_data."""
+        pass
+
     def weight_expr(self, t, w_plus, z, v):
         """Returns a list of trade constraints.
 
@@ -45,6 +56,24 @@ class BaseConstraint(object):
     def _weight_expr(self, t, w_plus, z, v):
         pass
 
+    def weight_bounds(self, t, w, v):
+        """Returns elementwise (lower, upper) bounds on the trade weights.
+
+        Box-type constraints override _weight_bounds, the others return None
+        and are passed to the solver through weight_expr.
+
+        Args:
+          t: time
+          w: pre-trade weights (numpy array), or None if not known numerically
+          v: portfolio value, or None if not known numerically
+        """
+        if w is None:
+            return self._weight_bounds(t, None, v)
+        return self._weight_bounds(t, np.asarray(w - self.w_bench), v)
+
+    def _weight_bounds(self, t, w, v):
+        return None
+
 
 class MaxTrade(BaseConstraint):
     """A limit on maximum trading size.
@@ -52,6 +81,8 @@ class MaxTrade(BaseConstraint):
     def __init__(self, ADVs, max_fraction=0.05, **kwargs):
         self.ADVs = ADVs
         self.max_fraction = max_fraction
+        # dollar limits over the whole time axis
+        self.limits = ADVs * max_fraction
         super(MaxTrade, self).__init__(**kwargs)
 
     def _weight_expr(self, t, w_plus, z, v):
@@ -65,6 +96,12 @@ class MaxTrade(BaseConstraint):
         """
         return cvx.abs(z[:-1])*v <= self.ADVs.loc[t].values * self.max_fraction  # TODO check [:-1] and fix pandas <=
 
+    def _weight_bounds(self, t, w, v):
+        if v is None:
+            return None
+        limit = np.append(self.limits.loc[t].values / v, np.inf)
+        return -limit, limit
+
 
 class LongOnly(BaseConstraint):
     """A long only constraint.
@@ -81,6 +118,11 @@ class LongOnly(BaseConstraint):
         """
         return w_plus >= 0
 
+    def _weight_bounds(self, t, w, v):
+        if w is None:
+            return None
+        return -w, np.full(len(w), np.inf)
+
 
 class LeverageLimit(BaseConstraint):
     """A limit on leverage.
@@ -121,3 +163,95 @@ class LongCash(BaseConstraint):
           wplus: holdings
         """
         return w_plus[-1] >= 0
+
+    def _weight_bounds(self, t, w, v):
+        if w is None:
+            return None
+        lower = np.full(len(w), -np.inf)
+        lower[-1] = -w[-1]
+        return lower, np.full(len(w), np.inf)
+
+
+class ConstraintCompiler(object):
+    """Lowers constraints on the trade weights to few cvxpy constraints.
+
+    Box-type constraints (and the no-trade masks of the costs) become
+    elementwise bounds on the trade weights z. These are stacked, together
+    with the budget constraint sum(z) == 0, into a single sparse matrix A,
+    so that the problem carries at most three constraint blocks
+    (equality, upper and lower) instead of one per constraint or ticker.
+    Constraints that are not box-type are passed through unchanged.
+    """
+
+    def __init__(self, constraints, costs=()):
+        self.constraints = constraints
+        self.costs = costs
+
+    def bounds(self, t, w, v, n):
+        """Returns the (lower, upper) bounds on z and the constraints
+        that could not be lowered to bounds.
+
+        Args:
+          t: time
+          w: pre-trade weights (numpy array), or None
+          v: portfolio value, or None
+          n: size of the trade vector
+        """
+        lower = np.full(n, -np.inf)
+        upper = np.full(n, np.inf)
+        other = []
+        for item in list(self.constraints) + list(self.costs):
+            bounds = item.weight_bounds(t, w, v)
+            if bounds is None:
+                if isinstance(item, BaseConstraint):
+                    other.append(item)
+                continue
+            lower = np.maximum(lower, bounds[0])
+            upper = np.minimum(upper, bounds[1])
+        return lower, upper, other
+
+    @staticmethod
+    def linear(lower, upper):
+        """Returns the sparse matrix A and the bounds on A*z.
+
+        The first row is the budget constraint, the others the bounds on z.
+        """
+        n = len(lower)
+        A = sp.vstack([sp.csr_matrix(np.ones((1, n))),
+                       sp.identity(n, format='csr')]).tocsr()
+        return A, np.append(0., lower), np.append(0., upper)
+
+    def weight_expr(self, t, w, z, v, active=None):
+        """Returns the list of constraints on the trade weights z.
+
+        Args:
+          t: time
+          w: pre-trade weights, numpy array or cvxpy expression
+          z: trade weights variable
+          v: portfolio value, number or cvxpy parameter
+          active: boolean array of the assets that trade, if z is over
+            these only, see Expression.weight_expr_active
+        """
+        w_num = w if isinstance(w, np.ndarray) else None
+        v_num = v if np.isscalar(v) else None
+        if active is None:
+            lower, upper, other = self.bounds(t, w_num, v_num, z.size[0])
+            w_plus, z_all = w + z, z
+        else:
+            lower, upper, other = self.bounds(t, w_num, v_num, len(active))
+            lower, upper = lower[active], upper[active]
+            w_plus, z_all = embed_active(w[active] + z, z, active, w)
+        A, lower, upper = self.linear(lower, upper)
+
+        constr = []
+        eq = lower == upper
+        if eq.any():
+            constr.append(A[eq] * z == lower[eq])
+        mask = ~eq & np.isfinite(upper)
+        if mask.any():
+            constr.append(A[mask] * z <= upper[mask])
+        mask = ~eq & np.isfinite(lower)
+        if mask.any():
+            constr.append(A[mask] * z >= lower[mask])
+
+        return constr + [con.weight_expr(t, w_plus, z_all, v) for con in other]
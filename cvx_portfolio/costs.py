@@ -14,23 +14,77 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import cvxpy as cvx
 import pandas as pd
 import numpy as np
 import copy
-from .expression import Expression
+from .expression import Expression, periods_between, embed_active
+from .kernels import rows
+from . import kernels
+from .utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
 
 __all__ = ['HcostModel', 'TcostModel']
 
 
+def _is_float_frame(obj):
+    if isinstance(obj, pd.DataFrame):
+        return all(np.issubdtype(dtype, np.floating) for dtype in obj.dtypes)
+    return isinstance(obj, pd.Series) and np.issubdtype(obj.dtype, np.floating)
+
+
 class BaseCost(Expression):
+    # of the arrays of the simulator kernels, see astype
+    dtype = np.float64
+
     def __init__(self):
         self.gamma = 1.  # it is changed by gamma * BaseCost()
 
+    def astype(self, dtype):
+        """A copy of the cost whose data and simulator kernels are of dtype,
+        e.g. np.float32; the costs of each portfolio are summed in float64.
+
+        The float frames of the copy are converted, so that it does not
+        refer to those of the original.
+        """
+        cost = copy.copy(self)
+        cost.dtype = dtype
+        for key, value in vars(self).items():
+            if _is_float_frame(value):
+                setattr(cost, key, value.astype(dtype))
+        cost._cache_data()
+        return cost
+
+    def reindex(self, assets):
+        """The cost with the columns of its data frames in the order of
+        assets, those of the trades and holdings of the simulator kernels.
+
+        It is a copy if some frame is reordered, else the cost itself.
+        """
+        frames = {key: value for key, value in vars(self).items()
+                  if isinstance(value, pd.DataFrame) and
+                  not value.columns.equals(assets) and
+                  assets.isin(value.columns).all()}
+        if not frames:
+            return self
+        cost = copy.copy(self)
+        for key, value in frames.items():
+            setattr(cost, key, value[assets])
+        cost._cache_data()
+        return cost
+
     def weight_expr(self, t, w_plus, z, value):
         cost, constr = self._estimate(t, w_plus, z, value)
         return self.gamma * cost, constr
 
+    def weight_expr_active(self, t, w_plus, z, value, active, w):
+        cost, constr = self._estimate_active(t, w_plus, z, value, active, w)
+        return self.gamma * cost, constr
+
+    def _estimate_active(self, t, w_plus, z, value, active, w):
+        w_plus, z = embed_active(w_plus, z, active, w)
+        return self._estimate(t, w_plus, z, value)
+
     def weight_expr_ahead(self, t, tau, w_plus, z, value):
         cost, constr = self._estimate_ahead(t, tau, w_plus, z, value)
         return self.gamma * cost, constr
@@ -45,6 +99,59 @@ class BaseCost(Expression):
         """Read the gamma parameter as a multiplication."""
         return self.__mul__(other)
 
+    def weight_bounds(self, t, w, value):
+        """Elementwise (lower, upper) bounds on the trade weights implied
+        by the cost, or None."""
+        return None
+
+    def weight_gradient(self, t, w_plus, z, value):
+        """Gradients of weight_expr in w_plus and in z, at numeric values."""
+        g_wplus, g_z = self._gradient(t, w_plus, z, value)
+        return self.gamma * g_wplus, self.gamma * g_z
+
+    def _gradient(self, t, w_plus, z, value):
+        raise NotImplementedError(
+            '%s has no gradient in the weights' % self.__class__.__name__)
+
+    def weight_hessian(self, t, w_plus, z, value):
+        """Hessians of weight_expr in w_plus and in z, at numeric values."""
+        H_wplus, H_z = self._hessian(t, w_plus, z, value)
+        return self.gamma * H_wplus, self.gamma * H_z
+
+    def _hessian(self, t, w_plus, z, value):
+        raise NotImplementedError(
+            '%s has no Hessian, needed by the sensitivity attribution' %
+            self.__class__.__name__)
+
+    def value_grad(self, t, h_plus, u):
+        """Gradients of value_expr in h_plus and in u, as arrays."""
+        raise NotImplementedError(
+            '%s has no gradient, needed by the sensitivity attribution' %
+            self.__class__.__name__)
+
+    def value_expr_batch(self, t, h_plus, u):
+        """value_expr for each row of the (S, n) arrays h_plus and u.
+
+        t is a time, or a sequence of S times, one per row.
+        """
+        raise NotImplementedError(
+            '%s has no batched value, needed by the scenarios' %
+            self.__class__.__name__)
+
+    def value_expr_shared(self, t, h_plus, u):
+        """value_expr_batch for rows trading in the same market at time t.
+
+        The rows are accounts, by default their costs are independent.
+        """
+        return self.value_expr_batch(t, h_plus, u)
+
+    def simulation_log_batch(self, times):
+        """simulation_log of the rows of the last value_expr_batch,
+        indexed by times."""
+        raise NotImplementedError(
+            '%s has no batched log, needed by the fast-forwarded steps' %
+            self.__class__.__name__)
+
 
 class HcostModel(BaseCost):
     """A model for holding costs.
@@ -56,10 +163,17 @@ class HcostModel(BaseCost):
 
     def __init__(self, borrow_costs, dividends=None, cash_key = 'cash'):
         self.borrow_costs = borrow_costs[borrow_costs.columns.difference([cash_key])]
-        self.dividends = None if not dividends else dividends[dividends.columns.difference([cash_key])]
+        self.dividends = None if dividends is None else dividends[dividends.columns.difference([cash_key])]
         self.cash_key = cash_key
+        self._cache_data()
         super().__init__()
 
+    def _cache_data(self):
+        # arrays of the simulator kernels
+        self._borrow_values = np.asarray(self.borrow_costs.values, dtype=self.dtype)
+        self._dividend_values = None if self.dividends is None else \
+            np.asarray(self.dividends.values, dtype=self.dtype)
+
     def _estimate(self, t, w_plus, z, value):
         ## TODO make expression a vector not a scalar (like tcost)
         """Estimate holding costs.
@@ -80,20 +194,63 @@ class HcostModel(BaseCost):
 
         return self.expression, []
 
+    def _estimate_active(self, t, w_plus, z, value, active, w):
+        # the holdings of the other assets add a constant
+        assets, fixed = active[:-1], ~active[:-1]
+        w_fixed = w[:-1][fixed]
+        borrow = self.borrow_costs.loc[t].values
+        self.expression = borrow[assets].T*cvx.neg(w_plus[:-1]) + \
+            borrow[fixed].dot(np.maximum(-w_fixed, 0.))
+        if self.dividends is not None:
+            dividends = self.dividends.loc[t].values
+            self.expression -= dividends[assets].T*w_plus[:-1] + \
+                dividends[fixed].dot(w_fixed)
+        return self.expression, []
+
     def _estimate_ahead(self, t, tau, w_plus, z, value):
         return self._estimate(t,w_plus, z, value)
 
     def value_expr(self, t, h_plus, u):
-        self.last_cost= -self.borrow_costs.loc[t].values.T @ np.minimum(0,h_plus.values[:-1])
-        if self.dividends is not None:
-            self.last_cost -= self.dividends.loc[t].values.T @ h_plus.values[:-1]
+        self.last_cost = self.value_expr_batch(t, h_plus.values[np.newaxis], None)[0]
         return self.last_cost
 
+    def _gradient(self, t, w_plus, z, value):
+        grad = np.zeros(len(w_plus))
+        grad[:-1] = -self.borrow_costs.loc[t].values * (np.asarray(w_plus)[:-1] < 0)
+        if self.dividends is not None:
+            grad[:-1] -= self.dividends.loc[t].values
+        return grad, np.zeros(len(w_plus))
+
+    def _hessian(self, t, w_plus, z, value):
+        # piecewise linear
+        n = len(w_plus)
+        return np.zeros((n, n)), np.zeros((n, n))
+
+    def value_grad(self, t, h_plus, u):
+        h_plus = np.asarray(h_plus)
+        grad = np.zeros(len(h_plus))
+        grad[:-1] = -self.borrow_costs.loc[t].values * (h_plus[:-1] < 0)
+        if self.dividends is not None:
+            grad[:-1] -= self.dividends.loc[t].values
+        return grad, np.zeros(len(h_plus))
+
+    def value_expr_batch(self, t, h_plus, u):
+        dividends = 0. if self.dividends is None else \
+            rows(self._dividend_values, self.dividends.index, t)
+        cost = kernels.hcost(h_plus[:, :-1], rows(self._borrow_values,
+                                                  self.borrow_costs.index, t),
+                             dividends).sum(axis=1, dtype=np.float64)
+        self.last_cost_batch = cost
+        return cost
+
+    def simulation_log_batch(self, times):
+        return pd.Series(index=times, data=self.last_cost_batch)
+
     def optimization_log(self,t):
         return self.expression.value
 
     def simulation_log(self,t):
-        return self.last_cost
+        return self.last_cost_batch[0]
 
 
 class TcostModel(BaseCost):
@@ -105,16 +262,32 @@ class TcostModel(BaseCost):
       spread: A dataframe of bid-ask spreads.
       nonlin_coeff: A dataframe of coefficients for the nonlinear cost.
       power: The nonlinear tcost power.
+      period: Length of the periods of est_period, or the bar times.
     """
-    def __init__(self, volume, sigma, spread, nonlin_coeff, power=1.5, cash_key='cash'):
+    def __init__(self, volume, sigma, spread, nonlin_coeff, power=1.5, cash_key='cash',
+                 period=pd.Timedelta("1 days")):
         self.volume = volume[volume.columns.difference([cash_key])]
         self.sigma = sigma[sigma.columns.difference([cash_key])]
         self.spread = spread[spread.columns.difference([cash_key])]
         self.nonlin_coeff = nonlin_coeff[nonlin_coeff.columns.difference([cash_key])]
         self.power = power
         self.cash_key = cash_key
+        self.period = period
+        self.impact = True
+        # if volume was 0 don't trade, over the whole time axis
+        self.no_trade = (self.nonlin_coeff * self.sigma *
+                         (1. / self.volume)**(power - 1)).isnull()
+        self._cache_data()
         super().__init__()
 
+    def _cache_data(self):
+        # arrays of the simulator kernels
+        coeff = self.nonlin_coeff * self.sigma * self.volume**(1 - self.power)
+        self._coeff_times = coeff.index
+        self._coeff_values = coeff.values.astype(self.dtype)
+        self._coeff_values[~np.isfinite(self._coeff_values)] = 0.  # not traded
+        self._spread_values = np.asarray(self.spread.values, dtype=self.dtype)
+
 
     def _estimate(self, t, w_plus, z, value):
         """Estimate tcosts given trades.
@@ -133,51 +306,127 @@ class TcostModel(BaseCost):
             z = z.values
         except AttributeError:
             z = z[:-1]  # TODO fix when cvxpy pandas ready
+        return self._tcost_expr(t, z, value, slice(None))
 
+    def _estimate_active(self, t, w_plus, z, value, active, w):
+        # the other assets do not trade, at no cost
+        return self._tcost_expr(t, z[:-1], value, active[:-1])
+
+    def _tcost_expr(self, t, z, value, assets):
+        """The tcosts of the trades z of the assets (mask or slice)."""
+        self.expression_assets = assets
         z_abs = cvx.abs(z)
-        tmp = self.nonlin_coeff.loc[t] * self.sigma.loc[t] * (value / self.volume.loc[t])**(self.power - 1)
+        # the value is factored out, so that it can be a cvxpy parameter
+        tmp = (self.nonlin_coeff.loc[t] * self.sigma.loc[t] * (1. / self.volume.loc[t])**(self.power - 1)).values[assets]
+        spread = self.spread.loc[t].values[assets]
 
         assert (z.size[0] == tmp.size)
-        assert (z.size[0] == self.spread.loc[t].size)
+        assert (z.size[0] == spread.size)
 
-        # if volume was 0 don't trade
-        no_trade = tmp.index[tmp.isnull()]
-        constr = []
-        for ticker in no_trade:
-            locator=tmp.index.get_loc(ticker)
-            constr.append(z[locator]==0)
-        tmp.loc[tmp.isnull()] = 0.
+        # no-trade tickers are fixed by weight_bounds
+        tmp[np.isnan(tmp)] = 0.
 
-        self.expression = cvx.mul_elemwise(self.spread.loc[t].values, z_abs) + \
-            cvx.mul_elemwise(tmp.values, (z_abs)**self.power)
+        self.expression = cvx.mul_elemwise(spread, z_abs)
+        if self.impact:
+            self.expression += value**(self.power - 1) * \
+                cvx.mul_elemwise(tmp, (z_abs)**self.power)
 
         res= cvx.sum_entries(self.expression)
 
         assert (res.is_convex())
-        return res, constr
-
-    def value_expr(self, t, h_plus, u):
-        # TODO figure out why calling weight_expr is buggy
-        value=sum(h_plus)
-        u_normalized = u/value
-        abs_u = np.abs(u_normalized[:-1])
+        return res, []
 
-        tcosts = self.spread.loc[t]*abs_u + self.nonlin_coeff.loc[t] * \
-                 self.sigma.loc[t] * (abs_u**self.power)/((self.volume.loc[t]/value)**(self.power-1))
+    def without_impact(self):
+        """Copy of the model with only the spread term, the market impact
+        being estimated on the aggregate trade, see JointAccountOpt."""
+        newobj = copy.copy(self)
+        newobj.impact = False
+        return newobj
 
-        self.tmp_tcosts=tcosts*value
+    def weight_bounds(self, t, w, value):
+        """Fixes the trades to zero where the volume was 0."""
+        mask = self.no_trade.loc[t].values
+        if not mask.any():
+            return None
+        bound = np.append(np.where(mask, 0., np.inf), np.inf)
+        return -bound, bound
 
-        return self.tmp_tcosts.sum()
+    def value_expr(self, t, h_plus, u):
+        # TODO figure out why calling weight_expr is buggy
+        return self.value_expr_batch(t, None, u.values[np.newaxis])[0]
+
+    def _gradient(self, t, w_plus, z, value):
+        z = np.asarray(z)[:-1]
+        tmp = (self.nonlin_coeff.loc[t] * self.sigma.loc[t] *
+               (value / self.volume.loc[t])**(self.power - 1)).fillna(0.).values
+        grad = np.zeros(len(z) + 1)
+        grad[:-1] = np.sign(z) * (self.spread.loc[t].values +
+                                  self.impact * self.power * tmp *
+                                  np.abs(z)**(self.power - 1))
+        return np.zeros(len(grad)), grad
+
+    def _hessian(self, t, w_plus, z, value):
+        # only the nonlinear term has curvature, none where z is 0
+        n = len(z)
+        tmp = self.nonlin_coeff.loc[t] * self.sigma.loc[t] * \
+            (value / self.volume.loc[t])**(self.power - 1)
+        z_abs = np.abs(np.asarray(z)[:-1])
+        curvature = np.zeros(n)
+        nonzero = z_abs > 0
+        curvature[:-1][nonzero] = (tmp.fillna(0.).values * self.power *
+                                   (self.power - 1) *
+                                   z_abs**(self.power - 2))[nonzero]
+        return np.zeros((n, n)), np.diag(curvature)
+
+    def _dollar_coeff(self, t):
+        """Coefficients of |u|^power in the cost of dollar trades u."""
+        return rows(self._coeff_values, self._coeff_times, t)
+
+    def value_grad(self, t, h_plus, u):
+        u = np.asarray(u)
+        grad = np.zeros(len(u))
+        grad[:-1] = np.sign(u[:-1]) * (self.spread.loc[t].values + self.power *
+                                       self._dollar_coeff(t) *
+                                       np.abs(u[:-1])**(self.power - 1))
+        return np.zeros(len(u)), grad
+
+    def value_expr_batch(self, t, h_plus, u):
+        # the cost of dollar trades does not depend on the value
+        self.tmp_tcosts_batch = kernels.tcost(
+            u[:, :-1], rows(self._spread_values, self.spread.index, t),
+            self._dollar_coeff(t), self.power)
+        return self.tmp_tcosts_batch.sum(axis=1, dtype=np.float64)
+
+    def value_expr_shared(self, t, h_plus, u):
+        # the impact of the net aggregate trade, split pro rata of |u|
+        abs_u = np.abs(u[:, :-1])
+        gross = abs_u.sum(axis=0)
+        share = np.divide(abs_u, gross, out=np.zeros(abs_u.shape),
+                          where=gross > 0)
+        impact = np.abs(u[:, :-1].sum(axis=0))**self.power * \
+            self._dollar_coeff(t)
+        self.tmp_tcosts_batch = abs_u * rows(self._spread_values, self.spread.index, t) + \
+            share * impact
+        return self.tmp_tcosts_batch.sum(axis=1, dtype=np.float64)
+
+    def simulation_log_batch(self, times):
+        return pd.DataFrame(index=times, data=self.tmp_tcosts_batch,
+                            columns=self.spread.columns)
 
     def optimization_log(self,t):
         try:
-            return self.expression.value.A1
+            values = self.expression.value.A1
         except AttributeError:
-            return np.nan
+            return np.full(len(self.spread.columns), np.nan)
+        if isinstance(self.expression_assets, slice):
+            return values
+        # built over the active assets, the others have no tcost
+        result = np.zeros(len(self.expression_assets))
+        result[self.expression_assets] = values
+        return result
 
     def simulation_log(self,t):
-        ## TODO find another way
-        return self.tmp_tcosts
+        return pd.Series(self.tmp_tcosts_batch[0], index=self.spread.columns)
 
     def _estimate_ahead(self, t, tau, w_plus, z, value):
         """Returns the estimate at time t of tcost at time tau.
@@ -187,5 +436,5 @@ class TcostModel(BaseCost):
     def est_period(self, t, tau_start, tau_end, w_plus, z, value):
         """Returns the estimate at time t of tcost over given period.
         """
-        K = (tau_end - tau_start).days
+        K = periods_between(tau_start, tau_end, self.period)
         return self.weight_expr(t, None, z / K, value) * K
@@ -0,0 +1,176 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from .costs import TcostModel, HcostModel
+from .simulator import MarketSimulator
+
+__all__ = ['FRAMES', 'MarketData']
+
+# the frames of the example dataset, dates by tickers, each read from
+# <name>.csv.gz
+FRAMES = ['returns', 'sigmas', 'volumes', 'prices', 'a', 'b', 's',
+          'return_estimate', 'sigma_estimate', 'volume_estimate']
+
+MANIFEST = 'manifest.json'
+
+
+class MarketData(object):
+    """The frames of the example dataset, loaded from a binary cache.
+
+    The .csv.gz files of datadir are converted once, and again when they
+    change, to cache_dir: the frames are aligned on the same dates and
+    tickers, the cash last, and saved as .npy arrays that are memory
+    mapped on load. Each frame keeps the range of dates of its file.
+
+    Attributes:
+      index: the dates of all frames.
+      columns: the tickers of all frames.
+      names: the frames in datadir.
+    """
+
+    def __init__(self, datadir, cache_dir=None, cash_key='USDOLLAR',
+                 mmap=True):
+        """
+        Args:
+            datadir: directory of the .csv.gz files.
+            cache_dir: directory of the cache, by default datadir/cache.
+            mmap: if False the arrays are read in memory.
+        """
+        self.datadir = datadir
+        self.cache_dir = cache_dir or os.path.join(datadir, 'cache')
+        self.cash_key = cash_key
+        self.mmap = mmap
+        sources = self._sources()
+        manifest = self._manifest()
+        if manifest is None or manifest['sources'] != sources:
+            manifest = self._convert(sources)
+        self.names = list(manifest['ranges'])
+        self._ranges = manifest['ranges']
+        self.index = pd.DatetimeIndex(self._load('index'))
+        self.columns = pd.Index(self._load('columns'))
+        self._frames = {}
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, name + '.npy')
+
+    def _sources(self):
+        """The size and modification time of the files of datadir."""
+        sources = {}
+        for name in FRAMES:
+            path = os.path.join(self.datadir, name + '.csv.gz')
+            if os.path.exists(path):
+                stat = os.stat(path)
+                sources[name] = [stat.st_size, stat.st_mtime]
+        return sources
+
+    def _manifest(self):
+        try:
+            with open(os.path.join(self.cache_dir, MANIFEST)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _convert(self, sources):
+        """Parses the files of datadir and writes the cache."""
+        logging.info('Converting the data of %s to %s' % (self.datadir,
+                                                          self.cache_dir))
+        frames = {name: pd.read_csv(os.path.join(self.datadir,
+                                                 name + '.csv.gz'),
+                                    index_col=0, parse_dates=[0])
+                  for name in sources}
+        index = pd.DatetimeIndex(sorted(set().union(
+            *[frame.index for frame in frames.values()])))
+        columns = []
+        for name in FRAMES:
+            if name in frames:
+                columns += [column for column in frames[name].columns
+                            if column not in columns]
+        if self.cash_key in columns:
+            columns.remove(self.cash_key)
+            columns.append(self.cash_key)
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._save('index', index.values.astype('datetime64[ns]'))
+        self._save('columns', np.array(columns, dtype=str))
+        ranges = {}
+        for name, frame in frames.items():
+            start, stop = index.searchsorted([frame.index.min(),
+                                              frame.index.max()])
+            self._save(name, frame.reindex(index=index[start:stop + 1],
+                                           columns=columns).values.astype(float))
+            ranges[name] = [int(start), int(stop) + 1]
+        # written last, the cache is used only if complete
+        manifest = {'sources': sources, 'ranges': ranges}
+        tmp = os.path.join(self.cache_dir, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp, os.path.join(self.cache_dir, MANIFEST))
+        return manifest
+
+    def _save(self, name, values):
+        tmp = self._path(name) + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, values)
+        os.replace(tmp, self._path(name))
+
+    def _load(self, name):
+        # copy on write, the changes to a frame are not saved
+        return np.load(self._path(name), mmap_mode='c' if self.mmap else None)
+
+    def __getitem__(self, name):
+        """The DataFrame of the frame name, e.g. 'returns'."""
+        if name not in self._frames:
+            if name not in self._ranges:
+                raise KeyError(name)
+            start, stop = self._ranges[name]
+            self._frames[name] = pd.DataFrame(self._load(name),
+                                              index=self.index[start:stop],
+                                              columns=self.columns, copy=False)
+        return self._frames[name]
+
+    def __contains__(self, name):
+        return name in self._ranges
+
+    def tcost_model(self, estimates=False):
+        """The TcostModel of the volumes, sigmas, a and b.
+
+        Args:
+            estimates: if True use volume_estimate and sigma_estimate, as
+                the optimization does, instead of the realized ones.
+        """
+        suffix = '_estimate' if estimates else 's'
+        return TcostModel(self['volume' + suffix], self['sigma' + suffix],
+                          self['a'], self['b'], cash_key=self.cash_key)
+
+    def hcost_model(self):
+        """The HcostModel of the borrow costs s."""
+        return HcostModel(self['s'], cash_key=self.cash_key)
+
+    def simulator(self, **kwargs):
+        """The MarketSimulator of the returns, volumes and realized costs.
+
+        The keyword arguments are passed to MarketSimulator.
+        """
+        return MarketSimulator(self['returns'], self['volumes'],
+                               [self.tcost_model(), self.hcost_model()],
+                               cash_key=self.cash_key, **kwargs)
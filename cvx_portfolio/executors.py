@@ -0,0 +1,109 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
+from .utils.lazy import lazy_import
+
+multiprocess = lazy_import('multiprocess')
+
+__all__ = ['SerialExecutor', 'ThreadExecutor', 'ProcessExecutor', 'EXECUTORS',
+           'isolate']
+
+
+class SerialExecutor(object):
+    """Runs the jobs one after the other, in this process."""
+
+    def map(self, func, items, chunksize=None):
+        return list(map(func, items))
+
+    def close(self):
+        pass
+
+
+class ThreadExecutor(object):
+    """Runs the jobs in a pool of threads of this process, kept between calls.
+
+    Nothing is pickled or copied to other processes, so it starts fast and
+    uses little memory, and is as fast as the process pool when the time
+    goes to solvers that release the GIL. The jobs must not share mutable
+    state, see isolate.
+    """
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers
+        self._pool = None
+
+    def map(self, func, items, chunksize=None):
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(self.max_workers)
+        return list(self._pool.map(func, items))
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_pool'] = None
+        return state
+
+
+class ProcessExecutor(object):
+    """Runs the jobs in a pool of worker processes, kept between calls.
+
+    The jobs, and what they refer to, are pickled to the workers.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = processes
+        self._pool = None
+
+    def map(self, func, items, chunksize=None):
+        if self._pool is None:
+            self._pool = multiprocess.Pool(self.processes or
+                                           multiprocess.cpu_count())
+        return self._pool.map(func, items, chunksize)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def __getstate__(self):
+        # the pool is not sent to the workers
+        state = dict(self.__dict__)
+        state['_pool'] = None
+        return state
+
+
+EXECUTORS = {'serial': SerialExecutor, 'thread': ThreadExecutor,
+             'process': ProcessExecutor}
+
+
+def isolate(obj):
+    """Copy of a simulator or policy for a job of a thread.
+
+    The costs keep what they computed last, e.g. for the logs, so they
+    are copied too; the data are shared.
+    """
+    obj = copy.copy(obj)
+    if hasattr(obj, 'costs'):
+        obj.costs = [copy.copy(cost) for cost in obj.costs]
+    return obj
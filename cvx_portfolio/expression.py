@@ -14,19 +14,65 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
-import cvxpy as cvx
+import numpy as np
 import pandas as pd
 from abc import ABCMeta, abstractmethod
 
+from .utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
+sp = lazy_import('scipy.sparse')
+
+
+def periods_between(t, tau, period=pd.Timedelta("1 days")):
+    """Number of periods from t to tau.
+
+    period is the length of a period, or the DatetimeIndex of the bars,
+    in which case the bars from t to tau are counted.
+    """
+    if isinstance(period, pd.DatetimeIndex):
+        return period.searchsorted(tau) - period.searchsorted(t)
+    return (tau - t) // period
+
+
+def embed_active(w_plus, z, active, w):
+    """The post-trade weights and the trades of all assets, from the
+    expressions w_plus and z over the active assets, the others not
+    trading, see Expression.weight_expr_active."""
+    select = sp.identity(len(w), format='csc')[:, np.flatnonzero(active)]
+    return np.where(active, 0., w) + select * w_plus, select * z
+
 
 class Expression(object):
     __metaclass__ = ABCMeta
 
+    # periods of data before t used at time t, see window.data_window
+    lookback_periods = 0
+
+    def _cache_data(self):
+        """Computes the arrays derived from the data, also after they are
+        restricted to a window, see window.restrict."""
+        pass
+
     @abstractmethod
     def weight_expr(self, t, w_plus, z, value):
         """Returns the estimate of cost at time t."""
         pass
 
+    def weight_expr_active(self, t, w_plus, z, value, active, w):
+        """weight_expr when only the active assets trade.
+
+        Args:
+          active: boolean array of the assets that trade
+          w: pre-trade weights of all assets (numpy array)
+          w_plus, z: expressions over the active assets only
+
+        By default these are embedded in the expressions over all assets,
+        the models override it to slice their data to the active assets.
+        """
+        w_plus, z = embed_active(w_plus, z, active, w)
+        return self.weight_expr(t, w_plus, z, value)
+
     def weight_expr_ahead(self, t, tau, w_plus, z, value):
         """Returns the estimate at time t of cost at time tau.
         """
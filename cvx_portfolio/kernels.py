@@ -0,0 +1,86 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import functools
+import importlib.util
+
+import numpy as np
+
+__all__ = ['HAS_JIT', 'use_jit', 'rows', 'tcost', 'hcost', 'propagate']
+
+# the kernels are compiled with numba if it is installed, else they run
+# as plain numpy; the rows of the arrays are portfolios
+HAS_JIT = importlib.util.find_spec('numba') is not None
+
+_enabled = [True]
+
+
+def use_jit(flag):
+    """Turns the compilation of the kernels on or off, returns the
+    previous setting."""
+    previous = _enabled[0]
+    _enabled[0] = flag
+    return previous
+
+
+def _jit(func):
+    """Compiles func with numba on its first call, numba being slow to
+    import."""
+    compiled = []
+
+    @functools.wraps(func)
+    def wrapper(*args):
+        if not (HAS_JIT and _enabled[0]):
+            return func(*args)
+        if not compiled:
+            import numba
+            compiled.append(numba.njit(cache=True)(func))
+        return compiled[0](*args)
+    return wrapper
+
+
+def rows(values, index, t):
+    """The row of the array values at time t, or its rows at each of the
+    times t, index being the times of the rows."""
+    if isinstance(t, (list, np.ndarray)) or hasattr(t, 'get_indexer'):
+        positions = index.get_indexer(t)
+        assert (positions >= 0).all()
+        return values[positions]
+    return values[index.get_loc(t)]
+
+
+@_jit
+def tcost(u, spread, coeff, power):
+    """Transaction costs of the (S, n) dollar trades u, by asset."""
+    abs_u = np.abs(u)
+    return abs_u * spread + coeff * abs_u**power
+
+
+@_jit
+def hcost(h_plus, borrow_costs, dividends):
+    """Holding costs of the (S, n) post-trade holdings h_plus, by asset."""
+    return -np.minimum(0., h_plus) * borrow_costs - h_plus * dividends
+
+
+@_jit
+def propagate(h, u, returns, costs):
+    """Holdings after the period, given the (S, n) holdings h, trades u
+    and returns, the cash being the last column, and the (S,) costs.
+
+    The cash column of u is set to fund the trades and the costs.
+    """
+    u[:, -1] = -u[:, :-1].sum(axis=1) - costs
+    return (1. + returns) * (h + u), u
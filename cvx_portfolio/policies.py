@@ -18,15 +18,22 @@ from abc import ABCMeta, abstractmethod
 import pandas as pd
 import numpy as np
 import logging
-import cvxpy as cvx
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from .costs import BaseCost
-from .returns import BaseAlphaModel
-from .constraints import BaseConstraint
+from .costs import BaseCost, TcostModel
+from .returns import BaseAlphaModel, AlphaStream
+from .constraints import BaseConstraint, ConstraintCompiler
+from .solvers import SolverStrategy
+from .utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
+sp = lazy_import('scipy.sparse')
 
 
 __all__ = ['Hold', 'FixedTrade', 'PeriodicRebalance', 'AdaptiveRebalance',
-            'SinglePeriodOpt', 'MultiPeriodOpt','ProportionalTrade']
+            'SinglePeriodOpt', 'MultiPeriodOpt','ProportionalTrade',
+            'MultiAccountOpt', 'JointAccountOpt']
 
 
 class BasePolicy(object):
@@ -36,6 +43,8 @@ class BasePolicy(object):
     def __init__(self):
         self.costs = []
         self.constraints = []
+        # per-call timings and solver statistics, logged by the result
+        self.stats = {}
 
     @abstractmethod
     def get_trades(self, portfolio, t):
@@ -46,11 +55,35 @@ class BasePolicy(object):
     def _nulltrade(self, portfolio):
         return pd.Series(index=portfolio.index, data=0.)
 
+    def _cache_data(self):
+        """See Expression._cache_data."""
+        pass
+
+    def get_state(self):
+        """The attributes changed by get_trades, as a dict."""
+        return {}
+
+    def set_state(self, state):
+        """Restores a state returned by get_state."""
+        self.__dict__.update(state)
+
+    def next_decision_time(self, t, times):
+        """The first of times after t at which get_trades may trade.
+
+        Called after get_trades at t; the simulator skips the calls in
+        between, where the trades must be null. A time after the last of
+        times means no more trades, None that get_trades is always called.
+        """
+        return None
+
 class Hold(BasePolicy):
     """Hold initial portfolio.
     """
     def get_trades(self, portfolio, t):
         return self._nulltrade(portfolio)
+
+    def next_decision_time(self, t, times):
+        return pd.Timestamp.max
     
 
 class ProportionalTrade(BasePolicy):
@@ -111,13 +144,30 @@ class PeriodicRebalance(BaseRebalance):
         Args:
             target: target weights, n+1 vector
             period: supported options are "day", "week", "month", "quarter", "year".
-                rebalance on the first day of each new period
+                rebalance on the first day of each new period.
+                Or a pd.Timedelta, rebalance as soon as period has passed
+                since the last rebalance, e.g. for intraday bars.
         """
         self.target = target
         self.period = period
         super().__init__()
 
+    def get_state(self):
+        return {key: getattr(self, key) for key in ('last_t', 'last_rebalance')
+                if hasattr(self, key)}
+
+    def set_state(self, state):
+        self.__dict__.pop('last_t', None)
+        self.__dict__.pop('last_rebalance', None)
+        super().set_state(state)
+
     def is_start_period(self, t):
+        if isinstance(self.period, pd.Timedelta):
+            result = not hasattr(self, 'last_rebalance') or \
+                t - self.last_rebalance >= self.period
+            if result:
+                self.last_rebalance = t
+            return result
         result = not getattr(t, self.period) == getattr(self.last_t, self.period) \
             if hasattr(self, 'last_t') else True
         self.last_t = t
@@ -127,6 +177,21 @@ class PeriodicRebalance(BaseRebalance):
         return self._rebalance(portfolio) if self.is_start_period(t) else \
             self._nulltrade(portfolio)
 
+    def next_decision_time(self, t, times):
+        if isinstance(self.period, pd.Timedelta):
+            idx = times.searchsorted(self.last_rebalance + self.period)
+            return times[idx] if idx < len(times) else pd.Timestamp.max
+        # look in growing windows, so the cost is that of the gap
+        start, size = times.searchsorted(t, side='right'), 64
+        while start < len(times):
+            later = times[start:start + size]
+            new_period = np.asarray(getattr(later, self.period)) != \
+                getattr(t, self.period)
+            if new_period.any():
+                return later[new_period.argmax()]
+            start, size = start + size, 2 * size
+        return pd.Timestamp.max
+
 
 class AdaptiveRebalance(BaseRebalance):
     """ Rebalance portfolio when deviates too far from target.
@@ -150,7 +215,23 @@ class AdaptiveRebalance(BaseRebalance):
 class SinglePeriodOpt(BasePolicy):
 
     def __init__(self, alpha_model, costs, constraints, solver=None,
-                solver_opts = {}):
+                solver_opts = {}, active_set=False, kkt_tol=1e-6, cache=None):
+        """
+        Args:
+            alpha_model: the alpha model
+            costs: list of costs
+            constraints: list of constraints
+            solver: the cvxpy solver, or a SolverStrategy
+            solver_opts: options passed to the solver
+            active_set: if True the problem is built only over the assets
+                that are tradable and either held or with non-zero alpha,
+                the others are fixed at zero trade. The optimality of the
+                excluded assets is checked after each solve, and the
+                problem is solved again if some were wrongly excluded.
+            kkt_tol: tolerance of the optimality check
+            cache: a SolutionCache, the trades are looked up there before
+                solving (not by MultiPeriodOpt)
+        """
 
         self.alpha_model = alpha_model
         solver_opts=solver_opts
@@ -168,26 +249,48 @@ class SinglePeriodOpt(BasePolicy):
 
         self.solver = solver
         self.solver_opts = solver_opts
+        if isinstance(solver, SolverStrategy):
+            self.solver_strategy = solver
+        else:
+            self.solver_strategy = SolverStrategy([(solver, solver_opts)])
+        self.solver_used = None
+        self.active_set = active_set
+        self.kkt_tol = kkt_tol
+        self.cache = cache
+        self._cache_data()
+
+    def _cache_data(self):
+        # the compiler refers to the constraints and costs, see restrict
+        self.compiler = ConstraintCompiler(self.constraints, self.costs)
+
+    def _problem(self, t, w, z, value, active=None):
+        """Builds the problem over trade weights z (variable or expression).
+
+        If active is given z are the trades of the active assets only,
+        the others do not trade and the models are sliced to the active
+        assets, see Expression.weight_expr_active.
+        """
+        costs, constraints = [], []
 
-
-    def get_trades(self, portfolio, t):
-
-        value = sum(portfolio)
-        w = portfolio/value
-        z = cvx.Variable(w.size)  # TODO pass index
-        wplus = w.values + z
-
-        alpha_term = self.alpha_model.weight_expr(t, wplus)
+        if active is None:
+            wplus = w + z
+            alpha_term = self.alpha_model.weight_expr(t, wplus)
+        else:
+            wplus = w[active] + z
+            alpha_term = self.alpha_model.weight_expr_active(
+                t, wplus, z, value, active, w)
         assert(alpha_term.is_concave())
 
-        costs, constraints = [], []
-
         for cost in self.costs:
-            cost_expr, const_expr = cost.weight_expr(t, wplus, z, value)
+            if active is None:
+                cost_expr, const_expr = cost.weight_expr(t, wplus, z, value)
+            else:
+                cost_expr, const_expr = cost.weight_expr_active(
+                    t, wplus, z, value, active, w)
             costs.append(cost_expr)
             constraints += const_expr
 
-        constraints += [item for item in (con.weight_expr(t, wplus, z, value) for con in self.constraints)]
+        constraints += self.compiler.weight_expr(t, w, z, value, active)
 
         for el in costs:
             assert (el.is_convex())
@@ -195,24 +298,404 @@ class SinglePeriodOpt(BasePolicy):
         for el in constraints:
             assert (el.is_dcp())
 
-        prob = cvx.Problem(
-            cvx.Maximize(alpha_term - sum(costs)),
-            [cvx.sum_entries(z) == 0] + constraints)
+        return cvx.Problem(
+            cvx.Maximize(alpha_term - sum(costs)), constraints)
+
+    def _new_stats(self):
+        self.stats = {'build_time': 0., 'canon_time': 0., 'setup_time': 0.,
+                      'solver_time': 0., 'transfer_time': 0., 'readback_time': 0.,
+                      'status': np.nan, 'num_iters': np.nan,
+                      'primal_residual': np.nan, 'dual_residual': np.nan,
+                      'solver': np.nan, 'cache_hit': np.nan}
+
+    def _record_solve(self, solution, wall_time):
+        """Splits the solve time and collects the solver statistics.
+
+        The time to send the problem to the solver process and the solution
+        back is the transfer time, the rest of the time not spent in the
+        solver is canonicalization.
+        """
+        stats = solution.stats
+        setup_time = getattr(stats, 'setup_time', None) or 0.
+        solve_time = getattr(stats, 'solve_time', None) or 0.
+        num_iters = getattr(stats, 'num_iters', None)
+        extra = getattr(stats, 'extra_stats', None)
+        info = extra.get('info', extra) if isinstance(extra, dict) else {}
+
+        self.stats['setup_time'] += setup_time
+        self.stats['solver_time'] += solve_time
+        self.stats['transfer_time'] += solution.transfer_time
+        self.stats['canon_time'] += max(wall_time - setup_time - solve_time -
+                                        solution.transfer_time, 0.)
+        self.stats['status'] = solution.status
+        self.stats['num_iters'] = np.nan if num_iters is None else num_iters
+        self.stats['primal_residual'] = info.get('pres', info.get('resPri', np.nan))
+        self.stats['dual_residual'] = info.get('dres', info.get('resDual', np.nan))
+        self.stats['solver'] = self.solver_used or np.nan
+
+    def _solve(self, prob, deadline=None):
+        """Solves the problem, returns False if no trade should be made.
+
+        The solves of a time step share the deadline of the solver strategy.
+        """
+        start = time.time()
+        solution = self.solver_strategy.solve(prob, deadline)
+        self.solver_used = solution.solver
+        self._record_solve(solution, time.time() - start)
+        if self.solver_used is None:
+            logging.error('All solvers failed. Defaulting to no trades')
+            return False
+        return True
+
+    def _active_assets(self, t, w, lower, upper):
+        """Tradable assets that are held or have non-zero alpha, and cash."""
+        support = self.alpha_model.support(t)
+        active = (w != 0) if support is None else ((w != 0) | support)
+        active = active & (lower < upper)
+        active[-1] = True
+        return active
+
+    def _kkt_violations(self, t, w, value, trade, excluded, lower, upper):
+        """Excluded assets whose trade against cash improves the objective.
+
+        The one-sided derivatives of the objective are evaluated with all
+        excluded assets slightly bought and slightly sold.
+        """
+        eps = np.sqrt(self.kkt_tol) * excluded
+        grads = self._objective_gradients(t, w, value, trade, (eps, -eps))
+        if grads is None:
+            logging.warning('Objective not differentiable at %s, skipping optimality check' % t)
+            return np.zeros(len(w), dtype=bool)
+
+        up, down = grads
+        buy = (upper > 0) & (up - up[-1] > self.kkt_tol)
+        sell = (lower < 0) & (down - down[-1] < -self.kkt_tol)
+        return excluded & (buy | sell)
+
+    def _objective_gradients(self, t, w, value, trade, steps):
+        """Gradients of the objective in the trade weights at trade + step,
+        for each of steps, or None if not differentiable there.
+
+        They are computed from the gradients of the models, or of the cvxpy
+        objective over all assets if some model does not have them.
+        """
         try:
-            prob.solve(solver=self.solver, **self.solver_opts)
+            grads = []
+            for step in steps:
+                wplus = w + trade + step
+                grad = self.alpha_model.weight_gradient(t, wplus)
+                for cost in self.costs:
+                    g_wplus, g_z = cost.weight_gradient(t, wplus, trade + step,
+                                                        value)
+                    grad = grad - g_wplus - g_z
+                grads.append(np.asarray(grad, dtype=float))
+            return grads
+        except NotImplementedError:
+            pass
+        x = cvx.Variable(len(w))
+        obj = self.alpha_model.weight_expr(t, w + x) - \
+            sum(cost.weight_expr(t, w + x, x, value)[0] for cost in self.costs)
+        grads = []
+        for step in steps:
+            x.value = trade + step
+            grad = obj.grad[x]
+            if grad is None:
+                return None
+            grads.append(np.asarray(grad.todense() if sp.issparse(grad) else grad).ravel())
+        x.value = trade  # so that the cost expressions log the solution
+        return grads
+
+    def trade_sensitivities(self, t, w, trade, value):
+        """First-order sensitivities of the optimal trade weights.
+
+        The optimality conditions are differentiated over the free trades,
+        non-zero and strictly inside their bounds, with cash taking the
+        other side. The other trades and constraints are held fixed.
 
-            if prob.status == 'unbounded':
-                logging.error('The problem is unbounded. Defaulting to no trades')
-                return self._nulltrade(portfolio)
+        Args:
+            t: time of the trade.
+            w: weights before the trade.
+            trade: optimal trade weights at t.
+            value: portfolio value.
+        Returns:
+            (dz/dtheta, dz/dw), n x K sensitivities to the weights of the
+            sources of the AlphaStream and n x n sensitivities to w.
+        """
+        assert isinstance(self.alpha_model, AlphaStream)
+        n = len(w)
+        wplus = w + trade
+        lower, upper, _ = self.compiler.bounds(t, w, value, n)
+        tol = np.sqrt(self.kkt_tol)
+        free = (np.abs(trade) > tol) & (trade > lower + tol) & \
+            (trade < upper - tol)
+        free[-1] = True
+
+        H_wplus, H_z = np.zeros((n, n)), np.zeros((n, n))
+        for cost in self.costs:
+            H1, H2 = cost.weight_hessian(t, wplus, trade, value)
+            H_wplus += H1
+            H_z += H2
+        grads = np.column_stack([source.weight_gradient(t, wplus)
+                                 for source in self.alpha_model.alpha_sources])
+        K = grads.shape[1]
+
+        # KKT system of the free trades and the budget constraint
+        idx = np.flatnonzero(free)
+        m = len(idx)
+        kkt = np.zeros((m + 1, m + 1))
+        kkt[:m, :m] = (H_wplus + H_z)[np.ix_(idx, idx)]
+        kkt[:m, m] = 1.
+        kkt[m, :m] = 1.
+        rhs = np.zeros((m + 1, K + n))
+        rhs[:m, :K] = grads[idx]
+        rhs[:m, K:] = -H_wplus[idx]
+        dz = np.zeros((n, K + n))
+        dz[idx] = np.linalg.lstsq(kkt, rhs, rcond=None)[0][:m]
+        return dz[:, :K], dz[:, K:]
+
+    def get_trades(self, portfolio, t):
 
-            if prob.status == 'infeasible':
-                logging.error('The problem is infeasible. Defaulting to no trades')
+        self._new_stats()
+        value = sum(portfolio)
+        w = (portfolio/value).values
+
+        if self.cache is not None:
+            key = self.cache.key(self, t, w, value)
+            trade = self.cache.get(key)
+            self.stats['cache_hit'] = trade is not None
+            if trade is not None:
+                return pd.Series(index=portfolio.index, data=(trade * value))
+
+        deadline = self.solver_strategy.deadline()
+        active = None
+        if self.active_set:
+            lower, upper, _ = self.compiler.bounds(t, w, value, len(w))
+            active = self._active_assets(t, w, lower, upper)
+
+        while True:
+            if active is None:
+                z = cvx.Variable(len(w))  # TODO pass index
+            else:
+                # the problem is over the active assets only
+                z = cvx.Variable(int(active.sum()))
+
+            start = time.time()
+            prob = self._problem(t, w, z, value, active)
+            self.stats['build_time'] += time.time() - start
+            if not self._solve(prob, deadline):
                 return self._nulltrade(portfolio)
+            start = time.time()
+            if active is None:
+                trade = np.asarray(z.value).ravel()
+            else:
+                trade = np.zeros(len(w))
+                trade[active] = np.asarray(z.value).ravel()
+            self.stats['readback_time'] += time.time() - start
+
+            if active is None or active.all():
+                break
+            violations = self._kkt_violations(t, w, value, trade, ~active,
+                                              lower, upper)
+            if not violations.any():
+                break
+            logging.info('%d assets wrongly excluded from the active set at %s, solving again' %
+                         (violations.sum(), t))
+            active = active | violations
+
+        if self.cache is not None:
+            self.cache.put(key, trade)
+        start = time.time()
+        result = pd.Series(index=portfolio.index, data=(trade * value))  # TODO will have index
+        self.stats['readback_time'] += time.time() - start
+        return result
+
+class MultiAccountOpt(SinglePeriodOpt):
+    """SinglePeriodOpt for many accounts sharing the market model.
+
+    At each time the problem is built once, with the weights, value and
+    leverage limit of the account as parameters, and solved for each
+    account by setting them. The alpha, risk and cost data are looked up
+    once, and cvxpy reuses the canonicalized problem between the solves.
+    """
+
+    def __init__(self, alpha_model, costs, constraints, leverage_limits=None,
+                 **kwargs):
+        """
+        Args:
+            leverage_limits: leverage limit of each account, a number or a
+                pd.Series indexed by account, or None
+            others: as in SinglePeriodOpt
+        """
+        super().__init__(alpha_model, costs, constraints, **kwargs)
+        self.leverage_limits = leverage_limits
+
+    def _account_problem(self, t, n):
+        """Builds the problem at t over parameters w, value and leverage."""
+        self.w = cvx.Parameter(n)
+        self.value = cvx.Parameter(sign='positive')
+        z = cvx.Variable(n)
+        prob = self._problem(t, self.w, z, self.value)
+        if self.leverage_limits is not None:
+            self.leverage = cvx.Parameter(sign='positive')
+            prob = cvx.Problem(prob.objective, prob.constraints +
+                               [cvx.norm(self.w + z, 1) <= self.leverage])
+        return prob, z
+
+    def get_trades(self, portfolios, t):
+        """Trades of the accounts, rows of the dataframe portfolios."""
+        self._new_stats()
+        values = portfolios.sum(axis=1).values
+        assert (values > 0.).all()
+        weights = portfolios.values / values[:, np.newaxis]
+        if self.leverage_limits is not None:
+            limits = pd.Series(self.leverage_limits, index=portfolios.index)
+
+        start = time.time()
+        prob, z = self._account_problem(t, weights.shape[1])
+        self.stats['build_time'] += time.time() - start
+
+        trades = np.zeros(weights.shape)
+        deadline = self.solver_strategy.deadline()
+        for k in range(len(weights)):
+            self.w.value = weights[k]
+            self.value.value = values[k]
+            if self.leverage_limits is not None:
+                self.leverage.value = limits.iloc[k]
+            if self._solve(prob, deadline):
+                start = time.time()
+                trades[k] = np.asarray(z.value).ravel() * values[k]
+                self.stats['readback_time'] += time.time() - start
+        return pd.DataFrame(trades, index=portfolios.index,
+                            columns=portfolios.columns)
+
+
+class JointAccountOpt(MultiAccountOpt):
+    """MultiAccountOpt with the market impact of the aggregate trade.
+
+    The nonlinear term of the TcostModel costs is charged on the sum of
+    the dollar trades of the accounts, which trade in the same volume.
+    The problem is decomposed by ADMM on the aggregate trade (the sharing
+    problem of Boyd et al., Distributed Optimization, 2011, section 7.3).
+    At each iteration the account problems, with the spread cost only and
+    a proximal term, are solved in parallel threads, and the impact of
+    the aggregate trade by an elementwise bisection.
+    """
+
+    def __init__(self, alpha_model, costs, constraints, leverage_limits=None,
+                 rho=1., max_iters=100, eps=1e-5, max_workers=None, **kwargs):
+        """
+        Args:
+            rho: the ADMM penalty, with trades as fractions of the total
+                value of the accounts
+            max_iters: maximum number of ADMM iterations
+            eps: tolerance on the primal and dual residuals
+            max_workers: number of threads solving the account problems
+            others: as in MultiAccountOpt
+        """
+        self.impact_models = [cost for cost in costs
+                              if isinstance(cost, TcostModel)]
+        costs = [cost.without_impact() if isinstance(cost, TcostModel)
+                 else cost for cost in costs]
+        super().__init__(alpha_model, costs, constraints,
+                         leverage_limits=leverage_limits, **kwargs)
+        self.rho = rho
+        self.max_iters = max_iters
+        self.eps = eps
+        self.max_workers = max_workers
+
+    def _penalized_problem(self, t, w, value, scale, limit):
+        """The problem of an account, with the proximal term on the trades
+        of the ADMM update, scale being its fraction of the total value."""
+        z = cvx.Variable(len(w))
+        target = cvx.Parameter(len(w) - 1)
+        prob = self._problem(t, w, z, value)
+        constraints = prob.constraints
+        if limit is not None:
+            constraints = constraints + [cvx.norm(w + z, 1) <= limit]
+        objective = prob.objective.args[0] - \
+            self.rho * scale / 2. * cvx.sum_squares(z[:-1] - target)
+        return cvx.Problem(cvx.Maximize(objective), constraints), z, target
+
+    def _impact_prox(self, t, b, num, total, iters=60):
+        """Minimizes impact(num * s) + num * rho / 2 * ||s - b||^2 over s,
+        with s and b fractions of the total value."""
+        coeffs = [model.gamma * model._dollar_coeff(t) *
+                  total**(model.power - 1) * num**model.power
+                  for model in self.impact_models]
+        powers = [model.power for model in self.impact_models]
+        # the derivative in |s| is increasing, with a root in [0, |b|]
+        lower, upper = np.zeros(len(b)), np.abs(b)
+        for i in range(iters):
+            mid = (lower + upper) / 2.
+            grad = num * self.rho * (mid - np.abs(b)) + \
+                sum(c * p * mid**(p - 1) for c, p in zip(coeffs, powers))
+            lower = np.where(grad < 0, mid, lower)
+            upper = np.where(grad < 0, upper, mid)
+        return np.sign(b) * (lower + upper) / 2.
+
+    def get_trades(self, portfolios, t):
+        """Trades of the accounts, rows of the dataframe portfolios."""
+        self._new_stats()
+        values = portfolios.sum(axis=1).values
+        assert (values > 0.).all()
+        weights = portfolios.values / values[:, np.newaxis]
+        K, n = weights.shape
+        total = values.sum()
+        scales = values / total
+        limits = pd.Series([None] * K, index=portfolios.index)
+        if self.leverage_limits is not None:
+            limits = pd.Series(self.leverage_limits, index=portfolios.index)
+
+        start = time.time()
+        problems = [self._penalized_problem(t, weights[k], values[k],
+                                            scales[k], limits.iloc[k])
+                    for k in range(K)]
+        self.stats['build_time'] += time.time() - start
+
+        def solve(k, target):
+            prob, z, target_param = problems[k]
+            target_param.value = target / scales[k]
+            if self.solver_strategy.solve(prob, deadline).solver is None:
+                return None
+            return np.asarray(z.value).ravel()
+
+        # trades of the accounts, as fractions of the total value
+        trades = np.zeros((K, n))
+        X = np.zeros((K, n - 1))
+        zbar, u = np.zeros(n - 1), np.zeros(n - 1)
+        failed = np.zeros(K, dtype=bool)
+        # the solver process is started before the threads, if needed
+        self.solver_strategy.start()
+        deadline = self.solver_strategy.deadline()
+        start = time.time()
+        with ThreadPoolExecutor(self.max_workers) as executor:
+            for i in range(self.max_iters):
+                targets = X - X.mean(axis=0) + zbar - u
+                for k, z in enumerate(executor.map(solve, range(K), targets)):
+                    failed[k] = z is None
+                    # a failed account does not trade, nor add to the aggregate
+                    trades[k] = 0. if failed[k] else z
+                    X[k] = 0. if failed[k] else z[:-1] * scales[k]
+                xbar = X.mean(axis=0)
+                zbar_prev = zbar
+                zbar = self._impact_prox(t, xbar + u, K, total)
+                u = u + xbar - zbar
+                primal = np.sqrt(K) * np.linalg.norm(xbar - zbar)
+                dual = self.rho * np.sqrt(K) * np.linalg.norm(zbar - zbar_prev)
+                if primal < self.eps and dual < self.eps:
+                    break
+            else:
+                logging.warning('ADMM did not converge at %s' % t)
+        self.stats['solver_time'] += time.time() - start
+        self.stats['num_iters'] = i + 1
+
+        if failed.any():
+            logging.error('%d accounts failed. Defaulting to no trades' %
+                          failed.sum())
+        return pd.DataFrame(trades * values[:, np.newaxis],
+                            index=portfolios.index,
+                            columns=portfolios.columns)
 
-            return pd.Series(index=portfolio.index, data=(z.value.A1 * value))  # TODO will have index
-        except cvx.SolverError:
-            logging.error('The solver %s failed. Defaulting to no trades' % self.solver)
-            return self._nulltrade(portfolio)
 
 # class LookaheadModel():
 #     """Returns the planning periods for multi-period.
@@ -250,9 +733,11 @@ class MultiPeriodOpt(SinglePeriodOpt):
 
     def get_trades(self, portfolio, t):
 
+        self._new_stats()
+        start = time.time()
         value = sum(portfolio)
         assert (value > 0.)
-        w = cvx.Constant(portfolio.values/value)
+        w = portfolio.values/value
 
         prob_arr = []
         z_vars = []
@@ -263,7 +748,7 @@ self.trading_times[self.trading_times.index(t):self.trading_times.index(t)+self.
 #        delta_t in [pd.Timedelta('%d days' % i) for i in range(self.lookahead_periods)]:
 
 #            tau = t + delta_t
-            z = cvx.Variable(*w.size)
+            z = cvx.Variable(len(portfolio))
             wplus = w + z
             obj = self.alpha_model.weight_expr_ahead(t, tau, wplus)
 
@@ -274,8 +759,7 @@ self.trading_times[self.trading_times.index(t):self.trading_times.index(t)+self.
                 constr += const_expr
 
             obj -= sum(costs)
-            constr += [cvx.sum_entries(z) == 0]
-            constr += [con.weight_expr(t, wplus, z, value) for con in self.constraints]
+            constr += self.compiler.weight_expr(t, w, z, value)
 
             prob = cvx.Problem(cvx.Maximize(obj), constr)
             prob_arr.append(prob)
@@ -286,5 +770,11 @@ self.trading_times[self.trading_times.index(t):self.trading_times.index(t)+self.
         if self.terminal_weights is not None:
             prob_arr[-1].constraints += [wplus == self.terminal_weights.values]
 
-        sum(prob_arr).solve(solver=self.solver)
-        return pd.Series(index=portfolio.index, data=(z_vars[0].value.A1 * value))
+        prob = sum(prob_arr)
+        self.stats['build_time'] += time.time() - start
+        if not self._solve(prob, self.solver_strategy.deadline()):
+            return self._nulltrade(portfolio)
+        start = time.time()
+        result = pd.Series(index=portfolio.index, data=(z_vars[0].value.A1 * value))
+        self.stats['readback_time'] += time.time() - start
+        return result
@@ -18,7 +18,11 @@ limitations under the License.
 import numpy as np
 import pandas as pd
 import copy
-from .policies import MultiPeriodOpt
+import pickle
+
+from .utils.lazy import lazy_import
+
+sp = lazy_import('scipy.sparse')
 
 
 def getFiscalQuarter(dt):
@@ -29,6 +33,91 @@ def getFiscalQuarter(dt):
     return "Q%i %s" % (quarter, year)
 
 
+class _Log(object):
+    """Entries logged over time, turned into a Series or DataFrame on
+    access. Appending is O(1)."""
+
+    def __init__(self, dtype=None):
+        self.pieces = []
+        self.times = []
+        self.entries = []
+        self.dtype = dtype
+
+    def append(self, t, entry):
+        self.times.append(t)
+        self.entries.append(entry)
+
+    def extend(self, block):
+        self._flush()
+        self.pieces.append(block)
+
+    def _flush(self):
+        if self.times:
+            piece = (pd.Series if np.isscalar(self.entries[0]) else
+                     pd.DataFrame)(index=self.times, data=self.entries)
+            if self.dtype is not None:
+                piece = piece.astype(self.dtype, copy=False)
+            self.pieces.append(piece)
+            self.times, self.entries = [], []
+
+    def frame(self):
+        self._flush()
+        if len(self.pieces) > 1:
+            self.pieces = [pd.concat(self.pieces)]
+        return self.pieces[0]
+
+
+class _SparseLog(_Log):
+    """A _Log of rows that are mostly zero, e.g. trades, kept as a CSR
+    matrix with a row by time. Only the nonzero entries of each row
+    appended are kept."""
+
+    def __init__(self, dtype=None):
+        super().__init__(dtype)
+        self.columns = None
+
+    def append(self, t, entry):
+        if self.columns is None:
+            self.columns = entry.index
+        values = np.asarray(entry, dtype=self.dtype)
+        nonzero = np.flatnonzero(values)
+        self.times.append(t)
+        self.entries.append((nonzero, values[nonzero]))
+
+    def extend(self, block):
+        self._flush()
+        if self.columns is None:
+            self.columns = block.columns
+        self.pieces.append((block.index, sp.csr_matrix(
+            np.asarray(block.values, dtype=self.dtype))))
+
+    def _flush(self):
+        if self.times:
+            indptr = np.cumsum([0] + [len(nonzero) for nonzero, _ in
+                                      self.entries])
+            matrix = sp.csr_matrix(
+                (np.concatenate([values for _, values in self.entries]),
+                 np.concatenate([nonzero for nonzero, _ in self.entries]),
+                 indptr), shape=(len(self.times), len(self.columns)))
+            self.pieces.append((pd.Index(self.times), matrix))
+            self.times, self.entries = [], []
+
+    def matrix(self):
+        """The times, and the CSR matrix of the rows."""
+        self._flush()
+        if len(self.pieces) > 1:
+            self.pieces = [(self.pieces[0][0].append(
+                [times for times, _ in self.pieces[1:]]),
+                sp.vstack([matrix for _, matrix in self.pieces],
+                          format='csr'))]
+        return self.pieces[0]
+
+    def frame(self):
+        times, matrix = self.matrix()
+        return pd.DataFrame(index=times, data=matrix.toarray(),
+                            columns=self.columns)
+
+
 class SimulationResult():
     """A container for the result of a simulation.
 
@@ -39,7 +128,8 @@ class SimulationResult():
         borrow_costs: A series of borrow costs over time.
     """
     def __init__(self, initial_portfolio, policy, cash_key, simulator,
-                simulation_times=None, PPY=252, timedelta=pd.Timedelta("1 days")):
+                simulation_times=None, PPY=252, timedelta=pd.Timedelta("1 days"),
+                log_every=1, sparse=True):
         """
         Initialize the result object.
 
@@ -48,43 +138,267 @@ class SimulationResult():
             policy:
             simulator:
             simulation_times:
-            PPY:
+            PPY: periods per year, e.g. bars per year for intraday data.
+            timedelta: length of a period, to time the final holdings.
+            log_every: if larger than 1 the logs are kept one step every
+                log_every, except the values and risk-free returns.
+            sparse: if True the trades and the per-asset simulator cost
+                logs are kept as sparse matrices, and turned into
+                DataFrames at each access.
         """
         self.PPY = PPY
         self.timedelta = timedelta
+        self.log_every = log_every
+        self.sparse = sparse
+        self._step = 0
+        self._logs = {}
         self.initial_val = sum(initial_portfolio)
         self.initial_portfolio = copy.copy(initial_portfolio)
         self.cash_key = cash_key
         self.simulator = simulator
         self.policy = policy
+        # of the logged holdings, trades and costs, see MarketSimulator
+        self.dtype = getattr(simulator, 'dtype', np.dtype(np.float64))
+        # the values are logged, in float64, if the holdings are not all
+        self._log_values = log_every > 1 or self.dtype != np.float64
+        # holdings before the current step, logged if log_every > 1
+        self._h_prev = self.initial_portfolio
+        # policy state before trading at each time, for what_if
+        self.policy_states = {}
+        self._log_names = []
+
+
+    def _log(self, name, dtype=None, sparse=False):
+        if name not in self._logs:
+            self._logs[name] = (_SparseLog if sparse else _Log)(dtype)
+            self._log_names.append(name)
+        self.__dict__.pop(name, None)  # materialized again on access
+        return self._logs[name]
+
+
+    def _is_sparse(self, name, ndim):
+        """Whether the log name, of rows of ndim dimensions, is sparse."""
+        return self.sparse and ndim == 1 and \
+            (name == 'u' or name.startswith('simulator_'))
+
+
+    def log_data(self, name, t, entry, dtype=None):
+        self._log(name, dtype,
+                  self._is_sparse(name, np.ndim(entry))).append(t, entry)
+
+
+    def log_block(self, name, block, dtype=None):
+        """Logs the rows of a Series or DataFrame indexed by time."""
+        self._log(name, dtype,
+                  self._is_sparse(name, block.ndim - 1)).extend(block)
+
+
+    def _sparse_log(self, name):
+        """The times and CSR matrix of the log name, if it is sparse."""
+        log = self.__dict__.get('_logs', {}).get(name)
+        return log.matrix() if isinstance(log, _SparseLog) else None
+
+
+    @property
+    def _logging(self):
+        """Whether the current step is logged in full."""
+        return self._step % self.log_every == 0
+
+
+    def _logged_rows(self, num_steps):
+        """The rows of a block of num_steps steps that are logged in full."""
+        return (self._step + np.arange(num_steps)) % self.log_every == 0
+
+
+    def log_state(self, t, state):
+        if state and self._logging:
+            self.policy_states[t] = state
+
 
+    def log_policy_block(self, times, state):
+        """Logs the steps at times, where the policy was not called."""
+        keep = self._logged_rows(len(times))
+        if state:
+            for t in times[keep]:
+                self.policy_states[t] = state
+        self.log_block("policy_time", pd.Series(index=times[keep], data=0.))
 
-    def log_data(self, name, t, entry):
-        try:
-            getattr(self, name).loc[t] = entry
-        except AttributeError:
-            setattr(self, name, \
-                    (pd.Series if np.isscalar(entry) else
-                    pd.DataFrame)(index=[t],data=[entry]))
+
+    def snapshot(self, t):
+        """The holdings and policy state before trading at simulated time t.
+        """
+        if getattr(self, 'fork_time', None) is not None and t < self.fork_time:
+            return self.prefix.snapshot(t)
+        assert self.log_every == 1, 'snapshots need the full logs'
+        idx = self.h_next.index.get_loc(t)
+        h = self.initial_portfolio if idx == 0 else self.h_next.iloc[idx - 1]
+        return copy.copy(h), copy.deepcopy(self.policy_states.get(t, {}))
+
+
+    def fork(self, prefix, time):
+        """Stitches this result, simulated from time on, onto prefix.
+
+        The logs of prefix before time are shared with it, not copied.
+        """
+        self.prefix = prefix
+        self.fork_time = time
+        self.initial_portfolio = prefix.initial_portfolio
+        self.initial_val = prefix.initial_val
+        self._suffix = {name: self._logs.pop(name).frame()
+                        for name in self._log_names}
+        for name in self._log_names:
+            self.__dict__.pop(name, None)
+
+
+    def flatten(self):
+        """Copies the logs and states of the prefix of a forked result, so
+        that it no longer refers to it, e.g. to save it on its own."""
+        if getattr(self, 'fork_time', None) is None:
+            return
+        frames = {name: getattr(self, name) for name in self._log_names}
+        for name, frame in frames.items():
+            self._logs[name] = (_SparseLog if self._is_sparse(name, frame.ndim - 1)
+                                else _Log)(self.dtype)
+            self._logs[name].extend(frame)
+            self.__dict__.pop(name, None)
+        states = {t: state for t, state in self.prefix.policy_states.items()
+                  if t < self.fork_time}
+        states.update(self.policy_states)
+        self.policy_states = states
+        del self.prefix, self._suffix
+        self.fork_time = None
+
+
+    def __getattr__(self, name):
+        logs = self.__dict__.get('_logs')
+        if logs is not None and name in logs:
+            if isinstance(logs[name], _SparseLog):
+                return logs[name].frame()  # not kept dense
+            self.__dict__[name] = logs[name].frame()
+            return self.__dict__[name]
+        suffix = self.__dict__.get('_suffix')
+        if suffix is None or name not in suffix:
+            raise AttributeError(name)
+        head = getattr(self.prefix, name)
+        head = head.iloc[:head.index.searchsorted(self.fork_time)]
+        self.__dict__[name] = pd.concat([head, suffix[name]])
+        return self.__dict__[name]
+
+
+    def save(self, path):
+        """Pickles the result, without the simulator, to path."""
+        state = dict(self.__dict__)
+        state['simulator'] = None
+        with open(path, 'wb') as f:
+            pickle.dump(state, f)
+
+
+    @staticmethod
+    def load(path):
+        """Loads a result saved with save."""
+        with open(path, 'rb') as f:
+            state = pickle.load(f)
+        result = SimulationResult.__new__(SimulationResult)
+        result.__dict__.update(state)
+        return result
 
 
     def log_policy(self, t, exec_time):
+        from .policies import MultiPeriodOpt
+        if not self._logging:
+            return
         self.log_data("policy_time", t, exec_time)
+        if getattr(self.policy, 'stats', None):
+            self.log_data("policy_stats", t, pd.Series(self.policy.stats))
         ## TODO mpo policy requires changes in the optimization_log methods
         if not isinstance(self.policy, MultiPeriodOpt):
+            # on a SolutionCache hit nothing was built at t
+            hit = getattr(self.policy, 'stats', {}).get('cache_hit') is True
             for cost in self.policy.costs:
+                try:
+                    entry = cost.optimization_log(t)
+                except AttributeError:  # never built
+                    entry = np.nan
                 self.log_data("policy_"+cost.__class__.__name__,
-                              t, cost.optimization_log(t))
+                              t, entry * np.nan if hit else entry)
 
 
     def log_simulation(self, t, u, h_next, risk_free_return, exec_time):
-        self.log_data("simulation_time", t, exec_time)
-        self.log_data("u", t, u)
-        self.log_data("h_next", t, h_next)
         self.log_data("risk_free_returns", t, risk_free_return)
-        for cost in self.simulator.costs:
-            self.log_data("simulator_"+cost.__class__.__name__,
-                          t, cost.simulation_log(t))
+        if self._log_values:
+            self.log_data("v_next", t, sum(h_next))
+        if self._logging:
+            self.log_data("simulation_time", t, exec_time)
+            self.log_data("u", t, u.astype(self.dtype, copy=False),
+                          self.dtype)
+            self.log_data("h_next", t, h_next.astype(self.dtype, copy=False),
+                          self.dtype)
+            if self.log_every > 1:
+                self.log_data("h_pretrade", t,
+                              self._h_prev.astype(self.dtype, copy=False),
+                              self.dtype)
+            for cost in self.simulator.costs:
+                self.log_data("simulator_"+cost.__class__.__name__,
+                              t, cost.simulation_log(t), self.dtype)
+        self._h_prev = h_next
+        self._step += 1
+
+
+    def log_simulation_block(self, u, h_next, risk_free_returns, exec_time,
+                             costs):
+        """Logs the steps of a block, as log_simulation does one by one.
+
+        Args:
+            u, h_next: DataFrames indexed by the times of the block.
+            risk_free_returns: Series indexed by the times.
+            exec_time: simulation time of each step.
+            costs: dict of the simulator cost logs, by cost class name.
+        """
+        keep = self._logged_rows(len(u))
+        self.log_block("risk_free_returns", risk_free_returns)
+        if self._log_values:
+            self.log_block("v_next", h_next.sum(axis=1))
+        self.log_block("simulation_time",
+                       pd.Series(index=u.index[keep], data=exec_time))
+        self.log_block("u", u[keep].astype(self.dtype, copy=False))
+        self.log_block("h_next", h_next[keep].astype(self.dtype, copy=False))
+        if self.log_every > 1:
+            h_pretrade = h_next.shift(1)
+            h_pretrade.iloc[0] = self._h_prev
+            self.log_block("h_pretrade",
+                           h_pretrade[keep].astype(self.dtype, copy=False))
+        self._h_prev = h_next.iloc[-1]
+        for name, block in costs.items():
+            self.log_block("simulator_"+name,
+                           block[keep].astype(self.dtype, copy=False))
+        self._step += len(u)
+
+
+    @property
+    def policy_profile(self):
+        """Summary of the time spent in each phase of the policy.
+
+        The phases are expression building, cvxpy canonicalization, solver
+        setup, solver, transfer to and from the solver process, reading back
+        the solution, and the rest of the policy time. The solver statuses
+        and iterations are in policy_stats.
+        """
+        phases = ['build_time', 'canon_time', 'setup_time', 'solver_time',
+                  'transfer_time', 'readback_time']
+        times = self.policy_stats[phases].apply(pd.to_numeric)
+        times['other_time'] = self.policy_time - times.sum(axis=1)
+        return pd.DataFrame({'total': times.sum(),
+                             'mean': times.mean(),
+                             'median': times.median(),
+                             'max': times.max(),
+                             'fraction': times.sum() / self.policy_time.sum()},
+                            columns=['total', 'mean', 'median', 'max', 'fraction'])
+
+
+    @property
+    def cache_hit_rate(self):
+        """Fraction of the policy calls answered by its SolutionCache."""
+        return self.policy_stats.cache_hit.astype(float).mean()
 
 
     @property
@@ -93,7 +407,11 @@ class SimulationResult():
         Concatenate initial portfolio and h_next dataframe.
 
         Infers the timestamp of last element by increasing the final timestamp.
+        If log_every is larger than 1 these are the holdings before trading
+        at the logged steps only.
         """
+        if self.log_every > 1:
+            return self.h_pretrade
         tmp=self.h_next.shift(1)
         tmp.ix[0]=self.initial_portfolio
         tmp.loc[self.h_next.index[-1] + self.timedelta] = self.h_next.ix[-1]
@@ -103,8 +421,16 @@ class SimulationResult():
     @property
     def v(self):
         """The value of the portfolio over time.
+
+        At every step, also when the holdings are logged one step every
+        log_every.
         """
-        return self.h.sum(axis=1)
+        if not self._log_values:
+            return self.h.sum(axis=1)
+        tmp = self.v_next.shift(1)
+        tmp.iloc[0] = self.initial_val
+        tmp.loc[self.v_next.index[-1] + self.timedelta] = self.v_next.iloc[-1]
+        return tmp
 
 
     @property
@@ -116,7 +442,8 @@ class SimulationResult():
     @property
     def w(self):
         """The weights of the portfolio over time."""
-        return (self.h.T / self.v).T
+        h = self.h
+        return (h.T / self.v.loc[h.index]).T
 
 
     @property
@@ -204,8 +531,34 @@ class SimulationResult():
     def turnover(self):
         """Turnover ||u_t||_1/v_t
         """
-        noncash_trades = self.u.drop(self.cash_key, axis=1)
-        return np.abs(noncash_trades).sum(axis=1)/self.v
+        sparse = self._sparse_log('u')
+        if sparse is None:
+            noncash_trades = self.u.drop(self.cash_key, axis=1)
+            return np.abs(noncash_trades).sum(axis=1)/self.v
+        times, trades = sparse
+        noncash = np.flatnonzero(self._logs['u'].columns != self.cash_key)
+        return pd.Series(index=times, data=np.asarray(
+            abs(trades[:, noncash]).astype(float).sum(axis=1)).ravel())/self.v
+
+
+    @property
+    def cost_totals(self):
+        """The total of each simulator cost at each step, a column by
+        cost class name."""
+        totals = {}
+        for name in self._log_names:
+            if not name.startswith('simulator_'):
+                continue
+            sparse = self._sparse_log(name)
+            if sparse is None:
+                log = getattr(self, name)
+                total = log if log.ndim == 1 else log.sum(axis=1)
+            else:
+                times, costs = sparse
+                total = pd.Series(index=times, data=np.asarray(
+                    costs.astype(float).sum(axis=1)).ravel())
+            totals[name[len('simulator_'):]] = total
+        return pd.DataFrame(totals)
 
 
     @property
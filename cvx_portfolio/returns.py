@@ -15,14 +15,25 @@ limitations under the License.
 """
 
 
-import cvxpy as cvx
+import numpy as np
 import pandas as pd
-from cvx_portfolio.expression import Expression
+from cvx_portfolio.expression import Expression, periods_between
+from cvx_portfolio.utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
 __all__ = ['AlphaSource', 'MPOAlphaSource', 'AlphaStream']
 
 
 class BaseAlphaModel(Expression):
-    pass
+
+    def support(self, t):
+        """Boolean array of the assets with non-zero alpha at time t,
+        or None if not known."""
+        return None
+
+    def weight_gradient(self, t, wplus):
+        """Gradient of weight_expr at numeric wplus."""
+        raise NotImplementedError
 
 
 class AlphaSource(BaseAlphaModel):
@@ -32,15 +43,18 @@ class AlphaSource(BaseAlphaModel):
       alpha_data: A dataframe of return estimates.
       delta_data: A confidence interval around the estimates.
       half_life: Number of days for alpha auto-correlation to halve.
+      period: Length of the periods of the decay, or the bar times.
     """
 
-    def __init__(self, alpha_data, delta_data=None, gamma_decay=None, name=None):
+    def __init__(self, alpha_data, delta_data=None, gamma_decay=None, name=None,
+                 period=pd.Timedelta("1 days")):
         self.alpha_data = alpha_data
         # TODO input check goes here
         assert (not self.alpha_data.isnull().values.any())
         self.delta_data = delta_data
         self.gamma_decay = gamma_decay
         self.name = name
+        self.period = period
 
     def weight_expr(self, t, wplus, z=None, v=None):
         """Returns the estimated alpha.
@@ -60,6 +74,24 @@ class AlphaSource(BaseAlphaModel):
             alpha -= self.delta_data.loc[t].values.T*cvx.abs(wplus)
         return alpha
 
+    def weight_expr_active(self, t, wplus, z, v, active, w):
+        alpha_vec = self.alpha_data.loc[t].values
+        alpha = alpha_vec[active].T*wplus + alpha_vec[~active].dot(w[~active])
+        if self.delta_data is not None:
+            delta = self.delta_data.loc[t].values
+            alpha -= delta[active].T*cvx.abs(wplus) + \
+                delta[~active].dot(np.abs(w[~active]))
+        return alpha
+
+    def support(self, t):
+        return self.alpha_data.loc[t].values != 0
+
+    def weight_gradient(self, t, wplus):
+        grad = self.alpha_data.loc[t].values.astype(float)
+        if self.delta_data is not None:
+            grad = grad - self.delta_data.loc[t].values * np.sign(wplus)
+        return grad
+
     def weight_expr_ahead(self, t, tau, wplus):
         """Returns the estimate at time t of alpha at time tau.
 
@@ -78,7 +110,7 @@ class AlphaSource(BaseAlphaModel):
         #     tau_end = tau + pd.Timedelta('1 days')
         alpha = self.weight_expr(t, wplus)
         if tau > t  and self.gamma_decay is not None:
-            alpha *= (tau-t).days**(-self.gamma_decay)
+            alpha *= periods_between(t, tau, self.period)**(-self.gamma_decay)
             # decay_init = 2**(-(tau_start - t).days/self.half_life)
             # K = (tau_end - tau_start).days ## in all our calls K = 1 because tau is not a tuple
             # decay_factor = 2**(-1/self.half_life)
@@ -121,6 +153,17 @@ class AlphaStream(BaseAlphaModel):
         self.alpha_sources = alpha_sources
         self.weights = weights
 
+    def support(self, t):
+        result = False
+        for idx, source in enumerate(self.alpha_sources):
+            if self.weights[idx] == 0:
+                continue
+            support = source.support(t)
+            if support is None:
+                return None
+            result = result | support
+        return None if result is False else result
+
     def weight_expr(self, t, wplus, z=None, v=None):
         """Returns the estimated alpha.
 
@@ -137,6 +180,17 @@ class AlphaStream(BaseAlphaModel):
             alpha += source.weight_expr(t, wplus) * self.weights[idx]
         return alpha
 
+    def weight_expr_active(self, t, wplus, z, v, active, w):
+        alpha = 0
+        for idx, source in enumerate(self.alpha_sources):
+            alpha += source.weight_expr_active(t, wplus, z, v, active, w) * \
+                self.weights[idx]
+        return alpha
+
+    def weight_gradient(self, t, wplus):
+        return sum(source.weight_gradient(t, wplus) * self.weights[idx]
+                   for idx, source in enumerate(self.alpha_sources))
+
     def weight_expr_ahead(self, t, tau, wplus):
         """Returns the estimate at time t of alpha at time tau.
 
@@ -16,11 +16,14 @@ limitations under the License.
 
 from abc import abstractmethod
 
-import cvxpy as cvx
 import numpy as np
 import pandas as pd
 
 from .costs import BaseCost
+from .expression import periods_between, embed_active
+from .utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
 
 __all__ = ['FullSigma', 'EmpSigma', 'SqrtSigma', 'WorstCaseRisk',
             'RobustFactorModelSigma', 'RobustSigma',  'FactorModelSigma']  ## TODO fix redundancies here
@@ -40,22 +43,47 @@ class BaseRiskModel(BaseCost):
         self.w_bench = kwargs.pop('w_bench', 0.)
         super().__init__()
         self.gamma_half_life = kwargs.pop('gamma_half_life', np.inf)
+        # the half life is in periods, see periods_between
+        self.period = kwargs.pop('period', pd.Timedelta("1 days"))
 
     def weight_expr(self, t, w_plus, z, value):
         self.expression = self._estimate(t, w_plus - self.w_bench, z, value)
         return self.gamma * self.expression, []
 
+    def weight_expr_active(self, t, w_plus, z, value, active, w):
+        w_bench = np.asarray(self.w_bench)
+        w_plus = w_plus - (w_bench[active] if w_bench.ndim else w_bench)
+        self.expression = self._estimate_active(t, w_plus, z, value, active,
+                                                (w - w_bench)[~active])
+        return self.gamma * self.expression, []
+
+    def _estimate_active(self, t, w_plus, z, value, active, w_fixed):
+        """_estimate over the active assets, w_fixed are the weights of
+        the others."""
+        w = np.zeros(len(active))
+        w[~active] = w_fixed
+        w_plus, z = embed_active(w_plus, z, active, w)
+        return self._estimate(t, w_plus, z, value)
+
     @abstractmethod
     def _estimate(self, t, w_plus, z, value):
         pass
 
+    def weight_gradient(self, t, w_plus, z, value):
+        return super().weight_gradient(t, w_plus - self.w_bench, z, value)
+
+    def _gradient(self, t, w_plus, z, value):
+        # the models with a Hessian are quadratic
+        H_wplus, _ = self._hessian(t, w_plus, z, value)
+        return H_wplus.dot(w_plus), np.zeros(len(w_plus))
+
     def weight_expr_ahead(self, t, tau, w_plus, z, value):
         """Estimate risk model at time tau in the future, while t is present."""
         if self.gamma_half_life == np.inf:
             gamma_multiplier = 1.
         else:
             decay_factor = 2**(-1/self.gamma_half_life)
-            gamma_init = decay_factor**((tau - t).days)  # TODO not dependent on days
+            gamma_init = decay_factor**periods_between(t, tau, self.period)
             gamma_multiplier = gamma_init*(1 - decay_factor)/(1 - decay_factor)
 
         return gamma_multiplier * self.weight_expr(t, w_plus, z, value)[0], []
@@ -84,6 +112,19 @@ class FullSigma(BaseRiskModel):
             self.expression = cvx.quad_form(wplus, locator(self.Sigma.values, t))
         return self.expression
 
+    def _estimate_active(self, t, wplus, z, value, active, w_fixed):
+        Sigma = np.asarray(locator(self.Sigma, t))
+        fixed = ~active
+        cross = Sigma[np.ix_(active, fixed)] + Sigma[np.ix_(fixed, active)].T
+        self.expression = cvx.quad_form(wplus, Sigma[np.ix_(active, active)]) + \
+            cross.dot(w_fixed).T*wplus + \
+            w_fixed.dot(Sigma[np.ix_(fixed, fixed)]).dot(w_fixed)
+        return self.expression
+
+    def _hessian(self, t, wplus, z, value):
+        Sigma = np.asarray(locator(self.Sigma, t))
+        return Sigma + Sigma.T, np.zeros(Sigma.shape)
+
 
 class EmpSigma(BaseRiskModel):
     """Empirical Sigma matrix, built looking at *lookback* past returns."""
@@ -94,6 +135,10 @@ class EmpSigma(BaseRiskModel):
         assert(not np.any(pd.isnull(returns)))
         super(EmpSigma, self).__init__(**kwargs)
 
+    @property
+    def lookback_periods(self):
+        return self.lookback + 1
+
     def _estimate(self, t, wplus, z, value):
         idx = self.returns.index.get_loc(t)
         R = self.returns.iloc[max(idx-1-self.lookback,0):idx-1]  # TODO make sure pandas + cvxpy works
@@ -101,6 +146,19 @@ class EmpSigma(BaseRiskModel):
         self.expression = cvx.sum_squares(R.values*wplus)/self.lookback
         return self.expression
 
+    def _estimate_active(self, t, wplus, z, value, active, w_fixed):
+        idx = self.returns.index.get_loc(t)
+        R = self.returns.iloc[max(idx-1-self.lookback,0):idx-1].values
+        assert (R.shape[0] > 0)
+        self.expression = cvx.sum_squares(R[:, active]*wplus +
+                                          R[:, ~active].dot(w_fixed))/self.lookback
+        return self.expression
+
+    def _hessian(self, t, wplus, z, value):
+        idx = self.returns.index.get_loc(t)
+        R = self.returns.iloc[max(idx-1-self.lookback,0):idx-1].values
+        return 2 * R.T.dot(R) / self.lookback, np.zeros((R.shape[1],) * 2)
+
 
 class SqrtSigma(BaseRiskModel):
     def __init__(self, sigma_sqrt, **kwargs):
@@ -114,6 +172,16 @@ class SqrtSigma(BaseRiskModel):
         self.expression = cvx.sum_squares(self.sigma_sqrt.values @ wplus)
         return self.expression
 
+    def _estimate_active(self, t, wplus, z, value, active, w_fixed):
+        S = self.sigma_sqrt.values
+        self.expression = cvx.sum_squares(S[:, active] @ wplus +
+                                          S[:, ~active].dot(w_fixed))
+        return self.expression
+
+    def _hessian(self, t, wplus, z, value):
+        S = self.sigma_sqrt.values
+        return 2 * S.T.dot(S), np.zeros((S.shape[1],) * 2)
+
 
 class FactorModelSigma(BaseRiskModel):
     def __init__(self, exposures, factor_Sigma, idiosync, **kwargs):
@@ -133,6 +201,21 @@ class FactorModelSigma(BaseRiskModel):
                                                  locator(self.factor_Sigma, t).values)
         return self.expression
 
+    def _estimate_active(self, t, wplus, z, value, active, w_fixed):
+        F = locator(self.exposures, t).values
+        D = locator(self.idiosync, t).values
+        self.expression = cvx.sum_squares(cvx.mul_elemwise(np.sqrt(D[active]), wplus)) + \
+            D[~active].dot(w_fixed**2) + \
+            cvx.quad_form(F[:, active] @ wplus + F[:, ~active].dot(w_fixed),
+                          locator(self.factor_Sigma, t).values)
+        return self.expression
+
+    def _hessian(self, t, wplus, z, value):
+        F = locator(self.exposures, t).values
+        H = np.diag(locator(self.idiosync, t).values) + \
+            F.T.dot(locator(self.factor_Sigma, t).values).dot(F)
+        return 2 * H, np.zeros(H.shape)
+
 
 class RobustSigma(BaseRiskModel):
     """Implements covariance forecast error risk."""
@@ -0,0 +1,113 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import numpy as np
+import pandas as pd
+
+from .risks import locator
+
+__all__ = ['BlockBootstrap', 'FactorScenarios', 'ScenarioMetrics']
+
+
+class BlockBootstrap(object):
+    """Return paths made of blocks of consecutive historical returns.
+
+    Attributes:
+      returns: A dataframe of historical returns, cash included.
+      block_length: Number of periods of each block.
+    """
+
+    def __init__(self, returns, block_length=20):
+        assert (block_length <= len(returns))
+        self.returns = returns
+        self.block_length = block_length
+
+    def paths(self, times, num_scenarios, random_state):
+        """Yields the (num_scenarios, n) returns at each of times."""
+        data = self.returns.values
+        for i, t in enumerate(times):
+            offset = i % self.block_length
+            if offset == 0:
+                starts = random_state.randint(
+                    0, len(data) - self.block_length + 1, size=num_scenarios)
+            yield data[starts + offset]
+
+
+class FactorScenarios(object):
+    """Returns drawn from a factor model, as in FactorModelSigma.
+
+    Attributes:
+      exposures: k x n exposures, or a pd.Series/Panel of them over time.
+      factor_Sigma: k x k factor covariance, or over time.
+      idiosync: n vector of idiosyncratic variances, or over time.
+      mean: n vector of mean returns, or a dataframe over time.
+    """
+
+    def __init__(self, exposures, factor_Sigma, idiosync, mean=0.):
+        self.exposures = exposures
+        self.factor_Sigma = factor_Sigma
+        self.idiosync = idiosync
+        self.mean = mean
+
+    def paths(self, times, num_scenarios, random_state):
+        """Yields the (num_scenarios, n) returns at each of times."""
+        for t in times:
+            F = np.asarray(locator(self.exposures, t))
+            Sigma_F = np.asarray(locator(self.factor_Sigma, t))
+            D = np.asarray(locator(self.idiosync, t))
+            factors = random_state.multivariate_normal(
+                np.zeros(len(Sigma_F)), Sigma_F, size=num_scenarios)
+            noise = random_state.standard_normal((num_scenarios, len(D)))
+            yield np.asarray(locator(self.mean, t)) + factors.dot(F) + \
+                noise * np.sqrt(D)
+
+
+class ScenarioMetrics(object):
+    """Running metrics of a batch of scenarios, in O(S) memory.
+
+    The excess returns are accumulated with Welford's algorithm.
+    """
+
+    def __init__(self, initial_values, PPY=252):
+        self.PPY = PPY
+        self.value = np.array(initial_values, dtype=float)
+        self.peak = self.value.copy()
+        self.max_drawdown = np.zeros(len(self.value))
+        self.count = 0
+        self.mean = np.zeros(len(self.value))
+        self.m2 = np.zeros(len(self.value))
+
+    def update(self, values, risk_free_returns):
+        excess = values / self.value - 1 - risk_free_returns
+        self.count += 1
+        delta = excess - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (excess - self.mean)
+        self.value = values
+        self.peak = np.maximum(self.peak, values)
+        self.max_drawdown = np.maximum(self.max_drawdown,
+                                       100 * (self.peak - values) / self.peak)
+
+    @property
+    def sharpe_ratio(self):
+        return np.sqrt(self.PPY) * self.mean / np.sqrt(self.m2 / self.count)
+
+    def summary(self):
+        return pd.DataFrame({'sharpe_ratio': self.sharpe_ratio,
+                             'max_drawdown': self.max_drawdown,
+                             'final_value': self.value},
+                            columns=['sharpe_ratio', 'max_drawdown',
+                                     'final_value'])
@@ -16,36 +16,87 @@ limitations under the License.
 
 import copy
 import logging
+import os
 import time
+from collections import OrderedDict
 
-import multiprocess
 import numpy as np
 import pandas as pd
-import cvxpy as cvx
 
 from .returns import AlphaStream
 
 from .result import SimulationResult
 from .costs import BaseCost
+from .scenarios import ScenarioMetrics
+from .cache import step_fingerprints
+from .kernels import rows
+from .executors import EXECUTORS, isolate
+from .window import data_window, restrict
+from . import kernels
+from .utils.lazy import lazy_import
+
+# only loaded when solving or running in parallel
+cvx = lazy_import('cvxpy')
+multiprocess = lazy_import('multiprocess')
 
 # TODO update benchmark weights (?)
-# Also could try jitting with numba.
 
 class MarketSimulator():
     logger = None
 
-    def __init__(self, market_returns, market_volumes, costs, cash_key='cash'):
-        """Initialize market simulator with market returns object and cost objects."""
+    def __init__(self, market_returns, market_volumes, costs, cash_key='cash',
+                 PPY=252, timedelta=pd.Timedelta("1 days"), dtype=np.float64):
+        """Initialize market simulator with market returns object and cost objects.
+
+        PPY is the number of periods per year and timedelta the length of
+        a period, e.g. 252*390 and one minute for minute bars.
+
+        dtype is that of the market data and cost kernels, and of the
+        holdings, trades and costs logged in the results. With np.float32
+        the simulator keeps converted copies of the returns, volumes and
+        cost data, and refers to none of the float64 frames it was given:
+        its memory, and that of the logs, is halved once the caller drops
+        those. The holdings carried between the steps, the
+        cash and the values are kept in float64, so the relative error
+        of the values is at most about 2**-24 times the sum over the steps
+        of the largest absolute return plus the costs relative to the
+        value, e.g. 1.5e-5 for 5000 steps with returns up to 5%.
+        """
+        self.dtype = np.dtype(dtype)
         self.market_returns = market_returns
         self.market_volumes = market_volumes[market_volumes.columns.difference([cash_key])]
+        if self.dtype != np.float64:
+            self.market_returns = market_returns.astype(self.dtype)
+            self.market_volumes = self.market_volumes.astype(self.dtype)
         #assert (isinstance(self.market_returns, MarketReturns))
 
-        self.costs = costs
-        for cost in self.costs:
+        for cost in costs:
             assert (isinstance(cost, BaseCost))
+        self.costs = costs if self.dtype == np.float64 else \
+            [cost.astype(self.dtype) for cost in costs]
+        # the kernels of the costs take the assets in the order of the returns
+        self.costs = [cost.reindex(self.market_returns.columns[:-1])
+                      for cost in self.costs]
 
         self.cash_key = cash_key
-
+        self.PPY = PPY
+        self.timedelta = timedelta
+        self._cache_data()
+
+    def _cache_data(self):
+        # arrays of the kernels, columns as market_returns
+        self._returns_values = np.asarray(self.market_returns.values,
+                                          dtype=self.dtype)
+        null_trades = (self.market_volumes == 0).reindex(
+            columns=self.market_returns.columns, fill_value=False)
+        self._null_times = null_trades.index
+        self._null_trades = null_trades.values
+
+    def _simulation_times(self, start_time, end_time):
+        """The times of the market data from start_time to end_time."""
+        index = self.market_returns.index
+        return index[index.searchsorted(start_time):
+                     index.searchsorted(end_time, side='right')]
 
     def propagate(self, h, u, t):
         """Propagates the portfolio forward over time period t, given trades u.
@@ -60,100 +111,636 @@ class MarketSimulator():
             u: trades vector with simulated cash balance
         """
         assert (u.index.equals(h.index))
+        columns = self.market_returns.columns
+        if not h.index.equals(columns):
+            assert (h.index.sort_values().equals(columns.sort_values()))
+            h, u = h[columns], u[columns]
+        returns = rows(self._returns_values, self.market_returns.index, t)
+        H_next, U = self.propagate_batch(h.values[np.newaxis],
+                                         u.values[np.newaxis], t,
+                                         returns[np.newaxis])
+        assert (not np.isnan(H_next).any())
+        return pd.Series(H_next[0], index=columns), pd.Series(U[0], index=columns)
+
+    def propagate_batch(self, H, U, t, returns, shared=False):
+        """Propagates a batch of portfolios over time period t.
+
+        Args:
+            H: (S, n) array of holdings, columns as market_returns
+            U: (S, n) array of trades, the cash column is ignored
+            t: current time
+            returns: (S, n) array of the returns over period t
+            shared: if True the portfolios trade in the same market, and
+                the costs are their value_expr_shared
+
+        Returns:
+            H_next: holdings after returns propagation
+            U: trades with simulated cash balance
+        """
+        columns = self.market_returns.columns
+        assert (columns[-1] == self.cash_key)
+        U = np.array(U, dtype=float)
         # don't trade if volume is null
-        null_trades=self.market_volumes.columns[self.market_volumes.loc[t]==0]
-        if len(null_trades):
+        null_trades = rows(self._null_trades, self._null_times, t)
+        if null_trades.any():
             logging.info('Setting stocks %s on %s to null trades (because market volumes are 0)'%\
-                            (null_trades, t))
-            u.loc[null_trades] = 0.
-        hplus = h + u
-        costs = [cost.value_expr(t, h_plus=hplus, u=u) for cost in self.costs]
-        for cost in costs:
-            assert(not pd.isnull(cost))
-            assert(not np.isinf(cost))
-
-        u[self.cash_key] = - sum(u[u.index != self.cash_key]) - sum(costs)
-        hplus[self.cash_key] = h[self.cash_key] + u[self.cash_key]
+                            (columns[null_trades], t))
+            U[:, null_trades] = 0.
+        U[:, -1] = 0.
+        # the costs in dtype, the holdings and cash in float64
+        H_plus = (H + U).astype(self.dtype, copy=False)
+        U_costs = U.astype(self.dtype, copy=False)
+        if shared:
+            costs = sum(cost.value_expr_shared(t, H_plus, U_costs)
+                        for cost in self.costs)
+        else:
+            costs = sum(cost.value_expr_batch(t, H_plus, U_costs)
+                        for cost in self.costs)
+        assert (np.isfinite(costs).all())
+        return kernels.propagate(np.asarray(H, dtype=float), U,
+                                 np.asarray(returns, dtype=float),
+                                 np.zeros(len(U)) + costs)
 
-        assert (hplus.index.sort_values().equals(self.market_returns.columns.sort_values()))
-        h_next =  self.market_returns.loc[t] * hplus + hplus
-        #h_next = self.market_returns.value_expr(t, hplus)
+    def _compound_arrays(self, h, times):
+        """Propagates h with null trades over times, in one vectorized step.
 
-        assert (not h_next.isnull().values.any())
-        assert (not u.isnull().values.any())
-        return h_next, u
+        Returns:
+            H: (len(times) + 1, n) array of the holdings, starting with h
+            U: trades, the cash being the costs
+            risk_free_returns: array of the cash returns
+            costs: dict of the simulator cost logs, by cost class name
+        """
+        # compounded in float64, as the holdings carried between the steps
+        returns = np.asarray(self.market_returns.loc[times, h.index].values,
+                             dtype=float)
+        H = np.zeros((len(times) + 1, len(h)))
+        H[0] = h.values
+        H[1:, :-1] = h.values[:-1] * np.cumprod(1 + returns[:, :-1], axis=0)
+        U = np.zeros((len(times), len(h)))
+        costs = sum(cost.value_expr_batch(times,
+                                          H[:-1].astype(self.dtype, copy=False),
+                                          U.astype(self.dtype, copy=False))
+                    for cost in self.costs)
+        assert (np.isfinite(costs).all())
+        U[:, -1] = -costs
+        # cash recurrence c' = (1 + r) (c - cost), with P the growth of cash
+        P = np.cumprod(1 + returns[:, -1])
+        H[1:, -1] = P * (h.values[-1] - np.cumsum(costs / np.append(1., P[:-1])))
+        return H, U, returns[:, -1], {
+            cost.__class__.__name__: cost.simulation_log_batch(times)
+            for cost in self.costs}
+
+    def _compound(self, h, times, results, policy):
+        """Propagates h with null trades over times, in one vectorized step.
+
+        Logs what propagate with null trades would, at each of times.
+        """
+        start = time.time()
+        H, U, risk_free_returns, costs = self._compound_arrays(h, times)
+        exec_time = (time.time() - start) / len(times)
+        self._log_block(results, policy, times, h.index, H[1:], U,
+                        risk_free_returns, exec_time, costs)
+        return pd.Series(index=h.index, data=H[-1])
+
+    def _log_block(self, results, policy, times, columns, H_next, U,
+                   risk_free_returns, exec_time, costs):
+        results.log_policy_block(times, policy.get_state())
+        results.log_simulation_block(
+            u=pd.DataFrame(index=times, data=U, columns=columns),
+            h_next=pd.DataFrame(index=times, data=H_next, columns=columns),
+            risk_free_returns=pd.Series(index=times, data=risk_free_returns),
+            exec_time=exec_time, costs=costs)
 
     def run_backtest(self, initial_portfolio, start_time, end_time,
-                    policy, loglevel=logging.WARNING):
+                    policy, loglevel=logging.WARNING, alpha_sensitivity=False,
+                    fast_forward=False, log_every=1, restrict_data=False):
         """Backtest a single policy.
+
+        If alpha_sensitivity is True the derivatives of the holdings with
+        respect to the weights of the policy's AlphaStream are propagated
+        along, and those of the value are logged as alpha_sensitivity.
+
+        If fast_forward is True the holdings are compounded in one step
+        until the policy's next_decision_time, logging the same series.
+        The policy is then not called at the steps skipped, which is why
+        it is opt-in.
+
+        If log_every is larger than 1 only one step every log_every is
+        logged in full, see SimulationResult.
+
+        If restrict_data is True the backtest runs on copies of the
+        simulator and policy whose data are views of the window it uses,
+        see window.data_window, which are those of the result.
         """
         logging.basicConfig(level=loglevel)
 
+        if restrict_data:
+            times = self._simulation_times(start_time, end_time)
+            start, end = data_window(self.market_returns.index, times,
+                                     [self, policy])
+            logging.info('Restricting the data from %s to %s' % (start, end))
+            memo = {}
+            return restrict(self, start, end, memo).run_backtest(
+                initial_portfolio, start_time, end_time,
+                restrict(policy, start, end, memo), loglevel=loglevel,
+                alpha_sensitivity=alpha_sensitivity,
+                fast_forward=fast_forward, log_every=log_every)
+
         results = SimulationResult(initial_portfolio=copy.copy(initial_portfolio),
                                    policy=policy, cash_key=self.cash_key,
-                                   simulator=self)
+                                   simulator=self, PPY=self.PPY,
+                                   timedelta=self.timedelta,
+                                   log_every=log_every)
         h = initial_portfolio
 
-        simulation_times = self.market_returns.index[
-                (self.market_returns.index>=start_time)&
-                (self.market_returns.index<=end_time)]
+        simulation_times = self._simulation_times(start_time, end_time)
         logging.info('Backtest started, from %s to %s' % (simulation_times[0],
                                                             simulation_times[-1]))
 
-        for t in simulation_times:
-            logging.info('Getting trades at time %s' % t)
+        if alpha_sensitivity:
+            # derivatives of the holdings in the alpha source weights
+            D = np.zeros((len(h), len(policy.alpha_model.weights)))
+
+        i = 0
+        while i < len(simulation_times):
+            t = simulation_times[i]
+            i += 1
+            logging.info('Getting trades at time %s', t)
+            results.log_state(t, policy.get_state())
             start = time.time()
+            failed = False
             try:
                 u = policy.get_trades(h, t)
             except cvx.SolverError:
                 logging.warning('Solver failed on timestamp %s. Defaulting to no trades.'%t)
                 u = pd.Series(index=h.index, data=0.)
+                failed = True
             end = time.time()
             assert (not pd.isnull(u).any())
             results.log_policy(t, end-start)
 
-            logging.info('Propagating portfolio at time %s' % t)
+            if alpha_sensitivity:
+                if failed or self._solve_failed(policy):
+                    # the null trade does not depend on the alpha
+                    du = np.zeros(D.shape)
+                else:
+                    du = self._trade_sensitivity(policy, D, h, u, t)
+
+            logging.info('Propagating portfolio at time %s', t)
             start = time.time()
+            h_prev = h
             h, u = self.propagate(h, u, t)
             end = time.time()
+            if alpha_sensitivity:
+                D = self._propagate_sensitivity(D, du, h_prev + u, u, t)
+                results.log_data('alpha_sensitivity', t, D.sum(axis=0))
             assert (not h.isnull().values.any())
             results.log_simulation(t=t, u=u, h_next=h,
                 risk_free_return=self.market_returns.loc[t, self.cash_key],
                 exec_time=end-start)
 
+            if fast_forward and not alpha_sensitivity:
+                next_time = policy.next_decision_time(t, simulation_times)
+                if next_time is not None:
+                    j = simulation_times.searchsorted(next_time)
+                    if j > i:
+                        logging.info('Compounding portfolio from %s to %s' %
+                                     (simulation_times[i], simulation_times[j-1]))
+                        h = self._compound(h, simulation_times[i:j], results,
+                                           policy)
+                        i = j
+
         logging.info('Backtest ended, from %s to %s' % (simulation_times[0], simulation_times[-1]))
         return results
 
+    def run_segmented_backtest(self, initial_portfolio, start_time, end_time,
+                               policy, loglevel=logging.WARNING, parallel=True):
+        """Backtest a rebalancing policy, with its segments in parallel.
+
+        Between two decision times of the policy the holdings compound
+        with null trades, which is linear in the holdings since the
+        holding costs are: after a rebalance to the target the holdings
+        are the value times the target, but for the cash paying the
+        tcosts, which grows at the risk free rate. So the segments are
+        propagated in parallel from the target, with unit value, and
+        stitched together by rescaling them. The decisions and the trades
+        are simulated in order, as in run_backtest, and a segment is
+        propagated directly if its trades did not reach the target, e.g.
+        for a null volume.
+
+        Args:
+            policy: a policy with a target, e.g. PeriodicRebalance
+
+        Returns:
+            The SimulationResult that run_backtest would return.
+        """
+        logging.basicConfig(level=loglevel)
+        target = policy.target[initial_portfolio.index]
+        simulation_times = self._simulation_times(start_time, end_time)
+
+        # the decision times, as in run_backtest
+        decider = copy.deepcopy(policy)
+        starts, i = [], 0
+        while i < len(simulation_times):
+            starts.append(i)
+            t = simulation_times[i]
+            decider.get_trades(initial_portfolio, t)
+            next_time = decider.next_decision_time(t, simulation_times)
+            j = i + 1 if next_time is None else \
+                simulation_times.searchsorted(next_time)
+            i = max(j, i + 1)
+        segments = list(zip(starts, starts[1:] + [len(simulation_times)]))
+
+        def _propagate_segment(segment):
+            first, last = segment
+            simulator = isolate(self)
+            start = time.time()
+            a, _ = simulator.propagate(target * 1., target * 0.,
+                                       simulation_times[first])
+            if last == first + 1:
+                return a, None
+            times = simulation_times[first + 1:last]
+            arrays = simulator._compound_arrays(a, times)
+            return a, arrays + ((time.time() - start) / len(times),)
+
+        chunksize = int(np.ceil(len(segments) / multiprocess.cpu_count()))
+        blocks = self._get_executor(parallel).map(_propagate_segment, segments,
+                                                  chunksize)
+
+        results = SimulationResult(initial_portfolio=copy.copy(initial_portfolio),
+                                   policy=policy, cash_key=self.cash_key,
+                                   simulator=self, PPY=self.PPY,
+                                   timedelta=self.timedelta)
+        h = initial_portfolio
+        for (first, last), (a, block) in zip(segments, blocks):
+            t = simulation_times[first]
+            results.log_state(t, policy.get_state())
+            start = time.time()
+            u = policy.get_trades(h, t)
+            results.log_policy(t, time.time() - start)
+            start = time.time()
+            h, u = self.propagate(h, u, t)
+            results.log_simulation(t=t, u=u, h_next=h,
+                risk_free_return=self.market_returns.loc[t, self.cash_key],
+                exec_time=time.time() - start)
+            if block is None:
+                continue
+            times = simulation_times[first + 1:last]
+
+            # the holdings are the value times those from the target
+            a_assets = a.values[:-1]
+            norm = a_assets.dot(a_assets)
+            value = h.values[:-1].dot(a_assets) / norm if norm > 0 else 0.
+            if not np.allclose(h.values[:-1], value * a_assets):
+                logging.info('Propagating the segment at %s directly' % t)
+                h = self._compound(h, times, results, policy)
+                continue
+            H, U, risk_free_returns, costs, exec_time = block
+            H_next = value * H[1:]
+            H_next[:, -1] += (h.values[-1] - value * a.values[-1]) * \
+                np.cumprod(1 + risk_free_returns)
+            self._log_block(results, policy, times, h.index, H_next,
+                            value * U, risk_free_returns, exec_time,
+                            {name: value * log for name, log in costs.items()})
+            h = pd.Series(index=h.index, data=H_next[-1])
+        return results
+
+    def run_incremental_backtest(self, initial_portfolio, start_time, end_time,
+                                 policy, path, loglevel=logging.WARNING):
+        """Backtest a policy, reusing the result of a previous run saved at path.
+
+        The data and parameters of the simulator, the policy and the
+        initial portfolio are fingerprinted at each step, see
+        step_fingerprints, and saved with the result. On a rerun only the
+        steps from the first whose fingerprint changed are simulated,
+        starting from the holdings and policy state saved before it, or
+        from the policy's lookahead_periods before it if it plans ahead.
+
+        Returns:
+            The SimulationResult that run_backtest would return, also saved
+            at path.
+        """
+        logging.basicConfig(level=loglevel)
+        simulation_times = self._simulation_times(start_time, end_time)
+        static, fingerprints = step_fingerprints(
+            [self, policy, initial_portfolio], simulation_times)
+
+        first = 0
+        if os.path.exists(path):
+            previous = SimulationResult.load(path)
+            first = self._first_changed_step(previous, static, fingerprints,
+                                             policy)
+        if first == len(simulation_times):
+            logging.info('Backtest inputs unchanged, reusing %s' % path)
+            previous.simulator = self
+            return previous
+
+        if first == 0:
+            results = self.run_backtest(initial_portfolio, start_time,
+                                        end_time, policy, loglevel=loglevel)
+        else:
+            t = simulation_times[first]
+            logging.info('Backtest inputs changed, rerunning from %s' % t)
+            h, state = previous.snapshot(t)
+            policy = copy.copy(policy)
+            policy.set_state(copy.deepcopy(state))
+            results = self.run_backtest(h, t, end_time, policy,
+                                        loglevel=loglevel)
+            results.fork(previous, t)
+            results.flatten()
+        results.static_fingerprint = static
+        results.fingerprints = fingerprints
+        results.save(path)
+        return results
+
+    @staticmethod
+    def _first_changed_step(previous, static, fingerprints, policy):
+        """The first step to simulate again, given the previous result."""
+        old = getattr(previous, 'fingerprints', None)
+        if old is None or previous.static_fingerprint != static or \
+                previous.log_every != 1 or not len(old) or \
+                old.index[0] != fingerprints.index[0]:
+            return 0
+        num = min(len(old), len(fingerprints))
+        same = (old.index[:num] == fingerprints.index[:num]) & \
+            (old.values[:num] == fingerprints.values[:num])
+        first = num if same.all() else int(np.argmin(same))
+        if len(old) != len(fingerprints):
+            # the last common step is rerun, from the saved snapshot
+            first = min(first, num - 1)
+        if first == len(fingerprints):
+            return first
+        lookahead = getattr(policy, 'lookahead_periods', 1)
+        return 0 if lookahead is None else max(0, first - lookahead + 1)
+
+    @staticmethod
+    def _solve_failed(policy):
+        """Whether the last trades of policy are the null trade because
+        all solvers failed, see SinglePeriodOpt.stats."""
+        stats = getattr(policy, 'stats', {})
+        return 'solver' in stats and pd.isnull(stats['solver']) and \
+            stats.get('cache_hit') is not True
+
+    def _trade_sensitivity(self, policy, D, h, u, t):
+        """Derivatives of the trades u given those of the holdings h, D."""
+        value = sum(h)
+        w = h.values / value
+        trade = u.values / value
+        dv = D.sum(axis=0)
+        dw = (D - np.outer(w, dv)) / value
+        dz_theta, dz_w = policy.trade_sensitivities(t, w, trade, value)
+        return np.outer(trade, dv) + value * (dz_theta + dz_w.dot(dw))
+
+    def _propagate_sensitivity(self, D, du, h_plus, u, t):
+        """Derivatives of the next holdings, given those of the trades du."""
+        du = du.copy()
+        du[u.values == 0] = 0.  # null trades
+        dh_plus = D + du
+        dcost = 0.
+        for cost in self.costs:
+            grad_h, grad_u = cost.value_grad(t, h_plus, u)
+            dcost = dcost + grad_h.dot(dh_plus) + grad_u.dot(du)
+        dh_plus[-1] = D[-1] - du[:-1].sum(axis=0) - dcost
+        returns = self.market_returns.loc[t, h_plus.index].values
+        return (1 + returns)[:, np.newaxis] * dh_plus
+
     def run_multiple_backtest(self, initial_portf, start_time, end_time, policies,
                               loglevel=logging.WARNING, parallel=True):
         """Backtest multiple policies.
+
+        Args:
+            parallel: True for the process pool, False to run them in
+                order, a name of EXECUTORS ('serial', 'thread' or
+                'process') or an executor.
         """
 
         def _run_backtest(policy):
-            return self.run_backtest(initial_portf, start_time, end_time,
-                                     policy, loglevel=loglevel)
-
-        num_workers = min(multiprocess.cpu_count(), len(policies))
-        if parallel:
-            workers = multiprocess.Pool(num_workers)
-            results = workers.map(_run_backtest, policies)
-            workers.close()
-            return results
-        else:
-            return list(map(_run_backtest, policies))
+            return isolate(self).run_backtest(initial_portf, start_time,
+                                              end_time, isolate(policy),
+                                              loglevel=loglevel)
+
+        return self._get_executor(parallel).map(_run_backtest, policies)
+
+    def run_multi_account_backtest(self, initial_portfolios, start_time,
+                                   end_time, policy, loglevel=logging.WARNING,
+                                   shared_impact=True):
+        """Backtest many accounts trading with a MultiAccountOpt policy.
+
+        Args:
+            initial_portfolios: dataframe of holdings, one row per account
+                and columns as market_returns
+            policy: a MultiAccountOpt or JointAccountOpt
+            shared_impact: if True the market impact is that of the
+                aggregate trade of the accounts, split pro rata
+
+        Returns:
+            A dataframe of the values of the accounts over time.
+        """
+        logging.basicConfig(level=loglevel)
+        assert (initial_portfolios.columns.equals(self.market_returns.columns))
+        simulation_times = self._simulation_times(start_time, end_time)
+
+        H = initial_portfolios.values.astype(float)
+        values = [H.sum(axis=1)]
+        for t in simulation_times:
+            logging.info('Getting trades at time %s', t)
+            try:
+                U = policy.get_trades(pd.DataFrame(
+                    H, index=initial_portfolios.index,
+                    columns=initial_portfolios.columns), t).values
+            except cvx.SolverError:
+                logging.warning('Solver failed on timestamp %s. Defaulting to no trades.'%t)
+                U = np.zeros(H.shape)
+            returns = np.tile(self.market_returns.loc[t].values, (len(H), 1))
+            H, U = self.propagate_batch(H, U, t, returns,
+                                        shared=shared_impact)
+            values.append(H.sum(axis=1))
+
+        index = simulation_times.append(
+            pd.DatetimeIndex([simulation_times[-1] + self.timedelta]))
+        return pd.DataFrame(values, index=index,
+                            columns=initial_portfolios.index)
+
+    def walk_forward(self, initial_portfolio, start_time, end_time, policies,
+                     train_periods, test_periods, metric='sharpe_ratio',
+                     parallel=True):
+        """Walk-forward validation of candidate policies.
+
+        The simulation times are split in folds of train_periods followed
+        by test_periods, rolled forward by test_periods. On each fold the
+        candidate with the highest metric over the train window is
+        backtested over the test window. Each window starts from
+        initial_portfolio. If the train metric of all the candidates is
+        NaN, the first is selected, with a warning.
+
+        The train backtests of all folds and candidates run at once with
+        the executor of parallel, see run_multiple_backtest, then those of
+        the test windows, the jobs of a candidate being contiguous. The
+        data reused across the folds are only the kernel arrays of the
+        simulator, see _cache_data, sent once with each chunk of jobs
+        together with the policies, which build their problems again.
+
+        Args:
+            policies: dict of name -> policy, the candidates
+            metric: the SimulationResult attribute compared
+
+        Returns:
+            folds: DataFrame with the windows of each fold, the selected
+                policy and its train and test metric
+            returns: the out-of-sample returns, of the test windows
+        """
+        times = self._simulation_times(start_time, end_time)
+        windows = [(times[i:i + train_periods],
+                    times[i + train_periods:i + train_periods + test_periods])
+                   for i in range(0, len(times) - train_periods, test_periods)]
+        assert len(windows) > 0
+
+        def _run(job):
+            name, window = job
+            result = isolate(self).run_backtest(initial_portfolio, window[0],
+                                                window[-1],
+                                                isolate(policies[name]))
+            return getattr(result, metric), result.returns
+
+        def _map(jobs):
+            chunksize = int(np.ceil(len(jobs) / multiprocess.cpu_count()))
+            return self._get_executor(parallel).map(_run, jobs, chunksize)
+
+        names = list(policies)
+        scores = _map([(name, train) for name in names
+                       for train, test in windows])
+        scores = pd.DataFrame(np.reshape([score for score, returns in scores],
+                                         (len(names), len(windows))),
+                              index=names)
+        selected = []
+        for k, (train, test) in enumerate(windows):
+            if scores[k].isnull().all():
+                logging.warning('No %s on the train window ending %s, '
+                                'selecting %s' % (metric, train[-1], names[0]))
+                selected.append(names[0])
+            else:
+                selected.append(scores[k].idxmax())
+        tests = _map([(name, test) for name, (train, test) in
+                      zip(selected, windows)])
+
+        folds = pd.DataFrame([OrderedDict([
+            ('train_start', train[0]), ('train_end', train[-1]),
+            ('test_start', test[0]), ('test_end', test[-1]),
+            ('policy', name), ('train_' + metric, scores.loc[name, k]),
+            ('test_' + metric, score)])
+            for k, ((train, test), name, (score, returns))
+            in enumerate(zip(windows, selected, tests))])
+        return folds, pd.concat([returns for score, returns in tests])
+
+    def run_scenarios(self, initial_portfolio, start_time, end_time, policy,
+                      scenarios, num_scenarios=100, chunk_size=50, seed=0,
+                      parallel=True):
+        """Backtest a policy over simulated return paths.
+
+        The paths are run in chunks, each propagated as one batch, and only
+        the running metrics of each path are kept.
+
+        Args:
+            scenarios: a BlockBootstrap or FactorScenarios, giving the
+                returns of the paths at the simulation times.
+            num_scenarios: number of paths.
+            chunk_size: number of paths of each chunk, the work unit of the
+                process pool. The draws of a chunk are seeded by seed plus
+                its first path.
+        Returns:
+            A DataFrame with the sharpe_ratio, max_drawdown and final_value
+            of each path.
+        """
+        assert (initial_portfolio.index.equals(self.market_returns.columns))
+        simulation_times = self._simulation_times(start_time, end_time)
+
+        def _run_chunk(first):
+            return isolate(self)._run_scenario_chunk(
+                initial_portfolio, simulation_times, policy, scenarios,
+                min(chunk_size, num_scenarios - first), seed + first, self.PPY)
+
+        firsts = list(range(0, num_scenarios, chunk_size))
+        summaries = self._get_executor(parallel).map(_run_chunk, firsts)
+        return pd.concat(summaries, ignore_index=True)
+
+    def _run_scenario_chunk(self, initial_portfolio, simulation_times, policy,
+                            scenarios, num_scenarios, seed, PPY):
+        random_state = np.random.RandomState(seed)
+        index = initial_portfolio.index
+        H = np.tile(initial_portfolio.values.astype(float), (num_scenarios, 1))
+        # each path has its own policy state
+        policies = [copy.copy(policy) for i in range(num_scenarios)]
+        metrics = ScenarioMetrics(H.sum(axis=1), PPY)
+        paths = scenarios.paths(simulation_times, num_scenarios, random_state)
+        for t, returns in zip(simulation_times, paths):
+            U = np.zeros(H.shape)
+            for i in range(num_scenarios):
+                try:
+                    U[i] = policies[i].get_trades(pd.Series(H[i], index=index),
+                                                  t).values
+                except cvx.SolverError:
+                    logging.warning('Solver failed on timestamp %s. Defaulting to no trades.'%t)
+            H, U = self.propagate_batch(H, U, t, returns)
+            metrics.update(H.sum(axis=1), returns[:, -1])
+        return metrics.summary()
+
+    def _get_executor(self, parallel):
+        """The executor of the jobs, see run_multiple_backtest.
+
+        The pools of the named executors are kept between calls.
+        """
+        if parallel is True or parallel is False:
+            parallel = 'process' if parallel else 'serial'
+        if not isinstance(parallel, str):
+            return parallel
+        if not hasattr(self, '_executors'):
+            self._executors = {}
+        if parallel not in self._executors:
+            self._executors[parallel] = EXECUTORS[parallel]()
+        return self._executors[parallel]
+
+    def close(self):
+        """Shuts down the worker processes and threads, if any."""
+        for executor in getattr(self, '_executors', {}).values():
+            executor.close()
+        self._executors = {}
+
+    def __getstate__(self):
+        # the pools are not sent to the workers
+        state = dict(self.__dict__)
+        state['_executors'] = {}
+        return state
 
     def what_if(self, time, results, alt_policies, parallel=True):
         """Run alternative policies starting from given time.
+
+        The holdings and policy state before trading at time are restored
+        from results, and only the remaining times are simulated.
+
+        Args:
+            time: a simulated time of results.
+            results: a SimulationResult, or the path of one saved with
+                SimulationResult.save.
+            alt_policies: list of policies. Those of the same class as the
+                policy of results start from its state at time.
+            parallel: how to run the policies, see run_multiple_backtest.
+        Returns:
+            A list of SimulationResult sharing the logs of results before time.
         """
-        ## TODO fix
-        initial_portf = copy.copy(results.holdings.loc[time])
-        all_times = results.holdings.index
-        alt_results = self.run_multiple_backtest(initial_portf,
-                                                 all_times[all_times > time],
-                                                 alt_policies, parallel)
-        for idx, alt_result in enumerate(alt_results):
-            alt_result.holdings.loc[time] = results.holdings.loc[time]
-            alt_result.holdings.sort_index(axis=0, inplace=True)
+        if isinstance(results, str):
+            results = SimulationResult.load(results)
+        h, state = results.snapshot(time)
+        policies = []
+        for policy in alt_policies:
+            policy = copy.copy(policy)
+            if type(policy) is type(results.policy):
+                policy.set_state(copy.deepcopy(state))
+            policies.append(policy)
+        end_time = results.h_next.index[-1]
+        alt_results = self.run_multiple_backtest(h, time, end_time, policies,
+                                                 parallel=parallel)
+        for alt_result in alt_results:
+            alt_result.fork(results, time)
         return alt_results
 
     @staticmethod
@@ -178,22 +765,44 @@ class MarketSimulator():
             policy: the policy that achieved the returns. Alpha model must be a stream.
             selector: A map from SimulationResult to time series.
             delta: the fractional deviation.
-            fit: the type of fit to perform.
+            fit: the type of fit to perform, "linear", "least-squares", or
+                "sensitivity" which uses the derivatives of the profits in
+                the alpha source weights instead of perturbed backtests.
+                These are taken from true_results if it was run with
+                alpha_sensitivity, otherwise computed in one backtest.
+            parallel: how to run the perturbed backtests, see
+                run_multiple_backtest.
         Returns:
             A dict of alpha source to return series.
         """
         # Default selector looks at profits.
         if selector is None:
             def selector(result):
-                return result.v - result.initial_portfolio.v
+                return result.v - result.initial_val
+        elif fit == "sensitivity":
+            raise Exception("The sensitivity fit only attributes profits.")
 
         alpha_stream = policy.alpha_model
         assert isinstance(alpha_stream, AlphaStream)
-        times = true_results.h.index
-        weights = alpha_stream.weights
+        weights = np.asarray(alpha_stream.weights)
         assert np.sum(weights) == 1
         alpha_sources = alpha_stream.alpha_sources
         num_sources = len(alpha_sources)
+
+        if fit == "sensitivity":
+            result = true_results
+            if not hasattr(result, 'alpha_sensitivity'):
+                times = true_results.h_next.index
+                result = self.run_backtest(true_results.initial_portfolio,
+                                           times[0], times[-1], policy,
+                                           alpha_sensitivity=True)
+            profits = selector(true_results)
+            data = pd.DataFrame(columns=[s.name for s in alpha_sources],
+                                index=profits.index, data=0.)
+            # the sensitivity logged at t is that of the value after t
+            data.iloc[1:] = result.alpha_sensitivity.values * weights
+            data['residual'] = profits - data.sum(axis=1)
+            return data
         Wmat = self.reduce_signal_perturb(weights, delta)
         perturb_pols = []
         for idx in range(len(alpha_sources)):
@@ -203,31 +812,33 @@ class MarketSimulator():
             perturb_pols.append(new_pol)
         # Simulate
         p0 = true_results.initial_portfolio
-        alt_results = self.run_multiple_backtest(p0, times,
-                                                 perturb_pols, parallel)
+        times = true_results.h_next.index
+        alt_results = self.run_multiple_backtest(p0, times[0], times[-1],
+                                                 perturb_pols, parallel=parallel)
         # Attribute.
         true_arr = selector(true_results).values
         attr_times = selector(true_results).index
         Rmat = np.zeros((num_sources, len(attr_times)))
         for idx, result in enumerate(alt_results):
             Rmat[idx, :] = selector(result).values
-        Pmat = cvx.Variable(num_sources, len(attr_times))
         if fit == "linear":
-            prob = cvx.Problem(cvx.Minimize(0), [Wmat * Pmat == Rmat])
-            prob.solve()
+            Pmat = np.linalg.lstsq(Wmat, Rmat, rcond=None)[0]
         elif fit == "least-squares":
-            error = cvx.sum_squares(Wmat * Pmat - Rmat)
-            prob = cvx.Problem(cvx.Minimize(error),
-                               [Pmat.T * weights == true_arr])
-            prob.solve()
+            # KKT system of min ||Wmat * p - r||^2 s.t. weights * p = true,
+            # shared by all the columns
+            kkt = np.zeros((num_sources + 1, num_sources + 1))
+            kkt[:-1, :-1] = 2 * Wmat.T.dot(Wmat)
+            kkt[:-1, -1] = weights
+            kkt[-1, :-1] = weights
+            rhs = np.vstack([2 * Wmat.T.dot(Rmat), true_arr])
+            Pmat = np.linalg.solve(kkt, rhs)[:-1]
         else:
             raise Exception("Unknown fitting method.")
         # Dict of results.
-        wmask = np.tile(weights[:, np.newaxis], (1, len(attr_times))).T
         data = pd.DataFrame(columns=[s.name for s in alpha_sources],
                             index=attr_times,
-                            data=Pmat.value.T.A * wmask)
-        data['residual'] = true_arr - np.matrix((weights * Pmat).value).A1
-        data['RMS error'] = np.matrix(cvx.norm(Wmat * Pmat - Rmat, 2, axis=0).value).A1
+                            data=Pmat.T * weights)
+        data['residual'] = true_arr - weights.dot(Pmat)
+        data['RMS error'] = np.linalg.norm(Wmat.dot(Pmat) - Rmat, axis=0)
         data['RMS error'] /= np.sqrt(num_sources)
         return data
@@ -0,0 +1,262 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+
+from .utils.lazy import lazy_import
+
+cvx = lazy_import('cvxpy')
+multiprocess = lazy_import('multiprocess')
+
+__all__ = ['SolverStrategy', 'Solution']
+
+
+class Solution(object):
+    """The outcome of SolverStrategy.solve.
+
+    The values of the variables are set on the problem, the other results
+    are here, also for the solves run by the solver process.
+
+    Attributes:
+      solver: name of the solver that produced the solution, or None.
+      status: status of the last attempt, or None.
+      value: optimal value of the last attempt, or None.
+      stats: cvxpy SolverStats of the last attempt, or None.
+      transfer_time: seconds spent sending the problem to the solver
+          process and the solution back, 0 if solved in this process.
+    """
+
+    def __init__(self, solver=None, status=None, value=None, stats=None,
+                 transfer_time=0.):
+        self.solver = solver
+        self.status = status
+        self.value = value
+        self.stats = stats
+        self.transfer_time = transfer_time
+
+
+class SolverStrategy(object):
+    """An ordered list of solvers to try at each time step.
+
+    Attributes:
+      solvers: list of solver names or (solver, options) pairs, tried in order.
+      time_budget: wall-clock seconds allowed per time step, or None.
+          The solvers with a time limit option are given the time left,
+          the others run in the solver process, which is killed if it
+          runs out, see start.
+      relax_factor: if not None, when all solvers fail they are tried again
+          with their tolerances multiplied by this factor.
+    """
+
+    # default tolerances of the solvers, loosened by relax_factor
+    TOLERANCES = {'ECOS': {'abstol': 1e-7, 'reltol': 1e-6, 'feastol': 1e-7},
+                  'CVXOPT': {'abstol': 1e-7, 'reltol': 1e-6, 'feastol': 1e-7},
+                  'SCS': {'eps': 1e-3}}
+
+    # options giving the solvers a time limit, in seconds
+    TIME_LIMITS = {'GUROBI': 'TimeLimit'}
+
+    def __init__(self, solvers, time_budget=None, relax_factor=None):
+        self.solvers = [item if isinstance(item, tuple) else (item, {})
+                        for item in solvers]
+        self.time_budget = time_budget
+        self.relax_factor = relax_factor
+
+    def attempts(self):
+        """The (solver, options) pairs in the order they are tried."""
+        result = list(self.solvers)
+        if self.relax_factor is not None:
+            for solver, opts in self.solvers:
+                relaxed = dict(opts)
+                for key, default in self.TOLERANCES.get(solver, {}).items():
+                    relaxed[key] = opts.get(key, default) * self.relax_factor
+                result.append((solver, relaxed))
+        return result
+
+    def deadline(self):
+        """The time by which the solves of a time step must end, or None.
+
+        The policies take it once per time step, and pass it to all the
+        solves of that step.
+        """
+        if self.time_budget is None:
+            return None
+        return time.time() + self.time_budget
+
+    def start(self):
+        """Starts the solver process, if the time budget needs it.
+
+        It is started on the first timed solve, but only from the main
+        thread; the policies solving in threads call start before.
+        """
+        if self.time_budget is not None and \
+                any(solver not in self.TIME_LIMITS for solver, _ in self.solvers):
+            _worker.start()
+
+    def _solve_once(self, prob, solver, opts, remaining):
+        """Solves prob, returns its Solution or None if the time ran out.
+
+        The values of the variables of a solve in the solver process are
+        set on prob only if they arrive in time, so that prob can be
+        solved again.
+        """
+        opts = dict(opts)
+        if remaining is not None and solver not in self.TIME_LIMITS:
+            return _worker.solve(prob, solver, opts, remaining)
+        if remaining is not None:
+            opts[self.TIME_LIMITS[solver]] = remaining
+        prob.solve(solver=solver, **opts)
+        return Solution(status=prob.status, value=prob.value,
+                        stats=getattr(prob, 'solver_stats', None))
+
+    def solve(self, prob, deadline=None):
+        """Solves prob with the first solver that succeeds.
+
+        Args:
+          deadline: time by which to end, see deadline; by default the
+              time budget starts now.
+
+        Returns:
+          The Solution, whose solver is None if all failed.
+        """
+        if deadline is None:
+            deadline = self.deadline()
+        solution = Solution()
+        for solver, opts in self.attempts():
+            name = solver if solver is not None else 'default'
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    logging.warning('Time budget of %gs exhausted' % self.time_budget)
+                    return solution
+            try:
+                attempt = self._solve_once(prob, solver, opts, remaining)
+            except cvx.SolverError as e:
+                logging.warning('The solver %s failed: %s' % (name, e))
+                continue
+            if attempt is None:
+                logging.warning('The solver %s exceeded the time budget' % name)
+                return solution
+            solution = attempt
+            if solution.status in [cvx.OPTIMAL, cvx.OPTIMAL_INACCURATE]:
+                solution.solver = name
+                return solution
+            logging.warning('The problem is %s with solver %s' % (solution.status, name))
+        return solution
+
+
+class _SolverWorker(object):
+    """A child process solving the problems sent to it, for the solvers
+    without a time limit option.
+
+    It is kept between the solves, and killed, then started again, when
+    one runs out of time. It is not daemonic, so that it outlives the
+    solves, and is closed at exit. The problems are pickled to it, one at
+    a time.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def _check_fork(self):
+        # a forked process does not own the solver process of its parent
+        if self.pid != os.getpid():
+            self.__init__()
+
+    def start(self):
+        self._check_fork()
+        if self.process is not None and self.process.is_alive():
+            return
+        if multiprocess.current_process().daemon:
+            raise cvx.SolverError(
+                'The time budget of a solver without a time limit option '
+                'needs the solver process, which the daemonic workers of a '
+                'process pool cannot start; use parallel=\'thread\' or '
+                '\'serial\', or a solver in SolverStrategy.TIME_LIMITS')
+        if threading.current_thread() is not threading.main_thread():
+            raise cvx.SolverError(
+                'The solver process of the time budget is started only from '
+                'the main thread, to fork safely; call SolverStrategy.start '
+                'before solving in threads')
+        self.conn, child_conn = multiprocess.Pipe()
+        self.process = multiprocess.Process(target=_serve, args=(child_conn,))
+        self.process.start()
+        child_conn.close()
+
+    def solve(self, prob, solver, opts, remaining):
+        self._check_fork()
+        with self.lock:
+            start = time.time()
+            self.start()
+            self.conn.send((prob, solver, opts))
+            if not self.conn.poll(max(remaining - (time.time() - start), 0.)):
+                self.kill()
+                return None
+            try:
+                result = self.conn.recv()
+            except EOFError:
+                self.kill()
+                raise cvx.SolverError('The solver process exited')
+        if isinstance(result, Exception):
+            raise result
+        for var, value in zip(prob.variables(), result['primal']):
+            var.value = value
+        return Solution(status=result['status'], value=result['value'],
+                        stats=result['stats'],
+                        transfer_time=time.time() - start - result['time'])
+
+    def kill(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = self.conn = None
+
+    def close(self):
+        self._check_fork()
+        if self.process is not None and self.process.is_alive():
+            self.conn.send(None)
+            self.process.join()
+        self.process = self.conn = None
+
+
+def _serve(conn):
+    """Solves the problems sent by _SolverWorker, until None."""
+    while True:
+        request = conn.recv()
+        if request is None:
+            break
+        prob, solver, opts = request
+        start = time.time()
+        try:
+            prob.solve(solver=solver, **opts)
+            conn.send({'status': prob.status, 'value': prob.value,
+                       'primal': [var.value for var in prob.variables()],
+                       'stats': getattr(prob, 'solver_stats', None),
+                       'time': time.time() - start})
+        except Exception as e:
+            conn.send(e)
+
+
+_worker = _SolverWorker()
+atexit.register(_worker.close)
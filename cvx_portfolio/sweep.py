@@ -0,0 +1,167 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import itertools
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from .executors import isolate
+from .utils.lazy import lazy_import
+
+multiprocess = lazy_import('multiprocess')
+
+__all__ = ['ParameterSweep']
+
+# the components built by each thread of this process for the sweep being
+# run, by (token, thread), they are kept between the jobs a worker of the
+# pool is given. The threads don't share them, as the models keep the
+# expressions they build.
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+class ParameterSweep(object):
+    """Backtests of a policy over a grid of parameters.
+
+    The parts of the policy shared between configurations, e.g. risk
+    models, tcost models or alpha combinations, are components that depend
+    on a subset of the parameters. Each is built once by each worker and
+    reused by its jobs, which are sorted so that the configurations with
+    the same components are contiguous, and split in contiguous chunks.
+
+    Attributes:
+      grid: dict of parameter name -> list of values.
+      components: dict of component name -> (factory, parameter names),
+          the factory being called with those parameters as keywords. The
+          jobs are sorted by the components in this order, so the most
+          expensive should come first.
+      build_policy: function(params, components) returning the policy of a
+          configuration, given the dicts of its parameters and components.
+      metrics: list of SimulationResult attributes, or dict of
+          name -> function(result), reported for each run.
+    """
+
+    METRICS = ['sharpe_ratio', 'annual_return', 'volatility', 'max_drawdown']
+
+    def __init__(self, grid, components, build_policy, metrics=None):
+        self.grid = OrderedDict(grid)
+        self.components = OrderedDict(components)
+        self.build_policy = build_policy
+        self.metrics = self.METRICS if metrics is None else metrics
+        for factory, params in self.components.values():
+            assert all(param in self.grid for param in params)
+
+    def configurations(self):
+        """The (indices, parameters) of the configurations, in run order.
+
+        The indices are the positions of the values in the grid.
+        """
+        names = list(self.grid)
+        order = [param for factory, params in self.components.values()
+                 for param in params]
+        order += [name for name in names if name not in order]
+        positions = [names.index(param) for param in order]
+
+        indices = itertools.product(*[range(len(values)) for values in
+                                      self.grid.values()])
+        indices = sorted(indices, key=lambda item: [item[i] for i in positions])
+        return [(dict(zip(names, item)),
+                 OrderedDict((name, self.grid[name][i])
+                             for name, i in zip(names, item)))
+                for item in indices]
+
+    def _get_components(self, token, indices, params):
+        """The components of a configuration, and how many were cached."""
+        with _cache_lock:
+            for key in [key for key in _cache if key[0] != token]:
+                del _cache[key]  # of an earlier sweep
+            cache = _cache.setdefault((token, threading.get_ident()), {})
+        components, hits = {}, 0
+        for name, (factory, names) in self.components.items():
+            key = (name,) + tuple(indices[param] for param in names)
+            if key in cache:
+                hits += 1
+            else:
+                cache[key] = factory(**{param: params[param] for param in names})
+            components[name] = cache[key]
+        return components, hits
+
+    def _run_job(self, token, simulator, initial_portfolio, start_time,
+                 end_time, indices, params):
+        start = time.time()
+        components, hits = self._get_components(token, indices, params)
+        policy = self.build_policy(params, components)
+        build_time = time.time() - start
+
+        start = time.time()
+        result = isolate(simulator).run_backtest(initial_portfolio,
+                                                 start_time, end_time, policy)
+        backtest_time = time.time() - start
+
+        row = OrderedDict(params)
+        if isinstance(self.metrics, dict):
+            for name, metric in self.metrics.items():
+                row[name] = metric(result)
+        else:
+            for name in self.metrics:
+                row[name] = getattr(result, name)
+        row['build_time'] = build_time
+        row['backtest_time'] = backtest_time
+        row['cache_hits'] = hits
+        return row
+
+    def run(self, simulator, initial_portfolio, start_time, end_time,
+            parallel=True, chunk_size=None):
+        """Backtests all the configurations.
+
+        Args:
+            simulator: the MarketSimulator, whose executor runs the
+                chunks of jobs
+            parallel: see MarketSimulator.run_multiple_backtest
+            chunk_size: number of jobs of each chunk, by default the jobs
+                are split evenly between the workers
+
+        Returns:
+            A DataFrame with a row per configuration, its parameters,
+            metrics, build_time, backtest_time and cache_hits.
+        """
+        token = uuid.uuid4().hex
+        jobs = self.configurations()
+        if chunk_size is None:
+            workers = 1 if parallel is False else multiprocess.cpu_count()
+            chunk_size = int(np.ceil(len(jobs) / workers))
+        chunks = [jobs[i:i + chunk_size]
+                  for i in range(0, len(jobs), chunk_size)]
+        logging.info('Sweep of %d configurations in %d chunks' %
+                     (len(jobs), len(chunks)))
+
+        def _run_chunk(chunk):
+            return [self._run_job(token, simulator, initial_portfolio,
+                                  start_time, end_time, indices, params)
+                    for indices, params in chunk]
+
+        rows = simulator._get_executor(parallel).map(_run_chunk, chunks)
+        # the components built in this process are not kept
+        with _cache_lock:
+            for key in [key for key in _cache if key[0] == token]:
+                del _cache[key]
+        return pd.DataFrame([row for chunk in rows for row in chunk])
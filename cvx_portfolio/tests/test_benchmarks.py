@@ -0,0 +1,48 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import tempfile
+
+from ..benchmarks import synthetic_market, run_benchmarks, load_results, compare
+from .base_test import BaseTest
+
+
+class TestBenchmarks(BaseTest):
+
+    def test_synthetic_market(self):
+        """Test the shapes of the synthetic data.
+        """
+        data = synthetic_market(n=10, T=30)
+        self.assertEqual(data['returns'].shape, (30, 11))
+        self.assertEqual(data['volumes'].shape, (30, 10))
+        self.assertEqual(data['Sigma'].shape, (11, 11))
+        self.assertEqual(data['exposures'].iloc[0].shape[1], 11)
+
+    def test_run_and_compare(self):
+        """Test running the benchmarks and comparing the results.
+        """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'bench.jsonl')
+            names = ['propagate', 'backtest_hold']
+            run_benchmarks(n=5, T=20, names=names, repeat=1, output=path)
+            run_benchmarks(n=5, T=20, names=names, repeat=1, output=path)
+            results = load_results(path)
+            self.assertEqual(len(results), 4)
+            comparison = compare(results.iloc[:2], results.iloc[2:],
+                                 tolerance=1e6)
+            self.assertEqual(len(comparison), 2)
+            assert not comparison.regression.any()
@@ -0,0 +1,58 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import pickle
+import tempfile
+
+import numpy as np
+
+from ..data import MarketData, MANIFEST
+from ..simulator import MarketSimulator
+from .base_test import BaseTest
+
+DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
+
+
+class TestData(BaseTest):
+
+    def setUp(self):
+        with open(DATAFILE, 'rb') as f:
+            returns, sigma, volume, a, b, s = pickle.load(f)
+        self.frames = {'returns': returns.iloc[1:], 'sigmas': sigma,
+                       'volumes': volume, 'a': a, 'b': b, 's': s}
+
+    def test_market_data(self):
+        """Test the conversion of the csv files and the cached frames."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            for name, frame in self.frames.items():
+                frame.to_csv(os.path.join(tmpdir, name + '.csv.gz'),
+                             compression='gzip')
+            data = MarketData(tmpdir, cash_key='cash')
+            manifest = os.path.join(data.cache_dir, MANIFEST)
+            converted = os.path.getmtime(manifest)
+            self.assertEqual(sorted(data.names), sorted(self.frames))
+            self.assertEqual(data.columns[-1], 'cash')
+
+            data = MarketData(tmpdir, cash_key='cash')
+            self.assertEqual(os.path.getmtime(manifest), converted)
+            for name, frame in self.frames.items():
+                cached = data[name]
+                self.assertTrue(cached.index.equals(frame.index))
+                np.testing.assert_allclose(
+                    cached[frame.columns].values, frame.values)
+            self.assertTrue(isinstance(data.simulator(), MarketSimulator))
+            self.assertFalse('prices' in data)
@@ -0,0 +1,33 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import cvx_portfolio
+from ..benchmarks import heavy_imports
+from .base_test import BaseTest
+
+
+class TestImports(BaseTest):
+
+    def test_lazy_startup(self):
+        """Test that the heavy dependencies are loaded on first use only.
+        """
+        self.assertEqual(heavy_imports(), [])
+
+    def test_public_names(self):
+        """Test that all the public names resolve.
+        """
+        for name in cvx_portfolio.__all__:
+            assert getattr(cvx_portfolio, name) is not None
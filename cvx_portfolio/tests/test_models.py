@@ -23,7 +23,8 @@ import pandas as pd
 
 from ..costs import HcostModel, TcostModel
 from ..returns import AlphaSource, AlphaStream
-from ..constraints import (LongOnly, LeverageLimit,LongCash, MaxTrade)
+from ..constraints import (LongOnly, LeverageLimit,LongCash, MaxTrade,
+                           ConstraintCompiler)
 from .base_test import BaseTest
 
 DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
@@ -226,3 +227,33 @@ class TestModels(BaseTest):
         assert cons.value
         z.value = -100*z.value#-100*np.ones(n)
         assert not cons.value
+
+    def test_constraint_compiler(self):
+        """Test lowering of box constraints to bounds.
+        """
+        n = len(self.universe)
+        t = self.times[1]
+        value = 1e6
+        w = np.ones(n)/n
+        limit = self.volume.loc[t].values * .1 / value
+        compiler = ConstraintCompiler([LongOnly(), LongCash(),
+                                       MaxTrade(self.volume, max_fraction=.1),
+                                       LeverageLimit(2)])
+        lower, upper, other = compiler.bounds(t, w, value, n)
+        self.assertItemsAlmostEqual(lower[:-1], np.maximum(-w[:-1], -limit))
+        self.assertAlmostEqual(lower[-1], -w[-1])
+        self.assertItemsAlmostEqual(upper[:-1], limit)
+        self.assertEqual(upper[-1], np.inf)
+        self.assertEqual(len(other), 1)
+
+        # budget, upper and lower bounds in one matrix, plus the leverage
+        z = cvx.Variable(n)
+        cons = compiler.weight_expr(t, w, z, value)
+        self.assertEqual(len(cons), 4)
+        z.value = np.zeros(n)
+        assert all(con.value for con in cons)
+        tmp = np.zeros(n)
+        tmp[0] = 2 * limit[0]
+        tmp[-1] = -tmp[0]
+        z.value = tmp
+        assert not all(con.value for con in cons)
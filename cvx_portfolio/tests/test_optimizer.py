@@ -16,15 +16,22 @@ limitations under the License.
 
 import os
 import pickle
+import tempfile
+import time
 
 import cvxpy as cvx
 import numpy as np
 import pandas as pd
 
-from ..policies import SinglePeriodOpt, MultiPeriodOpt
+from ..policies import (SinglePeriodOpt, MultiPeriodOpt, MultiAccountOpt,
+                        JointAccountOpt)
 from ..costs import HcostModel, TcostModel
-from ..returns import AlphaSource
+from ..returns import AlphaSource, AlphaStream
 from ..risks import FullSigma
+from ..constraints import LeverageLimit
+from ..solvers import SolverStrategy
+from ..result import SimulationResult
+from ..cache import MemoryCache, DiskCache
 from .base_test import BaseTest
 
 DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
@@ -138,3 +145,262 @@ class TestOptimizer(BaseTest):
         self.assertAlmostEqual(w1.sum(), 1)
         self.assertAlmostEqual(w2.sum(), 1)
         self.assertItemsAlmostEqual(h/p_0.v, w1, places=4)
+
+    def test_active_set(self):
+        """Test that the active set mode matches the full problem.
+        """
+        gamma = 100.
+        n = len(self.universe)
+        alpha = self.returns.copy()
+        alpha.iloc[:, :n//2] = 0.
+        alpha_model = AlphaSource(alpha)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
+        t = self.times[1]
+        p_0 = pd.Series(index=self.universe, data=0.)
+        p_0.iloc[0] = 1E6
+        p_0.iloc[-1] = 1E6
+
+        pol = SinglePeriodOpt(alpha_model, [gamma*risk_model, tcost_model],
+                              [], solver=cvx.ECOS)
+        z = pol.get_trades(p_0, t)
+        pol = SinglePeriodOpt(alpha_model, [gamma*risk_model, tcost_model],
+                              [], solver=cvx.ECOS, active_set=True)
+        z_active = pol.get_trades(p_0, t)
+        self.assertAlmostEqual(z_active.sum(), 0)
+        self.assertItemsAlmostEqual(z_active/p_0.sum(), z/p_0.sum(), places=4)
+
+    def test_weight_expr_active(self):
+        """Test that the models sliced to the active assets match the
+        models over all assets when the others do not trade.
+        """
+        n = len(self.universe)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        models = [AlphaSource(self.returns, delta_data=self.returns.abs()),
+                  FullSigma(emp_Sigma), HcostModel(self.s, self.s),
+                  TcostModel(self.volume, self.sigma, self.a, self.b)]
+        t = self.times[1]
+        value = 1E6
+        np.random.seed(0)
+        w = np.random.randn(n)
+        active = np.random.rand(n) > 0.5
+        active[-1] = True
+        trade = np.random.randn(int(active.sum()))
+        z = cvx.Variable(len(trade))
+        z.value = trade
+        trade_full = np.zeros(n)
+        trade_full[active] = trade
+        z_full = cvx.Variable(n)
+        z_full.value = trade_full
+        for model in models:
+            full = model.weight_expr(t, w + z_full, z_full, value)
+            reduced = model.weight_expr_active(t, w[active] + z, z, value,
+                                               active, w)
+            if isinstance(full, tuple):
+                full, reduced = full[0], reduced[0]
+            self.assertAlmostEqual(reduced.value, full.value)
+
+    def test_solver_fallback(self):
+        """Test the solver fallback chain.
+        """
+        n = len(self.universe)
+        alpha_model = AlphaSource(self.returns)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
+        t = self.times[1]
+        p_0 = pd.Series(index=self.universe, data=1E6)
+
+        strategy = SolverStrategy(['NOT_A_SOLVER', cvx.ECOS], time_budget=60.)
+        pol = SinglePeriodOpt(alpha_model, [100*risk_model, tcost_model],
+                              [], solver=strategy)
+        z = pol.get_trades(p_0, t)
+        self.assertEqual(pol.solver_used, cvx.ECOS)
+        self.assertAlmostEqual(z.sum(), 0)
+
+        # a late solve is killed, the problem is solved again in time
+        x = cvx.Variable(n)
+        prob = cvx.Problem(cvx.Minimize(cvx.sum_squares(x - 1)))
+        self.assertIsNone(strategy._solve_once(prob, cvx.ECOS, {}, 1e-6))
+        self.assertIsNone(x.value)
+        solution = strategy.solve(prob)
+        self.assertEqual(solution.solver, cvx.ECOS)
+        self.assertEqual(solution.status, cvx.OPTIMAL)
+        self.assertItemsAlmostEqual(x.value, np.ones(n), places=4)
+
+        # the deadline is shared by the solves of a time step
+        self.assertIsNone(strategy.solve(prob, time.time() - 1.).solver)
+
+        attempts = SolverStrategy([cvx.ECOS], relax_factor=10.).attempts()
+        self.assertEqual(len(attempts), 2)
+        self.assertAlmostEqual(attempts[1][1]['feastol'], 1e-6)
+
+    def test_policy_stats(self):
+        """Test per-phase timings and solver statistics.
+        """
+        n = len(self.universe)
+        alpha_model = AlphaSource(self.returns)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
+        p_0 = pd.Series(index=self.universe, data=1E6)
+        pol = SinglePeriodOpt(alpha_model, [100*risk_model, tcost_model],
+                              [], solver=cvx.ECOS)
+        result = SimulationResult(initial_portfolio=p_0, policy=pol,
+                                  cash_key='cash', simulator=None)
+        for t in self.times[1:3]:
+            pol.get_trades(p_0, t)
+            result.log_policy(t, sum(v for k, v in pol.stats.items()
+                                     if k.endswith('_time')) + 1e-3)
+        self.assertEqual(list(result.policy_stats.status), ['optimal']*2)
+        self.assertEqual(list(result.policy_stats.solver), [cvx.ECOS]*2)
+        self.assertAlmostEqual(result.policy_profile['fraction'].sum(), 1.)
+
+    def test_solution_cache(self):
+        """Test that repeated problems are served from the cache.
+        """
+        n = len(self.universe)
+        alpha_model = AlphaSource(self.returns)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        p_0 = pd.Series(index=self.universe, data=1E6)
+        t = self.times[1]
+        for cache in [MemoryCache(), DiskCache(tempfile.mkdtemp())]:
+            pol = SinglePeriodOpt(alpha_model, [100*risk_model], [],
+                                  solver=cvx.ECOS, cache=cache)
+            z = pol.get_trades(p_0, t)
+            self.assertFalse(pol.stats['cache_hit'])
+            self.assertTrue(np.allclose(pol.get_trades(p_0, t), z))
+            self.assertTrue(pol.stats['cache_hit'])
+            pol.get_trades(p_0*2, t)
+            self.assertFalse(pol.stats['cache_hit'])
+            self.assertAlmostEqual(cache.hit_rate, 1/3.)
+            # the expressions of a hit are those of the last solve
+            results = SimulationResult(p_0, pol, 'cash', None)
+            pol.get_trades(p_0, t)
+            results.log_policy(t, 0.)
+            self.assertTrue(np.isnan(results.policy_FullSigma.iloc[0]))
+
+    def test_trade_sensitivities(self):
+        """Test the trade sensitivities against finite differences.
+        """
+        n = len(self.universe)
+        sources = [AlphaSource(self.returns),
+                   AlphaSource(self.returns.shift(1).fillna(0.))]
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        tcost_model = TcostModel(self.volume, self.sigma,
+                                 self.a*0, self.b, power=2)
+        t = self.times[2]
+        p_0 = pd.Series(index=self.universe, data=1E6)
+        value = p_0.sum()
+
+        def trades(weights):
+            pol = SinglePeriodOpt(AlphaStream(sources, weights),
+                                  [100*risk_model, tcost_model], [],
+                                  solver=cvx.ECOS)
+            return pol, pol.get_trades(p_0, t).values / value
+
+        pol, trade = trades(np.array([.5, .5]))
+        dz_theta, dz_w = pol.trade_sensitivities(t, (p_0/value).values,
+                                                 trade, value)
+        self.assertEqual(dz_w.shape, (n, n))
+        eps = 1e-3
+        for k in range(2):
+            weights = np.array([.5, .5])
+            weights[k] += eps
+            diff = (trades(weights)[1] - trade) / eps
+            scale = np.abs(dz_theta[:, k]).max()
+            self.assertItemsAlmostEqual(diff / scale, dz_theta[:, k] / scale,
+                                        places=2)
+
+    def test_multi_account_opt(self):
+        """Test that the accounts are optimized as separate problems.
+        """
+        n = len(self.universe)
+        alpha_model = AlphaSource(self.returns)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
+        t = self.times[2]
+        portfolios = pd.DataFrame([np.ones(n)*1E6, np.arange(1, n+1)*1E5],
+                                  index=['A', 'B'], columns=self.universe)
+        limits = pd.Series([2., 1.5], index=['A', 'B'])
+        pol = MultiAccountOpt(alpha_model, [100*risk_model, tcost_model], [],
+                              leverage_limits=limits, solver=cvx.ECOS)
+        trades = pol.get_trades(portfolios, t)
+        for account in portfolios.index:
+            single = SinglePeriodOpt(alpha_model,
+                                     [100*risk_model, tcost_model],
+                                     [LeverageLimit(limits[account])],
+                                     solver=cvx.ECOS)
+            trade = single.get_trades(portfolios.loc[account], t)
+            value = portfolios.loc[account].sum()
+            self.assertItemsAlmostEqual(trades.loc[account] / value,
+                                        trade / value, places=4)
+
+    def test_joint_account_opt(self):
+        """Test that one account alone pays all the market impact.
+        """
+        n = len(self.universe)
+        alpha_model = AlphaSource(self.returns)
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        risk_model = FullSigma(emp_Sigma)
+        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
+        t = self.times[2]
+        portfolio = pd.Series(index=self.universe, data=1E6)
+        single = SinglePeriodOpt(alpha_model, [100*risk_model, tcost_model],
+                                 [], solver=cvx.ECOS)
+        trade = single.get_trades(portfolio, t)
+        joint = JointAccountOpt(alpha_model, [100*risk_model, tcost_model],
+                                [], eps=1e-8, max_iters=1000,
+                                solver=cvx.ECOS)
+        trades = joint.get_trades(pd.DataFrame([portfolio]), t)
+        self.assertItemsAlmostEqual(trades.iloc[0] / portfolio.sum(),
+                                    trade / portfolio.sum(), places=4)
+        # the limits are by position, whatever the labels of the accounts
+        joint = JointAccountOpt(alpha_model, [100*risk_model, tcost_model],
+                                [], leverage_limits=10., eps=1e-8,
+                                max_iters=1000, solver=cvx.ECOS)
+        trades = joint.get_trades(pd.DataFrame([portfolio], index=[5]), t)
+        self.assertItemsAlmostEqual(trades.loc[5] / portfolio.sum(),
+                                    trade / portfolio.sum(), places=4)
+
+        # the accounts trading the same names share the impact of the
+        # aggregate trade, as in the problem of all the accounts
+        portfolios = pd.DataFrame([portfolio, 3 * portfolio *
+                                   np.linspace(.5, 1.5, n)])
+        joint = JointAccountOpt(alpha_model, [100*risk_model, tcost_model],
+                                [], eps=1e-8, max_iters=1000,
+                                solver=cvx.ECOS)
+        trades = joint.get_trades(portfolios, t)
+        values = portfolios.sum(axis=1).values
+        total = values.sum()
+        objective, constraints, zs = 0., [], []
+        for k in range(len(values)):
+            z = cvx.Variable(n)
+            prob = joint._problem(t, portfolios.iloc[k].values / values[k], z,
+                                  values[k])
+            objective += values[k] / total * prob.objective.args[0]
+            constraints += prob.constraints
+            zs.append(z)
+        aggregate = sum(values[k] / total * zs[k][:-1]
+                        for k in range(len(values)))
+        coeff = tcost_model._dollar_coeff(t) * total**(tcost_model.power - 1)
+        objective -= cvx.sum_entries(cvx.mul_elemwise(
+            coeff, cvx.abs(aggregate)**tcost_model.power))
+        cvx.Problem(cvx.Maximize(objective), constraints).solve(solver=cvx.ECOS)
+        for k in range(len(values)):
+            self.assertItemsAlmostEqual(
+                trades.iloc[k] / total,
+                np.asarray(zs[k].value).ravel() * values[k] / total, places=4)
+
+        # the aggregate impact is split between the accounts
+        U = np.zeros((2, n))
+        U[:, 0] = [1E5, 3E5]
+        shared = tcost_model.value_expr_shared(t, U, U)
+        single = tcost_model.value_expr_batch(t, U.sum(axis=0, keepdims=True),
+                                              U.sum(axis=0, keepdims=True))
+        self.assertAlmostEqual(shared.sum() / 1E5, single[0] / 1E5)
+        self.assertAlmostEqual(shared[1] / shared[0], 3.)
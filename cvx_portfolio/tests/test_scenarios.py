@@ -0,0 +1,57 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import pickle
+
+import numpy as np
+
+from ..scenarios import FactorScenarios
+from .base_test import BaseTest
+
+DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
+
+
+class TestScenarios(BaseTest):
+
+    def setUp(self):
+        with open(DATAFILE, 'rb') as f:
+            self.returns, self.sigma, self.volume, self.a, self.b, self.s = \
+            pickle.load(f)
+
+    def test_factor_scenarios(self):
+        """Test the shapes and moments of the factor model returns."""
+        n = len(self.returns.columns)
+        random_state = np.random.RandomState(0)
+        exposures = random_state.randn(2, n) * 1e-2
+        factor_Sigma = np.array([[1., .3], [.3, .5]])
+        idiosync = np.full(n, 1e-4)
+        Sigma = exposures.T.dot(factor_Sigma).dot(exposures) + np.diag(idiosync)
+        std = np.sqrt(np.diag(Sigma))
+
+        # the mean over time is looked up at each time
+        scenarios = FactorScenarios(exposures, factor_Sigma, idiosync,
+                                    mean=self.returns)
+        times = self.returns.index[:3]
+        paths = list(scenarios.paths(times, 100000, random_state))
+        self.assertEqual(len(paths), len(times))
+        for t, returns in zip(times, paths):
+            self.assertEqual(returns.shape, (100000, n))
+            self.assertItemsAlmostEqual(
+                (returns.mean(axis=0) - self.returns.loc[t].values) / std,
+                np.zeros(n), places=1)
+            self.assertItemsAlmostEqual(np.cov(returns.T) / np.outer(std, std),
+                                        Sigma / np.outer(std, std), places=1)
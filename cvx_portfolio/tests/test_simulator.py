@@ -17,6 +17,7 @@ limitations under the License.
 import os
 import pickle
 import copy
+import tempfile
 
 import pandas as pd
 import numpy as np
@@ -25,8 +26,13 @@ from ..returns import AlphaSource, MarketReturns
 from .base_test import BaseTest
 from ..costs import TcostModel, HcostModel
 from ..simulator import MarketSimulator
-from ..policies import Hold
+from ..policies import Hold, PeriodicRebalance, SinglePeriodOpt
 from ..result import SimulationResult
+from ..scenarios import BlockBootstrap
+from ..expression import periods_between
+from .. import kernels
+from ..risks import EmpSigma
+from ..window import data_window, restrict
 
 DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
 
@@ -105,3 +111,344 @@ class TestSimulator(BaseTest):
         h_next, u = self.Simulator.propagate(h,u, t=t)
         results.log_simulation(t=t, u=u, h_next=h_next, exec_time=0)
         self.assertAlmostEquals(results.simulator_HcostModel.sum(), 2800.0)
+
+    def test_what_if(self):
+        """Test forking alternative policies from a snapshot."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        policy = PeriodicRebalance(target, 'month')
+        times = self.returns.index
+        results = simulator.run_backtest(self.portfolio, times[1], times[40],
+                                         policy)
+        t = times[20]
+        same, hold = simulator.what_if(t, results,
+                                       [PeriodicRebalance(target, 'month'),
+                                        Hold()], parallel=False)
+        # the same policy, restored at t, reproduces the original run
+        self.assertItemsAlmostEqual(same.v, results.v)
+        self.assertItemsAlmostEqual(same.turnover, results.turnover)
+        self.assertItemsAlmostEqual(hold.v[:t], results.v[:t])
+        assert (hold.u.loc[t:].drop('cash', axis=1) == 0).values.all()
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'results.pickle')
+            results.save(path)
+            same, = simulator.what_if(t, path, [PeriodicRebalance(target,
+                                                                  'month')],
+                                      parallel=False)
+        self.assertItemsAlmostEqual(same.v, results.v)
+
+    def test_incremental_backtest(self):
+        """Test rerunning a backtest from the first revised data."""
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        times = self.returns.index
+        costs = [self.tcost_term, self.hcost_term]
+        simulator = MarketSimulator(self.returns, self.volume, costs=costs)
+        revised = self.returns.copy()
+        revised.loc[times[30], :] += 1e-3
+        revised_simulator = MarketSimulator(revised, self.volume, costs=costs)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'results.pickle')
+            results = simulator.run_incremental_backtest(
+                self.portfolio, times[1], times[40],
+                PeriodicRebalance(target, 'week'), path)
+            same = simulator.run_incremental_backtest(
+                self.portfolio, times[1], times[40],
+                PeriodicRebalance(target, 'week'), path)
+            self.assertItemsAlmostEqual(same.v, results.v)
+            rerun = revised_simulator.run_incremental_backtest(
+                self.portfolio, times[1], times[40],
+                PeriodicRebalance(target, 'week'), path)
+        full = revised_simulator.run_backtest(
+            self.portfolio, times[1], times[40],
+            PeriodicRebalance(target, 'week'))
+        self.assertItemsAlmostEqual(rerun.v, full.v)
+        self.assertItemsAlmostEqual(rerun.v[:times[29]], results.v[:times[29]])
+        self.assertEqual(list(rerun.fingerprints != results.fingerprints),
+                         [t == times[30] for t in times[1:41]])
+
+    def test_propagate_batch(self):
+        """Test batched propagation against propagate."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        t = self.returns.index[1]
+        u = pd.Series(index=self.portfolio.index, data=1E4)
+        u.iloc[0] = -3E4
+        h_next, u_next = simulator.propagate(self.portfolio.copy(), u.copy(), t)
+        H = np.tile(self.portfolio.values, (2, 1))
+        U = np.vstack([u.values, 2*u.values])
+        R = np.tile(self.returns.loc[t].values, (2, 1))
+        H_next, U_next = simulator.propagate_batch(H, U, t, R)
+        self.assertItemsAlmostEqual(H_next[0], h_next.values, places=3)
+        self.assertItemsAlmostEqual(U_next[0], u_next.values, places=3)
+
+    def test_column_order(self):
+        """Test that the costs are priced by asset, in any column order."""
+        t = self.returns.index[1]
+        assets = list(self.returns.columns[:-1][::-1]) + ['cash']
+        simulator = MarketSimulator(self.returns[assets], self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        u = pd.Series(index=self.portfolio.index,
+                      data=np.linspace(-3E4, 3E4, len(self.portfolio)))
+        h = self.portfolio - 2E6 * (np.arange(len(self.portfolio)) % 2)
+        h_next, u_next = self.Simulator.propagate(h.copy(), u.copy(), t)
+        h_rev, u_rev = simulator.propagate(h[assets], u[assets], t)
+        self.assertItemsAlmostEqual(h_rev[assets], h_next[assets], places=3)
+        self.assertItemsAlmostEqual(u_rev[assets], u_next[assets], places=3)
+
+    def test_kernels(self):
+        """Test the simulator kernels, compiled or not, against pandas."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        t = self.returns.index[1]
+        u = pd.Series(index=self.portfolio.index, data=1E4)
+        u.iloc[0] = -3E4
+        abs_u = np.abs(u[:-1])
+        tcost = self.tcost_term.spread.loc[t] * abs_u + \
+            self.tcost_term.nonlin_coeff.loc[t] * self.tcost_term.sigma.loc[t] * \
+            abs_u**1.5 / self.tcost_term.volume.loc[t]**.5
+        hcost = -self.hcost_term.borrow_costs.loc[t] @ \
+            np.minimum(0, (self.portfolio + u)[:-1])
+        expected = (self.portfolio + u) * (1 + self.returns.loc[t])
+        expected[-1] -= (u[:-1].sum() + tcost.sum() + hcost) * \
+            (1 + self.returns.loc[t][-1])
+        for jit in [True, False]:
+            previous = kernels.use_jit(jit)
+            try:
+                h_next, u_next = simulator.propagate(self.portfolio.copy(),
+                                                     u.copy(), t)
+            finally:
+                kernels.use_jit(previous)
+            self.assertItemsAlmostEqual(h_next / 1E6, expected / 1E6)
+            self.assertAlmostEqual(self.tcost_term.simulation_log(t).sum(),
+                                   tcost.sum())
+
+    def test_scenarios(self):
+        """Test the scenario metrics on the historical path."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        times = self.returns.index
+        result = simulator.run_backtest(self.portfolio, times[0], times[-1],
+                                        Hold())
+        # a single block as long as the history is the history itself
+        scenarios = BlockBootstrap(self.returns, block_length=len(times))
+        metrics = simulator.run_scenarios(self.portfolio, times[0], times[-1],
+                                          Hold(), scenarios, num_scenarios=3,
+                                          chunk_size=2, parallel=False)
+        self.assertEqual(len(metrics), 3)
+        for i in range(3):
+            self.assertAlmostEqual(metrics.final_value[i] / result.v[-1], 1.)
+            self.assertAlmostEqual(metrics.sharpe_ratio[i], result.sharpe_ratio)
+            self.assertAlmostEqual(metrics.max_drawdown[i], result.max_drawdown)
+
+    def test_executors(self):
+        """Test that the executors give the same backtests."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        policies = [PeriodicRebalance(target, period)
+                    for period in ['day', 'week', 'month']]
+        times = self.returns.index
+        serial = simulator.run_multiple_backtest(
+            self.portfolio, times[0], times[-1], policies, parallel='serial')
+        threads = simulator.run_multiple_backtest(
+            self.portfolio, times[0], times[-1], policies, parallel='thread')
+        simulator.close()
+        for result, other in zip(serial, threads):
+            self.assertItemsAlmostEqual(result.v / 1E6, other.v / 1E6)
+            self.assertItemsAlmostEqual(result.simulator_TcostModel.values,
+                                        other.simulator_TcostModel.values)
+
+    def test_walk_forward(self):
+        """Test the folds of the walk-forward validation."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        policies = {'hold': Hold(),
+                    'weekly': PeriodicRebalance(target, 'week')}
+        times = self.returns.index
+        folds, returns = simulator.walk_forward(
+            self.portfolio, times[0], times[-1], policies, train_periods=20,
+            test_periods=10, parallel=False)
+        self.assertEqual(len(folds), int(np.ceil((len(times) - 20) / 10)))
+        self.assertEqual(len(returns), len(times) - 20)
+        for i, fold in folds.iterrows():
+            scores = [simulator.run_backtest(
+                self.portfolio, fold.train_start, fold.train_end,
+                policy).sharpe_ratio for policy in policies.values()]
+            np.testing.assert_allclose(fold.train_sharpe_ratio, np.nanmax(scores))
+            result = simulator.run_backtest(
+                self.portfolio, fold.test_start, fold.test_end,
+                policies[fold.policy])
+            # nan if the last test window has a single period
+            np.testing.assert_allclose(fold.test_sharpe_ratio,
+                                       result.sharpe_ratio)
+
+    def test_fast_forward(self):
+        """Test compounding through the periods without trades."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        times = self.returns.index
+        for policy in [Hold(), PeriodicRebalance(target, 'week')]:
+            fast = simulator.run_backtest(self.portfolio, times[1], times[-1],
+                                          copy.copy(policy), fast_forward=True)
+            slow = simulator.run_backtest(self.portfolio, times[1], times[-1],
+                                          copy.copy(policy))
+            self.assertItemsAlmostEqual(fast.v / slow.v, np.ones(len(slow.v)))
+            self.assertItemsAlmostEqual(fast.h_next.values / 1E6,
+                                        slow.h_next.values / 1E6)
+            self.assertItemsAlmostEqual(fast.u.values, slow.u.values, places=3)
+            self.assertItemsAlmostEqual(fast.simulator_HcostModel,
+                                        slow.simulator_HcostModel, places=3)
+            assert fast.h_next.index.equals(slow.h_next.index)
+
+    def test_float32(self):
+        """Test the single precision mode against the error bound."""
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        times = self.returns.index
+        costs = [self.tcost_term, self.hcost_term]
+        results = {}
+        for dtype in [np.float64, np.float32]:
+            simulator = MarketSimulator(self.returns, self.volume,
+                                        costs=costs, dtype=dtype)
+            results[dtype] = simulator.run_backtest(
+                self.portfolio, times[1], times[-1],
+                PeriodicRebalance(target, 'week'), fast_forward=True)
+        single, double = results[np.float32], results[np.float64]
+        self.assertEqual(single.u.values.dtype, np.float32)
+        self.assertEqual(single.h_next.values.dtype, np.float32)
+        self.assertEqual(single.simulator_TcostModel.values.dtype, np.float32)
+        self.assertEqual(single.v.dtype, np.float64)
+        self.assertEqual(single.u.values.nbytes * 2, double.u.values.nbytes)
+        # no float64 copy of the data is kept next to the float32 one
+        simulator = single.simulator
+        self.assertEqual(simulator.market_returns.values.dtype, np.float32)
+        tcost = simulator.costs[0]
+        self.assertEqual(tcost.spread.values.dtype, np.float32)
+        self.assertTrue(np.shares_memory(tcost._spread_values,
+                                         tcost.spread.values))
+        self.assertEqual(self.tcost_term.spread.values.dtype, np.float64)
+        # the bound documented in MarketSimulator
+        bound = 2.**-24 * len(times) * (np.abs(self.returns.values).max() +
+                                        0.01)
+        self.assertTrue((np.abs(single.v / double.v - 1) <= bound).all())
+        self.assertItemsAlmostEqual(single.simulator_TcostModel.sum(axis=1),
+                                    double.simulator_TcostModel.sum(axis=1),
+                                    places=2)
+
+    def test_sparse_logs(self):
+        """Test the trades and cost logs kept as sparse matrices."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        times = self.returns.index
+        results = simulator.run_backtest(self.portfolio, times[1], times[-1],
+                                         PeriodicRebalance(target, 'week'))
+        _, trades = results._sparse_log('u')
+        self.assertTrue(trades.nnz < results.u.size / 2)
+        self.assertEqual(len(results.u), len(times) - 1)
+        turnover = np.abs(results.u.drop('cash', axis=1)).sum(axis=1) / \
+            results.v
+        self.assertItemsAlmostEqual(results.turnover.fillna(0),
+                                    turnover.fillna(0))
+        self.assertItemsAlmostEqual(results.cost_totals.TcostModel,
+                                    results.simulator_TcostModel.sum(axis=1))
+        self.assertItemsAlmostEqual(results.cost_totals.HcostModel,
+                                    results.simulator_HcostModel)
+
+    def test_restrict_data(self):
+        """Test backtesting on the window of the data it uses."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        times = self.returns.index
+        self.assertEqual(data_window(times, times[10:20],
+                                     [simulator, EmpSigma(self.returns, 5)]),
+                         (times[4], times[19]))
+        full = simulator.run_backtest(self.portfolio, times[10], times[20],
+                                      PeriodicRebalance(target, 'week'))
+        restricted = simulator.run_backtest(self.portfolio, times[10],
+                                            times[20],
+                                            PeriodicRebalance(target, 'week'),
+                                            restrict_data=True)
+        self.assertItemsAlmostEqual(restricted.v, full.v)
+        self.assertItemsAlmostEqual(restricted.simulator_TcostModel,
+                                    full.simulator_TcostModel)
+        self.assertEqual(len(restricted.simulator.market_returns), 11)
+        self.assertEqual(len(restricted.simulator.costs[0].volume), 11)
+        self.assertEqual(len(simulator.market_returns), len(times))
+        # the constraint compiler of a policy is that of the restricted data
+        policy = SinglePeriodOpt(AlphaSource(self.returns), [self.tcost_term],
+                                 [])
+        restricted = restrict(policy, times[10], times[20])
+        self.assertIs(restricted.compiler.costs, restricted.costs)
+        self.assertIs(restricted.compiler.constraints, restricted.constraints)
+        self.assertEqual(len(restricted.compiler.costs[0].no_trade), 11)
+        self.assertEqual(len(policy.compiler.costs[0].no_trade), len(times))
+
+    def test_segmented_backtest(self):
+        """Test stitching the segments between rebalances."""
+        simulator = MarketSimulator(self.returns, self.volume,
+                                    costs=[self.tcost_term, self.hcost_term])
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        times = self.returns.index
+        for period in ['week', pd.Timedelta('3 days')]:
+            policy = PeriodicRebalance(target, period)
+            segmented = simulator.run_segmented_backtest(
+                self.portfolio, times[1], times[-1], copy.copy(policy),
+                parallel=False)
+            serial = simulator.run_backtest(self.portfolio, times[1],
+                                            times[-1], copy.copy(policy))
+            self.assertItemsAlmostEqual(segmented.v / serial.v,
+                                        np.ones(len(serial.v)))
+            self.assertItemsAlmostEqual(segmented.h_next.values / 1E6,
+                                        serial.h_next.values / 1E6)
+            self.assertItemsAlmostEqual(segmented.simulator_HcostModel,
+                                        serial.simulator_HcostModel, places=3)
+
+    def test_intraday(self):
+        """Test minute bars with downsampled logs."""
+        bars = pd.date_range('2017-01-03 09:30', periods=len(self.returns),
+                             freq='min')
+
+        def to_bars(df):
+            return pd.DataFrame(df.values, index=bars, columns=df.columns)
+        tcost = TcostModel(to_bars(self.volume), to_bars(self.sigma),
+                           to_bars(self.a), to_bars(self.b),
+                           period=pd.Timedelta('1min'))
+        hcost = HcostModel(to_bars(self.s))
+        simulator = MarketSimulator(to_bars(self.returns),
+                                    to_bars(self.volume), [tcost, hcost],
+                                    PPY=252*390, timedelta=pd.Timedelta('1min'))
+        target = pd.Series(index=self.returns.columns,
+                           data=1./len(self.returns.columns))
+        policy = PeriodicRebalance(target, pd.Timedelta('10min'))
+        full = simulator.run_backtest(self.portfolio, bars[0], bars[-1],
+                                      copy.copy(policy))
+        sparse = simulator.run_backtest(self.portfolio, bars[0], bars[-1],
+                                        copy.copy(policy), log_every=5)
+        self.assertEqual(len(sparse.h_next), (len(bars) + 4) // 5)
+        self.assertItemsAlmostEqual(sparse.v / full.v, np.ones(len(full.v)))
+        logged = sparse.h_next.index
+        self.assertTrue(sparse.h.index.equals(logged))
+        self.assertItemsAlmostEqual((sparse.h / full.h.loc[logged]).values,
+                                    np.ones(sparse.h.shape))
+        self.assertItemsAlmostEqual((sparse.w - full.w.loc[logged]).values,
+                                    np.zeros(sparse.w.shape))
+        self.assertItemsAlmostEqual(sparse.leverage, full.leverage.loc[logged])
+        self.assertAlmostEqual(sparse.sharpe_ratio, full.sharpe_ratio)
+        self.assertEqual(periods_between(bars[0], bars[10],
+                                         pd.Timedelta('1min')), 10)
+        self.assertEqual(periods_between(bars[0], bars[10], bars[::2]), 5)
@@ -0,0 +1,79 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import pickle
+
+import pandas as pd
+
+from ..costs import TcostModel, HcostModel
+from ..simulator import MarketSimulator
+from ..policies import PeriodicRebalance
+from ..sweep import ParameterSweep
+from .base_test import BaseTest
+
+DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
+
+
+class TestSweep(BaseTest):
+
+    def setUp(self):
+        with open(DATAFILE, 'rb') as f:
+            self.returns, self.sigma, self.volume, self.a, self.b, self.s = \
+            pickle.load(f)
+        self.portfolio = pd.Series(index=self.returns.columns, data=1E6)
+        self.simulator = MarketSimulator(
+            self.returns, self.volume,
+            costs=[TcostModel(self.volume, self.sigma, self.a, self.b),
+                   HcostModel(self.s)])
+
+    def test_sweep(self):
+        """Test that the shared components are built once.
+        """
+        n = len(self.returns.columns)
+        built = []
+
+        def target(cash):
+            built.append(cash)
+            weights = pd.Series(index=self.returns.columns,
+                                data=(1. - cash) / (n - 1))
+            weights['cash'] = cash
+            return weights
+
+        def build_policy(params, components):
+            return PeriodicRebalance(components['target'], params['period'])
+
+        sweep = ParameterSweep({'period': ['week', 'month'],
+                                'cash': [.1, .5]},
+                               {'target': (target, ['cash'])}, build_policy)
+        times = self.returns.index
+        table = sweep.run(self.simulator, self.portfolio, times[0],
+                          times[-1], parallel=False)
+        self.assertEqual(built, [.1, .5])
+        self.assertEqual(list(table.cash), [.1, .1, .5, .5])
+        self.assertEqual(list(table.cache_hits), [0, 1, 0, 1])
+
+        # the threads of a pool keep their own components
+        threaded = sweep.run(self.simulator, self.portfolio, times[0],
+                             times[-1], parallel='thread', chunk_size=2)
+        self.assertEqual(list(threaded.cache_hits), [0, 1, 0, 1])
+        self.assertItemsAlmostEqual(threaded.sharpe_ratio, table.sharpe_ratio)
+
+        for i, row in table.iterrows():
+            result = self.simulator.run_backtest(
+                self.portfolio, times[0], times[-1],
+                PeriodicRebalance(target(row.cash), row.period))
+            self.assertAlmostEqual(row.sharpe_ratio, result.sharpe_ratio)
@@ -22,11 +22,12 @@ import numpy as np
 import pandas as pd
 import copy
 
-from cvx_portfolio import simulator, portfolio
-from cvx_portfolio.costs import HcostModel, TcostModel
-from cvx_portfolio.policy import SinglePeriodOpt
-from cvx_portfolio.returns import AlphaSource, AlphaStream, MarketReturns
-from cvx_portfolio.risks import FullSigma
+from ..simulator import MarketSimulator
+from ..costs import HcostModel, TcostModel
+from ..policies import SinglePeriodOpt
+from ..returns import AlphaSource, AlphaStream
+from ..risks import FullSigma
+from ..solvers import SolverStrategy
 from .base_test import BaseTest
 
 DATAFILE = os.path.dirname(__file__) + os.path.sep + 'sample_data.pickle'
@@ -39,149 +40,124 @@ class TestWhatIf(BaseTest):
             data = pickle.load(f)
         self.returns, self.sigma, self.volume, self.a, \
             self.b, self.s = data
+        self.volume['cash'] = np.NaN
         self.universe = self.returns.columns
         self.times = self.returns.index
+        self.weights = np.array([0.1, 0.3, 0.6])
 
-    def test_attribution(self):
-        """Test attribution.
-        """
-        # Alpha source
+        # the sources are the same, so are the backtests of any weights
         alpha_sources = [AlphaSource(self.returns, name=i) for i in range(3)]
-        weights = np.array([0.1, 0.3, 0.6])
-        alpha_model = AlphaStream(alpha_sources, weights)
+        alpha_model = AlphaStream(alpha_sources, self.weights)
         emp_Sigma = np.cov(self.returns.as_matrix().T)
-        risk_model = FullSigma(emp_Sigma, gamma=100.)
+        risk_model = 100. * FullSigma(emp_Sigma)
         tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
         hcost_model = HcostModel(self.s, self.s*0)
-        pol = SinglePeriodOpt(alpha_model, [risk_model, tcost_model, hcost_model], [],
-                              solver=cvx.ECOS)
+        self.pol = SinglePeriodOpt(alpha_model,
+                                   [risk_model, tcost_model, hcost_model], [],
+                                   solver=cvx.ECOS)
 
-        returns_model = MarketReturns(self.returns)
         tcost = TcostModel(self.volume, self.sigma, self.a, self.b)
         hcost = HcostModel(self.s)
-        market_sim = simulator.MarketSimulator(returns_model, costs=[tcost, hcost])
-
-        p_0 = portfolio.Portfolio(pd.Series(index=self.universe, data=1E6))
-        noisy = market_sim.run_backtest(p_0, self.returns.index[1:10], pol)
-        # linear fit attribution
-        attr = market_sim.attribute(noisy, pol,
-                                    parallel=False, fit="linear")
-        base_line = noisy.v - p_0.v
-        for i in range(3):
-            self.assertItemsAlmostEqual(attr[i]/weights[i]/p_0.v, base_line/p_0.v)
-        self.assertItemsAlmostEqual(attr['RMS error'], np.zeros(len(noisy.v)))
-
-        # least-squares fit attribution
-        attr = market_sim.attribute(noisy, pol,
-                                    parallel=False, fit="least-squares")
-        base_line = noisy.v - p_0.v
-        for i in range(3):
-            self.assertItemsAlmostEqual(attr[i]/weights[i]/p_0.v, base_line/p_0.v)
-        # Residual always 0.
+        self.market_sim = MarketSimulator(self.returns, self.volume,
+                                          costs=[tcost, hcost])
+        self.p_0 = pd.Series(index=self.universe, data=1E6)
+        self.noisy = self.market_sim.run_backtest(self.p_0, self.times[1],
+                                                  self.times[9], self.pol)
+
+    def zero_alpha_policy(self):
         alpha_sources = [AlphaSource(self.returns*0, name=i) for i in range(3)]
-        weights = np.array([0.1, 0.3, 0.6])
-        alpha_model = AlphaStream(alpha_sources, weights)
-        pol = copy.copy(pol)
-        pol.alpha_model = alpha_model
-        attr = market_sim.attribute(noisy, pol,
-                                    parallel=False, fit="least-squares")
-        self.assertItemsAlmostEqual(attr['residual'], np.zeros(len(noisy.v)))
+        pol = copy.copy(self.pol)
+        pol.alpha_model = AlphaStream(alpha_sources, self.weights)
+        return pol
+
+    def check_attribution(self, selector, base_line):
+        """The attributions of the linear and least-squares fits."""
+        sources = list(range(3))
+        for fit in ["linear", "least-squares"]:
+            attr = self.market_sim.attribute(self.noisy, self.pol, selector,
+                                             parallel=False, fit=fit)
+            for i in sources:
+                self.assertItemsAlmostEqual(attr[i]/self.weights[i]/self.p_0.sum(),
+                                            base_line/self.p_0.sum())
+            # the parts sum to the attributed quantity
+            self.assertItemsAlmostEqual(
+                (attr[sources].sum(axis=1) + attr['residual'])/self.p_0.sum(),
+                base_line/self.p_0.sum())
+            if fit == "linear":
+                self.assertItemsAlmostEqual(attr['RMS error'],
+                                            np.zeros(len(base_line)))
+
+        # Residual always 0.
+        attr = self.market_sim.attribute(self.noisy, self.zero_alpha_policy(),
+                                         selector, parallel=False,
+                                         fit="least-squares")
+        self.assertItemsAlmostEqual(attr['residual'], np.zeros(len(base_line)))
+
+    def test_attribution(self):
+        """Test attribution of the profits.
+        """
+        self.check_attribution(None, self.noisy.v - self.p_0.sum())
 
     def test_attribute_non_profit_series(self):
         """Test attributing series quantities besides profit.
         """
-        # Alpha source
-        alpha_sources = [AlphaSource(self.returns, name=i) for i in range(3)]
-        weights = np.array([0.1, 0.3, 0.6])
-        alpha_model = AlphaStream(alpha_sources, weights)
-        emp_Sigma = np.cov(self.returns.as_matrix().T)
-        risk_model = FullSigma(emp_Sigma, gamma=100.)
-        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
-        hcost_model = HcostModel(self.s, self.s*0)
-        pol = SinglePeriodOpt(alpha_model, [risk_model, tcost_model, hcost_model], [],
-                              solver=cvx.ECOS)
-
-        returns_model = MarketReturns(self.returns)
-        tcost = TcostModel(self.volume, self.sigma, self.a, self.b)
-        hcost = HcostModel(self.s)
-        market_sim = simulator.MarketSimulator(returns_model, costs=[tcost, hcost])
-
-        p_0 = portfolio.Portfolio(pd.Series(index=self.universe, data=1E6))
-        noisy = market_sim.run_backtest(p_0, self.returns.index[1:10], pol)
-        # Select tcosts.
-
         def selector(result):
             return result.leverage
 
-        # linear fit attribution
-        attr = market_sim.attribute(noisy, pol, selector,
-                                    parallel=False, fit="linear")
-        base_line = noisy.leverage
-        for i in range(3):
-            self.assertItemsAlmostEqual(attr[i]/weights[i]/p_0.v, base_line/p_0.v)
-        self.assertItemsAlmostEqual(attr['RMS error'], np.zeros(len(noisy.v)))
-
-        # least-squares fit attribution
-        attr = market_sim.attribute(noisy, pol, selector,
-                                    parallel=False, fit="least-squares")
-        for i in range(3):
-            self.assertItemsAlmostEqual(attr[i]/weights[i]/p_0.v, base_line/p_0.v)
-        # Residual always 0.
-        alpha_sources = [AlphaSource(self.returns*0, name=i) for i in range(3)]
-        weights = np.array([0.1, 0.3, 0.6])
-        alpha_model = AlphaStream(alpha_sources, weights)
-        pol = copy.copy(pol)
-        pol.alpha_model = alpha_model
-        attr = market_sim.attribute(noisy, pol, selector,
-                                    parallel=False, fit="least-squares")
-        self.assertItemsAlmostEqual(attr['residual'], np.zeros(len(noisy.v)))
+        self.check_attribution(selector, self.noisy.leverage)
 
     def test_attribute_non_profit_scalar(self):
         """Test attributing scalar quantities besides profit.
         """
-        # Alpha source
-        alpha_sources = [AlphaSource(self.returns, name=i) for i in range(3)]
-        weights = np.array([0.1, 0.3, 0.6])
-        alpha_model = AlphaStream(alpha_sources, weights)
-        emp_Sigma = np.cov(self.returns.as_matrix().T)
-        risk_model = FullSigma(emp_Sigma, gamma=100.)
-        tcost_model = TcostModel(self.volume, self.sigma, self.a, self.b)
-        hcost_model = HcostModel(self.s, self.s*0)
-        pol = SinglePeriodOpt(alpha_model, [risk_model, tcost_model, hcost_model], [],
-                              solver=cvx.ECOS)
-
-        returns_model = MarketReturns(self.returns)
-        tcost = TcostModel(self.volume, self.sigma, self.a, self.b)
-        hcost = HcostModel(self.s)
-        market_sim = simulator.MarketSimulator(returns_model, costs=[tcost, hcost])
+        def selector(result):
+            return pd.Series(index=[self.noisy.h.index[-1]],
+                             data=result.volatility)
 
-        p_0 = portfolio.Portfolio(pd.Series(index=self.universe, data=1E6))
-        noisy = market_sim.run_backtest(p_0, self.returns.index[1:10], pol)
-        # Select tcosts.
+        self.check_attribution(selector, selector(self.noisy))
 
-        def selector(result):
-            return pd.Series(index=[noisy.h.index[-1]],
-                             data=result.realized_volatility)
-
-        # linear fit attribution
-        attr = market_sim.attribute(noisy, pol, selector,
-                                    parallel=False, fit="linear")
-        base_line = noisy.realized_volatility
-        for i in range(3):
-            self.assertAlmostEqual(attr[i][0]/weights[i]/p_0.v, base_line/p_0.v)
-        self.assertItemsAlmostEqual(attr['RMS error'], np.zeros(len(noisy.v)))
-
-        # least-squares fit attribution
-        attr = market_sim.attribute(noisy, pol, selector,
-                                    parallel=False, fit="least-squares")
-        for i in range(3):
-            self.assertAlmostEqual(attr[i][0]/weights[i]/p_0.v, base_line/p_0.v)
-        # Residual always 0.
-        alpha_sources = [AlphaSource(self.returns*0, name=i) for i in range(3)]
-        weights = np.array([0.1, 0.3, 0.6])
-        alpha_model = AlphaStream(alpha_sources, weights)
-        pol = copy.copy(pol)
-        pol.alpha_model = alpha_model
-        attr = market_sim.attribute(noisy, pol, selector,
-                                    parallel=False, fit="least-squares")
-        self.assertItemsAlmostEqual(attr['residual'], np.zeros(len(noisy.v)))
+    def test_alpha_sensitivity(self):
+        """Test the logged alpha sensitivity against bumped-alpha backtests.
+        """
+        n = len(self.universe)
+        sources = [AlphaSource(self.returns, name=0),
+                   AlphaSource(self.returns.shift(1).fillna(0.), name=1)]
+        emp_Sigma = np.cov(self.returns.as_matrix().T) + np.eye(n)*1e-3
+        tcost_model = TcostModel(self.volume, self.sigma,
+                                 self.a*0, self.b, power=2)
+
+        def backtest(weights, solver=cvx.ECOS, **kwargs):
+            pol = SinglePeriodOpt(AlphaStream(sources, weights),
+                                  [100*FullSigma(emp_Sigma), tcost_model], [],
+                                  solver=solver)
+            return self.market_sim.run_backtest(self.p_0, self.times[1],
+                                                self.times[9], pol,
+                                                **kwargs), pol
+
+        weights = np.array([.5, .5])
+        result, pol = backtest(weights, alpha_sensitivity=True)
+        self.assertEqual(result.alpha_sensitivity.shape, (len(result.v) - 1, 2))
+        eps = 1e-3
+        for k in range(2):
+            bumped = weights.copy()
+            bumped[k] += eps
+            # the sensitivity logged at t is that of the value after t
+            diff = (backtest(bumped)[0].v - result.v).iloc[1:] / eps
+            scale = np.abs(diff).max()
+            self.assertItemsAlmostEqual(diff / scale,
+                                        result.alpha_sensitivity.iloc[:, k] / scale,
+                                        places=2)
+
+        attr = self.market_sim.attribute(result, pol, fit="sensitivity")
+        profits = result.v - result.initial_val
+        self.assertItemsAlmostEqual(attr.iloc[0, :2], np.zeros(2))
+        self.assertItemsAlmostEqual(attr.iloc[1:, :2].values / weights,
+                                    result.alpha_sensitivity.values)
+        self.assertItemsAlmostEqual(
+            (attr[[0, 1]].sum(axis=1) + attr['residual'])/self.p_0.sum(),
+            profits/self.p_0.sum())
+
+        # no trades, nor derivatives, when the solvers fail
+        failed, _ = backtest(weights, solver=SolverStrategy(['NOT_A_SOLVER']),
+                             alpha_sensitivity=True)
+        self.assertItemsAlmostEqual(failed.alpha_sensitivity.values,
+                                    np.zeros(failed.alpha_sensitivity.shape))
@@ -16,3 +16,4 @@ limitations under the License.
 
 
 from .plotting import plot_what_if
+from .lazy import lazy_import
@@ -15,10 +15,11 @@ limitations under the License.
 """
 
 
-import matplotlib.pyplot as plt
 
 def plot_what_if(time, true_results, alt_results):
-    true_results.value.plot(label=true_results.pol_name)
+    # matplotlib is slow to import, so only load it when plotting
+    import matplotlib.pyplot as plt
+    true_results.v.plot(label=true_results.policy.__class__.__name__)
     for result in alt_results:
-        result.value.plot(label=result.pol_name, linestyle="--")
+        result.v.plot(label=result.policy.__class__.__name__, linestyle="--")
     plt.axvline(x=time, linestyle=":")
@@ -0,0 +1,103 @@
+"""
+Copyright 2016 Stephen Boyd, Enzo Busseti, Steven Diamond, BlackRock Inc.
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import copy
+
+import pandas as pd
+
+__all__ = ['data_window', 'restrict']
+
+# the models, constraints, policies and simulators are walked through,
+# they are the objects with a _cache_data method
+
+
+def _is_walked(obj):
+    return hasattr(obj, '_cache_data') and not isinstance(obj, type)
+
+
+def _is_time_indexed(obj):
+    return isinstance(obj, pd.core.generic.NDFrame) and \
+        isinstance(obj.axes[0], pd.DatetimeIndex)
+
+
+def _lookback_periods(obj, seen):
+    if isinstance(obj, (list, tuple)):
+        return max([_lookback_periods(item, seen) for item in obj] + [0])
+    if isinstance(obj, dict):
+        return _lookback_periods(list(obj.values()), seen)
+    if not _is_walked(obj) or id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    return max(getattr(obj, 'lookback_periods', 0),
+               _lookback_periods(list(vars(obj).values()), seen))
+
+
+def data_window(index, times, objs):
+    """The first and last time of the data used to simulate times.
+
+    Args:
+        index: the times of the market data, e.g. of the returns
+        times: the simulated times, a slice of index
+        objs: the simulator, policy and models, whose lookback_periods
+            are the periods before each time they use, and the policy's
+            lookahead_periods those after it, None for all of them.
+
+    Returns:
+        The (start, end) times of index.
+    """
+    first, last = index.get_loc(times[0]), index.get_loc(times[-1])
+    lookback = _lookback_periods(list(objs), set())
+    lookahead = max([getattr(obj, 'lookahead_periods', 0) or 0
+                     for obj in objs] + [0])
+    if any(getattr(obj, 'lookahead_periods', 0) is None for obj in objs):
+        lookahead = len(index)
+    return (index[max(first - lookback, 0)],
+            index[min(last + lookahead, len(index) - 1)])
+
+
+def restrict(obj, start, end, memo=None):
+    """A copy of obj whose data indexed by time are views of [start, end].
+
+    The Series, DataFrames and Panels indexed by time of obj, of its
+    lists, tuples and dicts, and of the models, constraints, policies and
+    simulators it refers to are sliced, which pandas does without copying
+    the data. The row before start is kept, for the lookups of the last
+    value before a time. The objects are copied shallowly and compute
+    again what they derive from their data with _cache_data.
+    """
+    if memo is None:
+        memo = {}
+    if id(obj) in memo:
+        return memo[id(obj)]
+    if _is_time_indexed(obj):
+        index = obj.axes[0]
+        first = max(index.searchsorted(start, side='right') - 1, 0)
+        result = obj.iloc[first:index.searchsorted(end, side='right')]
+    elif isinstance(obj, (list, tuple)):
+        result = type(obj)(restrict(item, start, end, memo) for item in obj)
+    elif isinstance(obj, dict):
+        result = type(obj)((key, restrict(value, start, end, memo))
+                           for key, value in obj.items())
+    elif _is_walked(obj):
+        result = copy.copy(obj)
+        memo[id(obj)] = result
+        for key, value in vars(obj).items():
+            setattr(result, key, restrict(value, start, end, memo))
+        result._cache_data()
+    else:
+        result = obj
+    memo[id(obj)] = result
+    return result
@@ -7,7 +7,8 @@ setup(
     author_email='ebusseti@stanford.edu, stevend2@stanford.edu',
     packages=['cvx_portfolio',
               'cvx_portfolio.tests',
-              'cvx_portfolio.utils'],
+              'cvx_portfolio.utils',
+              'cvx_portfolio.benchmarks'],
     package_dir={'cvx_portfolio': 'cvx_portfolio'},
     url='http://github.com/cvxgrp/cvx_portfolio/',
     license='Apache',
@@ -16,6 +17,7 @@ setup(
     install_requires=["pandas",
                       "pandas_datareader",
                       "matplotlib",
+                      "scipy",
                       "cvxpy"],
     use_2to3=True,
 )